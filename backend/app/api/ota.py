@@ -2,11 +2,17 @@ import aiohttp
 from pypinyin import lazy_pinyin
 from fastapi import APIRouter, Request
 from fastapi.responses import JSONResponse
+from tortoise import timezone
+from tortoise.exceptions import IntegrityError
 from core.log import logger
 from core.config import settings
+from core.firmware import firmware_info
+from core.rollout import rollout_engine
+from core.telemetry import record as record_telemetry
+from core.presence import heartbeat, heartbeat_device
 
 from controllers import device_controller
-from models import Ota, Agent, Profile
+from models import Agent, Profile
 from schemas import Fail
 
 router = APIRouter(tags=['OTA'])
@@ -71,6 +77,7 @@ async def ota(request: Request):
     # 查询设备是否OTA，是否有新版本
     device = await device_controller.get_by_mac(mac_address)
     if device:
+        await heartbeat_device(device)
         try:
             # 如果存在agent_id，则增加形象视频
             agent_id = device.agent_id
@@ -99,21 +106,22 @@ async def ota(request: Request):
                 res_data['wakeup'] = {'text': wakeup_word, 'pinyin': wakeup_pinyin}
         except Exception as e:
             logger.error(f'获取形象信息失败: {mac_address} {e}')
-        # 设备已存在，更新设备信息
-        await device_controller.update(
-            id=device.id, obj_in={'chip_type': chip_type, 'device_model': device_model, 'app_version': ori_version}
-        )
+        # 设备已存在，上报信息有变化或需要刷新最后在线时间时写入缓冲，由后台批量写库
+        await record_telemetry(device, chip_type=chip_type, device_model=device_model, app_version=ori_version)
+        # 灰度发布中的设备根据上报的版本判定上次升级结果
+        await rollout_engine.ensure_fresh()
+        await rollout_engine.observe(mac_address, device_model, ori_version)
         if not device.auto_update:
             res_data['firmware'] = {'version': ori_version, 'url': ''}
             logger.info(f'不更新固件: {mac_address} {res_data}')
             return JSONResponse(content=res_data)
-        # 获取最新版本信息
-        obj = await Ota.filter(device_model=device.device_model, is_default=True).first()
+        # 获取最新版本信息：灰度发布中的型号按设备分组决定下发版本，其余下发默认版本
+        obj = await rollout_engine.decide(mac_address, device_model, ori_version)
         if obj:
             logger.info(
                 f'{device.mac_address} {device.device_model} OtaEnabled {device.auto_update} 当前版本：{ori_version}，更新版本：{obj.app_version}'
             )
-            res_data['firmware'] = {'version': obj.app_version, 'url': f'{settings.OSS_BUCKET_URL}/{obj.ota_url}'}
+            res_data['firmware'] = firmware_info(obj, ori_version)
             logger.info(f'更新固件: {mac_address} {res_data}')
         else:
             logger.info(f'无最新固件: {mac_address} {res_data}')
@@ -125,8 +133,15 @@ async def ota(request: Request):
             'chip_type': chip_type,
             'device_model': device_model,
             'app_version': ori_version,
+            'last_seen_at': timezone.now(),
         }
-        await device_controller.create(obj_in=data)
+        try:
+            await device_controller.create(obj_in=data)
+        except IntegrityError:
+            # 同一设备的并发请求或批量导入已创建
+            logger.info(f'设备 {mac_address} 已存在，跳过新增')
+            return JSONResponse(content=res_data)
+        await heartbeat(data)
         logger.info(f'新增设备 {mac_address} 成功')
         return JSONResponse(content=res_data)
 
@@ -1,18 +1,26 @@
+import json
+import uuid
+import asyncio
 import hashlib
 from typing import Optional
-from fastapi import APIRouter, Query
+from fastapi import APIRouter, Query, Request
+from fastapi.responses import StreamingResponse
 from fastapi import File, UploadFile, Form
 from tortoise.expressions import Q
 from tortoise.transactions import in_transaction
-from core.background import CTX_USER_ID
+from core.background import CTX_USER_ID, BgTasks
 from core.log import logger
 from core.xz_api import xz_service
 from core.profile_api import bl_service, llm
-from core.celery_app import generate_videos, generate_single_video, celery_app
+from core.celery_app import generate_videos, generate_single_video, process_profile_upload, celery_app
 from core.minio import oss
+from core.oss_gc import enqueue_delete, sweep as oss_gc_sweep
+from core.uploads import create_slot, finalize_slot
 from core.config import settings
 from core.mcp_manager import mcp_manager
-from core.utils import resize_video_in_memory
+from core.mcp_supervisor import mcp_supervisor
+from core.mcp_events import subscribe as subscribe_mcp_status
+from core.utils import resized_video_file, file_digest, stream_digest
 from controllers import (
     agent_controller,
     agent_template_controller,
@@ -34,6 +42,8 @@ from schemas.agent import (
     AgentTemplateUpdate,
     ProfileVidGen,
     ProfileUpdate,
+    ProfileUploadSlot,
+    ProfileUploadFinalize,
     VoiceUpdate,
     SystemPromptCreate,
     SystemPromptUpdate,
@@ -308,9 +318,8 @@ async def upload_img(
     if balance < product.points_price:
         return Fail(code=402, msg='积分余额不足')
 
-    ori_img = await ori_img.read()
-    # 验证图片尺寸
-    is_valid, error_msg = bl_service.validate_image_size(ori_img)
+    # 验证图片尺寸：只读取图片头，文件内容留在上传的临时文件中
+    is_valid, error_msg = bl_service.validate_image_size(ori_img.file)
     if not is_valid:
         return Fail(code=400, msg=error_msg)
     # 创建profile栏位
@@ -322,7 +331,8 @@ async def upload_img(
     )
     suffix = hashlib.sha256(f'{obj.id}-ori'.encode()).hexdigest()[:4]
     ori_img_key = f'profile/img/{obj.id}-ori-img-{suffix}.png'
-    result = await oss.upload_file_async(ori_img_key, file_data=ori_img)
+    await ori_img.seek(0)
+    result = await oss.upload_stream_async(ori_img_key, ori_img.file, ori_img.size)
     if not result:
         await profile_controller.remove(id=obj.id)
         return Fail(code=400, msg='上传原始图片失败')
@@ -456,21 +466,20 @@ async def upload_vid(
     video: UploadFile = File(...),
 ):
     video_key = f'profile/vid/{id}/{emotion}.mp4'
-    video_data = await video.read()
-    # 转换视频尺寸
-    resized_data = await resize_video_in_memory(video_data)
-    if not resized_data:
-        return Fail(code=400, msg='视频转换失败')
-    upload_result = await oss.upload_file_async(
-        video_key,
-        file_data=resized_data,
-        content_type=video.content_type or 'application/octet-stream',
-    )
-    if not upload_result:
-        return Fail(code=400, msg='上传视频文件失败')
+    # 转换视频尺寸：上传文件分块落盘后由 ffmpeg 转换，转换结果从磁盘流式上传
+    async with resized_video_file(video) as resized_path:
+        if not resized_path:
+            return Fail(code=400, msg='视频转换失败')
+        upload_result = await oss.upload_file_async(
+            video_key,
+            file_path=resized_path,
+            content_type=video.content_type or 'application/octet-stream',
+        )
+        if not upload_result:
+            return Fail(code=400, msg='上传视频文件失败')
+        # 计算转换后视频文件的hash值
+        video_hash = await asyncio.to_thread(file_digest, resized_path)
     video_url = f'{settings.OSS_BUCKET_URL}/{video_key}'
-    # 计算转换后视频文件的hash值
-    video_hash = hashlib.sha256(resized_data).hexdigest()
     return Success(data={'video_url': video_url, 'video_hash': video_hash})
 
 
@@ -485,15 +494,16 @@ async def upload_src(
     obj = await Profile.get(id=id)
     if not obj:
         return Fail(code=400, msg='形象不存在')
-    source_data = await source.read()
-    if source_type == 'profile_vid':
-        resized_data = await resize_video_in_memory(source_data)
-        if not resized_data:
-            return Fail(code=400, msg='视频转换失败')
-        source_data = resized_data
     suffix = 'png' if source_type == 'avatar' else 'mp4'
     key = f'profile/src/{id}-{source_type}.{suffix}'
-    result = await oss.upload_file_async(key, file_data=source_data)
+    if source_type == 'profile_vid':
+        async with resized_video_file(source) as resized_path:
+            if not resized_path:
+                return Fail(code=400, msg='视频转换失败')
+            result = await oss.upload_file_async(key, file_path=resized_path)
+    else:
+        await source.seek(0)
+        result = await oss.upload_stream_async(key, source.file, source.size)
     if not result:
         return Fail(code=400, msg=f'上传{source_type}失败')
     url = f'{settings.OSS_BUCKET_URL}/{key}'
@@ -506,6 +516,45 @@ async def upload_src(
     return Success(data=data)
 
 
+@router.post('/profile/upload-slot', summary='申请视频直传凭证：客户端用返回的地址直接上传到对象存储')
+async def upload_slot_profile(
+    obj_in: ProfileUploadSlot,
+):
+    if obj_in.source_type not in ['emotion_vid', 'profile_vid']:
+        return Fail(code=400, msg='上传类型错误')
+    if obj_in.source_type == 'emotion_vid' and not obj_in.emotion:
+        return Fail(code=400, msg='缺少情绪参数')
+    if not obj_in.content_type.startswith('video/'):
+        return Fail(code=400, msg='只支持上传视频')
+    obj = await profile_controller.get(id=obj_in.id)
+    if not obj:
+        return Fail(code=400, msg='形象不存在')
+    # 原始视频先传到临时路径，确认后转换尺寸再写入正式路径
+    raw_key = f'profile/raw/{obj.id}/{uuid.uuid4().hex}.mp4'
+    data = await create_slot(
+        raw_key,
+        'profile_vid',
+        int(settings.UPLOAD_MAX_VIDEO_SIZE),
+        obj_in.content_type,
+        profile_id=obj.id,
+        source_type=obj_in.source_type,
+        emotion=obj_in.emotion,
+    )
+    return Success(data=data)
+
+
+@router.post('/profile/upload-finalize', summary='确认视频直传完成，提交转换任务')
+async def upload_finalize_profile(
+    obj_in: ProfileUploadFinalize,
+):
+    slot, msg = await finalize_slot(obj_in.slot_id, 'profile_vid')
+    if not slot:
+        return Fail(code=400, msg=msg)
+    # 转换尺寸、计算hash、写库都在celery中完成，通过 /profile/task-status/ 查询结果
+    task = process_profile_upload.delay(slot['profile_id'], slot['key'], slot['source_type'], slot['emotion'])
+    return Success(data={'task_id': task.id})
+
+
 @router.post('/profile/update', summary='手动创建形象(上传视频url)/更新形象')
 async def update_profile(
     obj_in: ProfileUpdate,
@@ -542,30 +591,13 @@ async def destroy_profile(
     obj = await profile_controller.get(id=id)
     if not obj:
         return Fail(code=400, msg='形象未创建')
-    # 删除oss中的文件：注意要改为key，而不是url
-    if obj.ori_img:
-        key = obj.ori_img.replace(settings.OSS_BUCKET_URL, '')
-        await oss.delete_file_async(key=key)
-    if obj.gen_img:
-        key = obj.gen_img.replace(settings.OSS_BUCKET_URL, '')
-        await oss.delete_file_async(key=key)
-    if obj.gen_vids:
-        for emotion, info in obj.gen_vids.items():
-            if info.get('url'):
-                key = info['url'].replace(settings.OSS_BUCKET_URL, '')
-                await oss.delete_file_async(key=key)
-    if obj.sys_vids:
-        for emotion, info in obj.sys_vids.items():
-            if info.get('url'):
-                key = info['url'].replace(settings.OSS_BUCKET_URL, '')
-                await oss.delete_file_async(key=key)
-    if obj.profile_vid:
-        key = obj.profile_vid.replace(settings.OSS_BUCKET_URL, '')
-        await oss.delete_file_async(key=key)
-    if obj.avatar:
-        key = obj.avatar.replace(settings.OSS_BUCKET_URL, '')
-        await oss.delete_file_async(key=key)
+    # 先删除记录，oss中的文件放入删除队列，由后台批量清理
+    urls = [obj.ori_img, obj.gen_img, obj.profile_vid, obj.avatar]
+    for vids in (obj.gen_vids, obj.sys_vids):
+        urls += [info.get('url') for info in (vids or {}).values()]
     await profile_controller.remove(id=id)
+    await enqueue_delete(urls)
+    await BgTasks.add_task(oss_gc_sweep)
     return Success(msg='删除成功')
 
 
@@ -686,10 +718,10 @@ async def create_mcp_tool(
     obj_in.token = token
     mcp = obj_in.model_dump()
     # 创建mcp连接
-    ok, msg = await mcp_manager.connect(mcp)
+    ok, msg = await mcp_supervisor.connect(mcp)
     if not ok:
         return Fail(code=400, msg=f'重启MCP服务失败: {msg}')
-    result = mcp_manager.get_connection_status(mcp.get('endpoint_id'))
+    result = await mcp_supervisor.get_connection_status(mcp.get('endpoint_id'))
     obj_in.status = result.get('status', '')
     obj = await mcp_tool_controller.create(obj_in)
     data = await obj.to_dict()
@@ -726,10 +758,10 @@ async def update_mcp_tool(
             'protocol': obj_in.protocol,
             'config': obj_in.config,
         }
-        ok, msg = await mcp_manager.connect(mcp)
+        ok, msg = await mcp_supervisor.connect(mcp)
         if not ok:
             return Fail(code=400, msg=f'重启MCP服务失败: {msg}')
-        result = mcp_manager.get_connection_status(mcp.get('endpoint_id'))
+        result = await mcp_supervisor.get_connection_status(mcp.get('endpoint_id'))
         obj_in.status = result.get('status', '')
         logger.info(f'重启MCP服务: {obj.endpoint_id}-{obj.name}')
     obj = await mcp_tool_controller.update(id=obj.id, obj_in=obj_in)
@@ -746,7 +778,7 @@ async def delete_mcp_tool(
         return Fail(code=400, msg='MCP不存在')
     # 删除manager中的服务
     mcp = await obj.to_dict()
-    await mcp_manager.disconnect(mcp)
+    await mcp_supervisor.disconnect(mcp)
     # 删除xz-service的MCP
     res = await xz_service.delete_mcp(obj.endpoint_id)
     if not res or not res.get('success'):
@@ -763,10 +795,10 @@ async def start_mcp_tool(obj_in: McpToolUpdate):
     if not obj:
         return Fail(code=400, msg='MCP不存在')
     mcp = await obj.to_dict()
-    ok, msg = await mcp_manager.connect(mcp)
+    ok, msg = await mcp_supervisor.connect(mcp)
     if not ok:
         return Fail(code=400, msg=f'MCP服务启动失败: {msg}')
-    result = mcp_manager.get_connection_status(mcp.get('endpoint_id'))
+    result = await mcp_supervisor.get_connection_status(mcp.get('endpoint_id'))
     await mcp_tool_controller.update(id=obj_in.id, obj_in={'status': result.get('status')})
     logger.info(f'启动MCP服务: {obj.endpoint_id}-{obj.name}')
     return Success(msg='MCP服务已启动')
@@ -778,26 +810,59 @@ async def stop_mcp_tool(obj_in: McpToolUpdate):
     if not obj:
         return Fail(code=400, msg='MCP不存在')
     mcp = await obj.to_dict()
-    await mcp_manager.disconnect(mcp)
+    await mcp_supervisor.disconnect(mcp)
     await mcp_tool_controller.update(id=obj_in.id, obj_in={'status': 'uncreated'})
     logger.info(f'停止MCP服务: {obj.endpoint_id}-{obj.name}')
     return Success(msg='MCP服务已停止')
 
 
+@router.get('/mcp-tool/metrics', summary='MCP工具调用耗时统计')
+async def get_mcp_tool_metrics(
+    endpoint_id: Optional[str] = Query('', description='MCP端点ID'),
+):
+    data = await mcp_supervisor.get_metrics()
+    if endpoint_id:
+        data = {key: {endpoint_id: value.get(endpoint_id, {})} for key, value in data.items()}
+    return Success(data=data)
+
+
+@router.get('/mcp-tool/events', summary='MCP工具状态推送')
+async def get_mcp_tool_events(request: Request):
+    """SSE 推送 MCP 状态变化，空闲时定期发送注释行保活"""
+
+    async def stream():
+        with subscribe_mcp_status() as queue:
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ': ping\n\n'
+                    continue
+                yield f'data: {json.dumps(event)}\n\n'
+
+    headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    return StreamingResponse(stream(), media_type='text/event-stream', headers=headers)
+
+
+@router.get('/mcp-tool/restore', summary='MCP工具启动恢复进度')
+async def get_mcp_tool_restore():
+    data = await mcp_supervisor.restore_progress()
+    return Success(data=data)
+
+
 # 音色克隆相关
 @router.post('/voice/upload', summary='上传音频文件')
 async def upload_voice(
     audio_file: UploadFile = File(...),
 ):
     user_id = CTX_USER_ID.get()
-    audio_content = await audio_file.read()
-    unique_id = hashlib.md5(audio_content).hexdigest()[:8]
+    unique_id = (await asyncio.to_thread(stream_digest, audio_file.file, 'md5'))[:8]
     audio_key = f'audio/ref-lx-{unique_id}.wav'
     obj = await Voice.filter(ref_audio=audio_key, user_id=user_id).first()
     if obj:
         return Fail(code=400, msg='音频已存在，请在音色管理页面编辑')
     logger.info(f'upload voice: {user_id} {unique_id}')
-    result = await oss.upload_audio_async(key=audio_key, audio_data=audio_content)
+    result = await oss.upload_audio_async(key=audio_key, audio_data=audio_file.file)
     if not result:
         return Fail(code=400, msg='上传音频失败')
     # 请求xz_service创建音色栏位
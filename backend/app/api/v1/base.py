@@ -10,6 +10,7 @@ from core.security import create_token, get_password_hash, verify_password
 from core.verifycode import RedisManager
 from core.log import logger
 from core.wx_api import wx_service
+from core.mcp_supervisor import mcp_supervisor
 from controllers import user_controller, agent_template_controller, system_config_controller
 from models.admin import Api, Menu, RoleApi, RoleMenu
 from schemas.admin import SystemConfigCreate, SystemConfigUpdate
@@ -277,3 +278,15 @@ async def update_config(config_in: SystemConfigUpdate):
 async def delete_config(id: int = Query(..., description='配置ID')):
     await system_config_controller.remove(id=id)
     return Success(msg='Deleted Successfully')
+
+
+@router.get('/ready', summary='服务就绪状态')
+async def get_ready():
+    """服务已可处理请求；MCP 连接在后台恢复，这里只返回恢复进度汇总，各工具明细见 /agent/mcp-tool/restore"""
+    try:
+        progress = await mcp_supervisor.restore_progress()
+    except Exception as e:
+        logger.error(f'查询MCP恢复进度失败: {e}')
+        return Success(data={'ready': True, 'mcp': None})
+    progress.pop('tools')
+    return Success(data={'ready': True, 'mcp': progress})
@@ -1,7 +1,16 @@
+import io
+import csv
+import functools
+import traceback
 from fastapi import APIRouter, Query
+from fastapi import File, UploadFile, Form
+from pydantic import ValidationError
 from tortoise.expressions import Q
 from core.log import logger
 from core.xz_api import xz_service
+from core.background import BgTasks
+from core.presence import online_count, online_map
+from core.bulk_jobs import create_job, record_results, run_job, finish_job, get_job
 from controllers import device_controller
 from schemas.base import Fail, Success, SuccessExtra
 from schemas.device import (
@@ -9,8 +18,13 @@ from schemas.device import (
     DeviceUpdate,
     DeviceBind,
     DevicePush,
+    DeviceImportItem,
+    DeviceBulkImport,
+    DeviceBulkIds,
+    DeviceBulkOta,
+    DeviceBulkBind,
 )
-from models.agent import Agent, AgentTemplate
+from models import Device
 
 
 router = APIRouter()
@@ -40,14 +54,28 @@ async def list_device(
     # 当前页码 每页显示数量；返回的是总数和当前页数据列表
     total, objs = await device_controller.list(page=page, page_size=page_size, search=q, order=['-id'])
     data = [await obj.to_dict() for obj in objs]
+    # 在线状态按 MAC 批量从心跳记录中查询
+    presence = await online_map([obj.mac_address for obj in objs])
+    for item in data:
+        item['online'], item['last_heartbeat'] = presence.get(item['mac_address'], (False, None))
     return SuccessExtra(data=data, total=total, page=page, page_size=page_size)
 
 
+@router.get('/online', summary='在线设备数')
+async def get_online_count(
+    agent_id: str = Query('', description='智能体ID'),
+    device_model: str = Query('', description='产品类型'),
+    user_id: str = Query('', description='用户ID'),
+):
+    data = await online_count(agent_id=agent_id, device_model=device_model, user_id=user_id)
+    return Success(data=data)
+
+
 @router.post('/create', summary='创建设备')
 async def create_device(
     obj_in: DeviceCreate,
 ):
-    obj = await device_controller.get_by_mac(device_id=obj_in.device_id)
+    obj = await device_controller.get_by_mac(obj_in.mac_address)
     if obj:
         return Fail(code=400, msg='设备已存在')
 
@@ -66,12 +94,9 @@ async def update_device(
         return Fail(code=400, msg='设备未绑定')
     if obj_in.auto_update is not None:
         # 给远端发送更新请求
-        res = await xz_service.update_device_ota(
-            agentId=obj.agent_id, macAddress=obj.mac_address, autoUpdate=1 if obj_in.auto_update else 0
-        )
-        if not res or not res['success']:
-            msg = res.get('message', '') if res else '未知'
-            return Fail(code=400, msg=f'远端设备更新OTA失败：{msg}')
+        ok, msg = await device_controller.set_auto_update(obj, obj_in.auto_update)
+        if not ok:
+            return Fail(code=400, msg=msg)
     await device_controller.update(id=obj_in.id, obj_in=obj_in)
     return Success(msg='Updated Successfully')
 
@@ -86,7 +111,7 @@ async def delete_device(
         return Fail(code=400, msg='Device not found')
     if obj.user_id:
         # 需要先解绑
-        await unbind_device(id=id)
+        await device_controller.unbind(obj)
     await device_controller.remove(id=id)
     return Success(msg='Device deleted Successfully')
 
@@ -95,107 +120,26 @@ async def delete_device(
 async def unbind_device(
     id: int = Query(..., description='ID'),
 ):
-    # 首先获得device
     device = await device_controller.get(id=id)
-    if device:
-        if not device.user_id:
-            return Fail(code=400, msg='设备已解绑')
-        # 1. 给远端发请求
-        result = await xz_service.unbind_device(deviceId=device.device_id)
-        if not result or not result['success']:
-            msg = result.get('message', '') if result else '未知'
-            return Fail(code=400, msg=f'远端设备解绑失败：{msg}')
-        # 2. 更新agent的devcice_count
-        agent = await Agent.filter(agent_id=device.agent_id).first()
-        await agent.update_from_dict({'device_count': agent.device_count - 1})
-        await agent.save()
-        # 3. device和用户解绑：主键 id 查询已经是唯一的，不需要.first()调用；新增is_unbound表示这个设备解绑过；必须用orm的.save()才能自动更新update_at字段
-        device.user_id = None
-        device.agent_id = None
-        device.device_id = None
-        device.last_conversation = None
-        device.alias = None
-        device.is_unbound = True
-        await device.save()
-
-        return Success(msg='Unbind Successfully')
-    else:
+    if not device:
         return Fail(msg='Device not found')
+    ok, msg = await device_controller.unbind(device)
+    if not ok:
+        return Fail(code=400, msg=msg)
+    return Success(msg='Unbind Successfully')
 
 
 @router.post('/bind', summary='绑定设备')
 async def bind_device(obj_in: DeviceBind):
-    # 判断 user_id 和 agent_id 是否匹配
-    user_id = obj_in.user_id
-    agent_id = obj_in.agent_id
-    if agent_id:
-        agent = await Agent.filter(user_id=user_id, agent_id=agent_id).first()
-        if not agent:
-            return Fail(code=400, msg=f'用户无权限操作当前智能体：{agent_id}')
-    res = await xz_service.bind_device(agentId=agent_id, verificationCode=obj_in.code)
-    if not res or not res['success']:
-        msg = res.get('message', '') if res else '未知'
-        return Fail(code=400, msg=f'设备绑定失败: {msg}')
-    data = res['data']
-
-    # 判断是否有agent_id，如果没有则创建一条agent记录
-    if agent_id:
-        # 更新agent中device_count
-        obj = await Agent.filter(agent_id=agent_id).first()
-        await obj.update_from_dict({'device_count': obj.device_count + 1})
-        await obj.save()
-    else:
-        # 创建一个agent
-        agent_id = data.get('agent_id', '')
-        res = await xz_service.get_agent(agent_id)
-        if not res or not res['success']:
-            msg = res.get('message', '') if res else '未知'
-            return Fail(code=400, msg=f'服务端获取智能体详情失败: {msg}')
-        agent = res['data'].get('agent')
-        agent['agent_id'] = agent.pop('id', agent_id)
-        agent['device_count'] = agent.pop('deviceCount', 0)
-        # 覆盖agent中的user_id，用我们库中的user_id
-        agent['user_id'] = user_id
-        # 根据agent_template_id获取模板的相关字段填入
-        template = await AgentTemplate.filter(agent_id=agent.get('agent_template_id', '')).first()
-        if template:
-            agent['avatar'] = template.avatar
-            agent['profile_id'] = template.profile_id
-            agent['system_prompt'] = template.system_prompt
-            agent['wakeup'] = template.wakeup
-        await Agent.create(**{k: v for k, v in agent.items() if v is not None})
-
-    # 判断是否有设备，如果没有则要创建一条设备记录
     try:
-        device = await device_controller.get_by_mac(data.get('mac_address', ''))
-        if device:
-            obj = await device_controller.update(
-                id=device.id,
-                obj_in={
-                    'user_id': user_id,
-                    'agent_id': agent_id,
-                    'device_id': data.get('id', ''),
-                    'auto_update': True if data.get('auto_update', False) else False,
-                    'serial_number': data.get('serial_number', ''),
-                },
-            )
-        else:
-            obj_in = {
-                'mac_address': data.get('mac_address', ''),
-                'user_id': user_id,
-                'agent_id': agent_id,
-                'device_id': data.get('id', ''),
-                'auto_update': True if data.get('auto_update', False) else False,
-                'serial_number': data.get('serial_number', ''),
-            }
-            obj = await device_controller.create(obj_in)
-        data = await obj.to_dict()
-        return Success(data=data, msg='绑定成功')
+        obj, msg = await device_controller.bind(user_id=obj_in.user_id, agent_id=obj_in.agent_id, code=obj_in.code)
     except Exception as e:
-        import traceback
-
         logger.error(f'设备绑定失败: {e}\n{traceback.format_exc()}')
         return Fail(code=500, msg=f'设备绑定失败: {str(e)}')
+    if not obj:
+        return Fail(code=400, msg=msg)
+    data = await obj.to_dict()
+    return Success(data=data, msg='绑定成功')
 
 
 @router.post('/push', summary='给设备推送消息')
@@ -205,3 +149,91 @@ async def push_message(obj_in: DevicePush):
         msg = res.get('message', '') if res else '未知'
         return Fail(code=400, msg=f'推送消息给设备失败: {msg}')
     return Success(msg='推送成功', data=res.get('data', {}))
+
+
+# 批量操作：请求返回任务ID，后台执行，通过 /bulk/job 查询每一项的结果
+async def _run_import(job_id, rows, on_conflict):
+    try:
+        results = await device_controller.bulk_import(rows, on_conflict=on_conflict)
+    except Exception as e:
+        logger.error(f'批量导入设备失败: {e}\n{traceback.format_exc()}')
+        await finish_job(job_id, status='failed', error=str(e))
+        return
+    await record_results(job_id, {item: (status != 'invalid', status) for item, status in results.items()})
+    # 重复的 MAC 只算一项
+    await finish_job(job_id, total=len(results))
+
+
+async def _start_import(rows, on_conflict):
+    if not rows:
+        return Fail(code=400, msg='没有要导入的设备')
+    job_id = await create_job('import', len(rows))
+    await BgTasks.add_task(_run_import, job_id, rows, on_conflict)
+    return Success(data={'job_id': job_id})
+
+
+@router.post('/bulk/import', summary='批量导入设备（JSON）')
+async def bulk_import_device(obj_in: DeviceBulkImport):
+    rows = [item.model_dump(exclude_none=True) for item in obj_in.devices]
+    return await _start_import(rows, obj_in.on_conflict)
+
+
+@router.post('/bulk/import-csv', summary='批量导入设备（CSV，首行为字段名，必须包含 mac_address）')
+async def bulk_import_device_csv(
+    file: UploadFile = File(...),
+    on_conflict: str = Form('skip', description='MAC已存在时：skip 跳过 / update 更新'),
+):
+    if on_conflict not in ['skip', 'update']:
+        return Fail(code=400, msg='on_conflict 参数错误')
+    content = (await file.read()).decode('utf-8-sig')
+    rows = []
+    for row in csv.DictReader(io.StringIO(content)):
+        row = {k.strip(): v.strip() for k, v in row.items() if k and v and v.strip()}
+        try:
+            rows.append(DeviceImportItem.model_validate(row).model_dump(exclude_none=True))
+        except ValidationError:
+            # 校验不通过的行记为 invalid
+            rows.append({})
+    return await _start_import(rows, on_conflict)
+
+
+async def _start_bulk(kind, ids, func):
+    devices = {str(obj.id): obj for obj in await Device.filter(id__in=ids)}
+    job_id = await create_job(kind, len(ids))
+    await record_results(job_id, {str(id): (False, '设备不存在') for id in ids if str(id) not in devices})
+    await BgTasks.add_task(run_job, job_id, devices, func)
+    return Success(data={'job_id': job_id})
+
+
+@router.post('/bulk/unbind', summary='批量解绑设备')
+async def bulk_unbind_device(obj_in: DeviceBulkIds):
+    return await _start_bulk('unbind', obj_in.ids, device_controller.unbind)
+
+
+@router.post('/bulk/ota', summary='批量开关设备OTA')
+async def bulk_ota_device(obj_in: DeviceBulkOta):
+    func = functools.partial(device_controller.set_auto_update, auto_update=obj_in.auto_update)
+    return await _start_bulk('ota', obj_in.ids, func)
+
+
+@router.post('/bulk/bind', summary='批量绑定设备（验证码列表）')
+async def bulk_bind_device(obj_in: DeviceBulkBind):
+    async def _bind(code):
+        obj, msg = await device_controller.bind(user_id=obj_in.user_id, agent_id=obj_in.agent_id, code=code)
+        return obj is not None, msg or obj.mac_address
+
+    codes = {code: code for code in dict.fromkeys(obj_in.codes)}
+    job_id = await create_job('bind', len(codes))
+    await BgTasks.add_task(run_job, job_id, codes, _bind)
+    return Success(data={'job_id': job_id})
+
+
+@router.get('/bulk/job', summary='查询批量操作任务')
+async def get_bulk_job(
+    job_id: str = Query(..., description='任务ID'),
+    with_items: bool = Query(True, description='是否返回每一项的结果'),
+):
+    job = await get_job(job_id, with_items=with_items)
+    if not job:
+        return Fail(code=400, msg='任务不存在或已过期')
+    return Success(data=job)
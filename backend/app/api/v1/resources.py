@@ -1,15 +1,30 @@
+import uuid
+import asyncio
 from fastapi import APIRouter, Query
 from fastapi import File, UploadFile, Form
 from tortoise.expressions import Q
 from controllers import (
     ota_controller,
+    ota_rollout_controller,
 )
 from schemas.base import Fail, Success, SuccessExtra
 from schemas.resource import (
     OtaCreate,
     OtaUpdate,
+    OtaUploadSlot,
+    OtaUploadFinalize,
+    OtaRolloutCreate,
+    OtaRolloutUpdate,
 )
 from core.minio import oss
+from core.oss_gc import enqueue_delete, sweep as oss_gc_sweep
+from core.oss_scanner import scan as oss_scan, get_usage as get_oss_usage
+from core.background import BgTasks
+from core.uploads import create_slot, finalize_slot
+from core.firmware import firmware_meta, save_meta, delete_meta
+from core.rollout import rollout_engine
+from core.celery_app import hash_firmware
+from core.config import settings
 
 
 router = APIRouter()
@@ -42,25 +57,33 @@ async def create_ota(obj_in: OtaCreate):
     obj = await ota_controller.get_by_name(app_version=obj_in.app_version, device_model=obj_in.device_model)
     if obj:
         return Fail(code=400, msg='ota版本已存在')
-    await ota_controller.create(obj_in=obj_in)
+    obj = await ota_controller.create(obj_in=obj_in)
+    await ota_controller.sync_firmware_meta(obj)
+    await rollout_engine.refresh()
     return Success(msg='Created Successfully')
 
 
 @router.post('/ota/update', summary='更新ota')
 async def update_ota(obj_in: OtaUpdate):
-    await ota_controller.update(id=obj_in.id, obj_in=obj_in)
+    old = await ota_controller.get(id=obj_in.id)
+    if not old:
+        return Fail(code=400, msg='ota版本不存在')
+    obj = await ota_controller.update(id=obj_in.id, obj_in=obj_in)
+    # 固件地址变化或成为默认版本时，更新元数据和差分包
+    if obj.ota_url != old.ota_url or (obj.is_default and not old.is_default):
+        await ota_controller.sync_firmware_meta(obj)
+    await rollout_engine.refresh()
     return Success(msg='Updated Successfully')
 
 
 @router.delete('/ota/delete', summary='删除ota')
 async def delete_ota(id: int = Query(..., description='ID')):
-    # 先删除OSS上的相关文件
     obj = await ota_controller.get(id=id)
-    if obj.ota_url:
-        await oss.delete_file_async(key=obj.ota_url)
-    if obj.whole_url:
-        await oss.delete_file_async(key=obj.whole_url)
     await ota_controller.remove(id=id)
+    # OSS上的相关文件放入删除队列，由后台批量清理
+    await enqueue_delete([obj.ota_url, obj.whole_url, obj.delta_url])
+    await BgTasks.add_task(oss_gc_sweep)
+    await rollout_engine.refresh()
     return Success(msg='Deleted Successfully')
 
 
@@ -72,8 +95,128 @@ async def upload_file_ota(
     file_type: str = Form(...),
 ):
     url = f'{device_model}-{app_version}.{file_type}'
-    file_content = await file.read()
-    status = await oss.upload_file_async(key=f'firmware/pro/{url}', file_data=file_content)
+    # 固件直接从上传的临时文件分片流式上传，不整体读入内存
+    await file.seek(0)
+    status = await oss.upload_stream_async(key=f'firmware/pro/{url}', stream=file.file, length=file.size)
     if not status:
         return Fail(code=500, msg='固件文件上传失败')
-    return Success(data={'url': f'firmware/pro/{url}'})
+    # 计算大小、sha256和分块清单，创建OTA记录时写入；已引用该地址的OTA记录立即更新
+    meta = await asyncio.to_thread(firmware_meta, file.file)
+    await save_meta(f'firmware/pro/{url}', meta)
+    await ota_controller.refresh_firmware(f'firmware/pro/{url}', meta)
+    return Success(data={'url': f'firmware/pro/{url}', 'size': meta['size'], 'sha256': meta['sha256']})
+
+
+@router.post('/ota/upload-slot', summary='申请固件直传凭证：客户端用返回的地址直接上传到对象存储')
+async def upload_slot_ota(obj_in: OtaUploadSlot):
+    url = f'{obj_in.device_model}-{obj_in.app_version}.{obj_in.file_type}'
+    # 先传到临时路径，确认通过后再复制到设备下载的正式路径，避免未校验的文件覆盖线上固件
+    data = await create_slot(
+        f'firmware/raw/{uuid.uuid4().hex}',
+        'firmware',
+        int(settings.UPLOAD_MAX_FIRMWARE_SIZE),
+        'application/octet-stream',
+        target=f'firmware/pro/{url}',
+    )
+    return Success(data=data)
+
+
+@router.post('/ota/upload-finalize', summary='确认固件直传完成，返回固件地址')
+async def upload_finalize_ota(obj_in: OtaUploadFinalize):
+    slot, msg = await finalize_slot(obj_in.slot_id, 'firmware')
+    if not slot:
+        return Fail(code=400, msg=msg)
+    key = slot['target']
+    copied = await oss.copy_file_async(slot['key'], key)
+    await enqueue_delete([slot['key']])
+    if not copied:
+        return Fail(code=500, msg='固件文件保存失败')
+    # 同一地址之前上传时缓存的元数据已失效，固件hash在celery中重新计算
+    await delete_meta(key)
+    await ota_controller.refresh_firmware(key)
+    task = hash_firmware.delay(key)
+    return Success(data={'url': key, 'size': slot['size'], 'task_id': task.id})
+
+
+# OTA灰度发布相关API
+@router.get('/ota/rollout/list', summary='查看ota灰度发布列表')
+async def list_ota_rollout(
+    page: int = Query(1, description='页码'),
+    page_size: int = Query(10, description='每页数量'),
+    device_model: str = Query('', description='设备型号，用于搜索'),
+    status: str = Query('', description='状态'),
+):
+    q = Q()
+    if device_model:
+        q &= Q(device_model__contains=device_model)
+    if status:
+        q &= Q(status=status)
+    # 列表前先把 Redis 中的实时计数同步到数据库
+    await rollout_engine.refresh()
+    total, objs = await ota_rollout_controller.list(page=page, page_size=page_size, search=q, order=['-id'])
+    data = [await obj.to_dict() for obj in objs]
+    return SuccessExtra(data=data, total=total, page=page, page_size=page_size)
+
+
+@router.post('/ota/rollout/create', summary='创建ota灰度发布')
+async def create_ota_rollout(obj_in: OtaRolloutCreate):
+    ota = await ota_controller.get(id=obj_in.ota_id)
+    if not ota:
+        return Fail(code=400, msg='ota版本不存在')
+    if ota.is_default:
+        return Fail(code=400, msg='该版本已是默认版本')
+    if await ota_rollout_controller.get_active(ota.device_model):
+        return Fail(code=400, msg='该型号已有进行中的灰度发布')
+    if not 0 <= obj_in.percentage <= 100:
+        return Fail(code=400, msg='灰度比例需在0-100之间')
+    data = obj_in.model_dump()
+    data.update(device_model=ota.device_model, app_version=ota.app_version, salt=uuid.uuid4().hex, status='active')
+    await ota_rollout_controller.create(obj_in=data)
+    await rollout_engine.refresh()
+    return Success(msg='Created Successfully')
+
+
+@router.post('/ota/rollout/update', summary='调整ota灰度发布：比例、暂停/恢复、完成')
+async def update_ota_rollout(obj_in: OtaRolloutUpdate):
+    obj = await ota_rollout_controller.get(id=obj_in.id)
+    if not obj:
+        return Fail(code=400, msg='灰度发布不存在')
+    if obj.status == 'completed':
+        return Fail(code=400, msg='灰度发布已完成')
+    if obj_in.percentage is not None and not 0 <= obj_in.percentage <= 100:
+        return Fail(code=400, msg='灰度比例需在0-100之间')
+    if obj_in.status and obj_in.status not in ['active', 'paused', 'completed']:
+        return Fail(code=400, msg='状态错误')
+    if obj_in.status == 'active' and await ota_rollout_controller.get_active(obj.device_model, exclude_id=obj.id):
+        return Fail(code=400, msg='该型号已有进行中的灰度发布')
+    data = obj_in.model_dump(exclude_unset=True, exclude={'id'})
+    # 自动暂停后恢复，清空暂停原因
+    if obj_in.status == 'active':
+        data['halt_reason'] = None
+    obj = await ota_rollout_controller.update(id=obj.id, obj_in=data)
+    if obj.status == 'completed':
+        await ota_rollout_controller.complete(obj)
+    await rollout_engine.refresh()
+    return Success(msg='Updated Successfully')
+
+
+@router.delete('/ota/rollout/delete', summary='删除ota灰度发布')
+async def delete_ota_rollout(id: int = Query(..., description='ID')):
+    await ota_rollout_controller.remove(id=id)
+    await rollout_engine.reset(id)
+    await rollout_engine.refresh()
+    return Success(msg='Deleted Successfully')
+
+
+# 对象存储巡检相关API
+@router.get('/oss/usage', summary='查看对象存储用量（最近一次巡检结果）')
+async def get_usage_oss(user_id: str = Query('', description='用户ID，指定时返回该用户的用量')):
+    data = await get_oss_usage(user_id=user_id)
+    return Success(data=data)
+
+
+@router.post('/oss/scan', summary='触发对象存储巡检')
+async def scan_oss(dry_run: bool = Query(True, description='仅统计不删除孤儿对象')):
+    # 巡检耗时较长，在请求返回后执行
+    await BgTasks.add_task(oss_scan, dry_run=dry_run)
+    return Success(msg='巡检任务已提交')
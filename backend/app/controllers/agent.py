@@ -1,8 +1,10 @@
+import asyncio
 from datetime import datetime, timedelta, timezone
 from typing import Optional
-from zoneinfo import ZoneInfo
 
+from tortoise.functions import Count
 from models.agent import Agent, AgentTemplate, Voice, Profile, SystemPrompt, McpTool, Alarm
+from models.device import Device
 from schemas.agent import (
     AgentCreate,
     AgentUpdate,
@@ -20,14 +22,24 @@ from schemas.agent import (
     AlarmUpdate,
 )
 
-from core.celery_app import push_alarm
+from core.celery_app import push_alarms
+from core.alarm_scheduler import (
+    schedule as schedule_alarm,
+    schedule_many as schedule_alarms,
+    unschedule as unschedule_alarm,
+    pop_due as pop_due_alarms,
+    ack as ack_alarms,
+    acquire_restore_lock,
+    release_restore_lock,
+    RESTORE_CHUNK_SIZE,
+    MISFIRE_GRACE,
+)
+from core.config import settings
 from core.log import logger
 from core.xz_api import xz_service
-from croniter import croniter
+from core.cron import next_fire, next_fires
 from .crud import CRUDBase
 
-_SHANGHAI_TZ = ZoneInfo('Asia/Shanghai')
-
 
 class AgentTemplateController(CRUDBase[AgentTemplate, AgentTemplateCreate, AgentTemplateUpdate]):
     def __init__(self):
@@ -41,6 +53,28 @@ class AgentController(CRUDBase[Agent, AgentCreate, AgentUpdate]):
     def __init__(self):
         super().__init__(model=Agent)
 
+    async def reconcile_device_counts(self) -> int:
+        """按设备表重新统计各智能体的设备数，修正不一致的记录，返回修正的数量"""
+        rows = (
+            await Device.filter(agent_id__isnull=False)
+            .annotate(count=Count('id'))
+            .group_by('agent_id')
+            .values('agent_id', 'count')
+        )
+        counts = {row['agent_id']: row['count'] for row in rows}
+        # 按修正后的数量分组，每组一条 UPDATE
+        fixes = {}
+        for agent in await self.model.all().values('id', 'agent_id', 'device_count'):
+            count = counts.get(agent['agent_id'], 0)
+            if agent['device_count'] != count:
+                fixes.setdefault(count, []).append(agent['id'])
+        for count, ids in fixes.items():
+            await self.model.filter(id__in=ids).update(device_count=count)
+        fixed = sum(len(ids) for ids in fixes.values())
+        if fixed:
+            logger.info(f'修正智能体设备数: {fixed} 条')
+        return fixed
+
 
 agent_controller = AgentController()
 
@@ -88,7 +122,7 @@ mcp_tool_controller = McpToolController()
 
 
 class AlarmController(CRUDBase[Alarm, AlarmCreate, AlarmUpdate]):
-    """闹钟业务逻辑：一次性 countdown，周期性触发后自动自调度"""
+    """闹钟业务逻辑：触发时间写入调度有序集合，到期后由轮询批量投递推送，周期性闹钟投递时即计算下次触发"""
 
     def __init__(self):
         super().__init__(model=Alarm)
@@ -98,12 +132,13 @@ class AlarmController(CRUDBase[Alarm, AlarmCreate, AlarmUpdate]):
         if existing:
             raise ValueError('该设备已有同名闹钟')
         alarm = await super().create(obj_in)
-        delay = self._calc_delay(alarm)
-        if delay is not None:
-            alarm.next_trigger_time = datetime.now(timezone.utc) + timedelta(seconds=delay)
+        now = datetime.now(timezone.utc)
+        trigger_at = self._next_trigger(alarm, now)
+        if trigger_at is not None:
+            alarm.next_trigger_time = trigger_at
             await alarm.save(update_fields=['next_trigger_time'])
-            push_alarm.apply_async(args=[alarm.id], countdown=delay)
-            logger.info(f'闹钟 {alarm.id} 已注册，{delay}秒后触发')
+            await schedule_alarm(alarm.id, alarm.next_trigger_time)
+            logger.info(f'闹钟 {alarm.id} 已注册，{int((trigger_at - now).total_seconds())}秒后触发')
         return alarm
 
     async def update(self, id: int, obj_in: AlarmUpdate) -> Optional[Alarm]:
@@ -111,86 +146,177 @@ class AlarmController(CRUDBase[Alarm, AlarmCreate, AlarmUpdate]):
             getattr(obj_in, k, None) is not None for k in ('enabled', 'cron_expr', 'delay_seconds')
         )
         alarm = await super().update(id, obj_in)
-        if alarm and need_reschedule and alarm.enabled:
-            delay = self._calc_delay(alarm)
-            if delay is not None:
-                alarm.next_trigger_time = datetime.now(timezone.utc) + timedelta(seconds=delay)
-                await alarm.save(update_fields=['next_trigger_time'])
-                push_alarm.apply_async(args=[alarm.id], countdown=delay)
+        if alarm and not alarm.enabled:
+            await unschedule_alarm(alarm.id)
+        elif alarm and need_reschedule:
+            trigger_at = self._next_trigger(alarm, datetime.now(timezone.utc))
+            # 已投递但还未执行的旧调度作废
+            alarm.schedule_gen += 1
+            if trigger_at is None:
+                # 表达式非法或未设置延迟，旧的触发时间不再生效
+                await alarm.save(update_fields=['schedule_gen'])
+                await unschedule_alarm(alarm.id)
+            else:
+                alarm.next_trigger_time = trigger_at
+                # 已触发或已过期的单次闹钟重新启用后恢复为生效状态，否则轮询时会被跳过
+                alarm.status = 'active'
+                await alarm.save(update_fields=['next_trigger_time', 'status', 'schedule_gen'])
+                await schedule_alarm(alarm.id, alarm.next_trigger_time)
         return alarm
 
-    @staticmethod
-    async def trigger_alarm(alarm_id: int):
-        """推送提醒 + 周期性闹钟自动重新调度"""
-        alarm = await Alarm.get_or_none(id=alarm_id)
-        if not alarm or not alarm.enabled:
-            return
-
-        # 幂等：60 秒内已触发过则跳过（防止重复投递导致重复推送）
-        if alarm.last_triggered and (datetime.now(timezone.utc) - alarm.last_triggered).total_seconds() < 60:
-            logger.info(f'闹钟 {alarm_id} 60秒内已触发，跳过')
-            return
-
-        if alarm.serial_number:
-            try:
-                await xz_service.push_message(
-                    serial_number=alarm.serial_number,
-                    message={'name': 'self.wake_up', 'arguments': {'reason': f'{alarm.name} 闹钟提醒时间到了，请播放相关提醒信息'}},
-                )
-            except Exception as e:
-                logger.error(f'闹钟 {alarm_id} 推送失败: {e}')
+    async def remove(self, id: int) -> None:
+        await super().remove(id)
+        await unschedule_alarm(id)
+
+    async def poll(self):
+        """取出到期的闹钟投递推送任务，周期性闹钟同时写入下次触发时间"""
+        alarm_ids = await pop_due_alarms()
+        if not alarm_ids:
+            return 0
+        try:
+            alarms = await Alarm.filter(id__in=alarm_ids, enabled=True, status='active')
+            rescheduled = self._reschedule_recurring(alarms, datetime.now(timezone.utc))
+            if rescheduled:
+                await Alarm.bulk_update(rescheduled, fields=['next_trigger_time'])
+                await schedule_alarms({alarm.id: alarm.next_trigger_time for alarm in rescheduled})
+            # 同一时刻到期的闹钟按批投递，每批在一个任务内并发推送；带上调度代数，重复投递的任务执行时丢弃
+            batch_size = int(settings.ALARM_BATCH_SIZE)
+            tokens = [[alarm.id, alarm.schedule_gen] for alarm in alarms]
+            for i in range(0, len(tokens), batch_size):
+                push_alarms.delay(tokens[i : i + batch_size])
+        except Exception as e:
+            # 不确认，租约到期后重新取出
+            logger.error(f'闹钟投递失败: {alarm_ids} {e}')
+            return 0
+        await ack_alarms(alarm_ids)
+        if alarms:
+            logger.info(f'闹钟到期投递 {len(alarms)} 个')
+        return len(alarms)
 
-        alarm.trigger_count += 1
-        alarm.last_triggered = datetime.now(timezone.utc)
+    @staticmethod
+    async def trigger_alarms(tokens: list[list[int]], claimed_tokens: Optional[list] = None):
+        """
+        批量推送提醒：按调度代数认领、并发推送、一次批量写库；周期性闹钟的下次触发已在投递时调度
+        Args:
+            tokens: [[闹钟ID, 投递时的调度代数]]，代数与数据库不一致的（已触发过、投递后被修改、重复投递）丢弃
+            claimed_tokens: 传入时写入认领成功的 [[闹钟ID, 认领后的调度代数]]，认领后推送或写库失败时用它重试
+        """
+        now = datetime.now(timezone.utc)
+        gens = {int(alarm_id): int(gen) for alarm_id, gen in tokens}
+        # 按代数条件更新认领，同一投递被多个进程同时执行时只有一个能更新成功
+        results = await asyncio.gather(
+            *(
+                Alarm.filter(id=alarm_id, schedule_gen=gen, enabled=True).update(schedule_gen=gen + 1)
+                for alarm_id, gen in gens.items()
+            )
+        )
+        claimed = [alarm_id for alarm_id, updated in zip(gens, results) if updated]
+        if claimed_tokens is not None:
+            claimed_tokens.extend([alarm_id, gens[alarm_id] + 1] for alarm_id in claimed)
+        stale = sorted(gens.keys() - set(claimed))
+        if stale:
+            logger.info(f'闹钟调度已过期或已被处理，跳过: {stale}')
+        if not claimed:
+            return 0
+        alarms = await Alarm.filter(id__in=claimed)
+
+        targets = [alarm for alarm in alarms if alarm.serial_number]
+        messages = [
+            (
+                alarm.serial_number,
+                {'name': 'self.wake_up', 'arguments': {'reason': f'{alarm.name} 闹钟提醒时间到了，请播放相关提醒信息'}},
+            )
+            for alarm in targets
+        ]
+        results = await xz_service.push_messages(messages)
+        failed = [alarm.id for alarm, res in zip(targets, results) if not res]
+        if failed:
+            logger.error(f'闹钟推送失败: {failed}')
 
-        if alarm.alarm_type == 'once':
-            alarm.status = 'triggered'
-            alarm.enabled = False
-            await alarm.save()
-        else:
-            delay = AlarmController._calc_delay(alarm)
-            if delay is not None:
-                alarm.next_trigger_time = datetime.now(timezone.utc) + timedelta(seconds=delay)
-                await alarm.save()
-                push_alarm.apply_async(args=[alarm.id], countdown=delay)
+        for alarm in alarms:
+            alarm.trigger_count += 1
+            alarm.last_triggered = now
+            if alarm.alarm_type == 'once':
+                alarm.status = 'triggered'
+                alarm.enabled = False
+        # 调度代数认领时已更新
+        fields = ['trigger_count', 'last_triggered', 'status', 'enabled']
+        await Alarm.bulk_update(alarms, fields=fields)
+        logger.info(f'闹钟触发 {len(alarms)} 个，推送失败 {len(failed)} 个')
+        return len(alarms)
 
     @staticmethod
-    def _calc_delay(alarm: Alarm) -> Optional[int]:
-        """计算距下次触发还剩多少秒（cron 按 Asia/Shanghai 时区解析）"""
+    def _next_trigger(alarm: Alarm, now: datetime) -> Optional[datetime]:
+        """计算下次触发时间（cron 按 Asia/Shanghai 时区解析，解析结果缓存）"""
         if alarm.alarm_type == 'once':
-            return alarm.delay_seconds if alarm.delay_seconds > 0 else None
-        if alarm.alarm_type == 'recurring' and alarm.cron_expr:
-            try:
-                now = datetime.now(_SHANGHAI_TZ).replace(tzinfo=None)
-                cron = croniter(alarm.cron_expr, now)
-                return int((cron.get_next(datetime) - now).total_seconds())
-            except Exception:
-                return None
+            return now + timedelta(seconds=alarm.delay_seconds) if alarm.delay_seconds > 0 else None
+        if alarm.alarm_type == 'recurring':
+            return next_fire(alarm.cron_expr, now=now)
         return None
 
+    @staticmethod
+    def _reschedule_recurring(alarms: list[Alarm], now: datetime) -> list[Alarm]:
+        """周期性闹钟按表达式分组计算下次触发时间，返回有下次触发的闹钟"""
+        recurring = [alarm for alarm in alarms if alarm.alarm_type == 'recurring']
+        fires = next_fires([alarm.cron_expr for alarm in recurring], now=now)
+        rescheduled = []
+        for alarm in recurring:
+            if fires.get(alarm.cron_expr):
+                alarm.next_trigger_time = fires[alarm.cron_expr]
+                rescheduled.append(alarm)
+        return rescheduled
+
     @staticmethod
     async def restore_schedules():
-        """服务重启后恢复所有未过期闹钟"""
-        alarms = await Alarm.filter(enabled=True, status='active').all()
-        count = 0
+        """
+        从数据库重建调度有序集合（服务启动时及定期执行），覆盖 Redis 数据丢失的场景
+        - 多个 worker 同时启动时只有拿到锁的执行，有序集合按闹钟ID写入，重复执行也不会产生重复调度
+        - 按ID顺序分块读取，不一次加载全部闹钟
+        """
+        token = await acquire_restore_lock()
+        if not token:
+            logger.info('闹钟调度正在由其他进程重建，跳过')
+            return 0
+        try:
+            now = datetime.now(timezone.utc)
+            last_id, total = 0, 0
+            while True:
+                alarms = (
+                    await Alarm.filter(enabled=True, status='active', id__gt=last_id)
+                    .order_by('id')
+                    .limit(RESTORE_CHUNK_SIZE)
+                )
+                if not alarms:
+                    break
+                last_id = alarms[-1].id
+                total += await AlarmController._restore_chunk(alarms, now)
+        finally:
+            await release_restore_lock(token)
+        logger.info(f'已恢复 {total} 个闹钟调度')
+        return total
+
+    @staticmethod
+    async def _restore_chunk(alarms: list[Alarm], now: datetime) -> int:
+        # 停机期间错过不久的仍写入调度，轮询时立即补发
+        since = now - timedelta(seconds=MISFIRE_GRACE)
+        scheduled, expired, missed = {}, [], []
         for alarm in alarms:
-            if alarm.alarm_type == 'once':
-                if alarm.next_trigger_time and alarm.next_trigger_time > datetime.now(timezone.utc):
-                    remaining = int((alarm.next_trigger_time - datetime.now(timezone.utc)).total_seconds())
-                    push_alarm.apply_async(args=[alarm.id], countdown=remaining)
-                    count += 1
-                else:
-                    alarm.status = 'expired'
-                    alarm.enabled = False
-                    await alarm.save()
+            if alarm.next_trigger_time and alarm.next_trigger_time > since:
+                scheduled[alarm.id] = alarm.next_trigger_time
+            elif alarm.alarm_type == 'once':
+                alarm.status = 'expired'
+                alarm.enabled = False
+                expired.append(alarm)
             else:
-                delay = AlarmController._calc_delay(alarm)
-                if delay is not None:
-                    alarm.next_trigger_time = datetime.now(timezone.utc) + timedelta(seconds=delay)
-                    await alarm.save()
-                    push_alarm.apply_async(args=[alarm.id], countdown=delay)
-                    count += 1
-        logger.info(f'已恢复 {count} 个闹钟调度')
+                missed.append(alarm)
+        rescheduled = AlarmController._reschedule_recurring(missed, now)
+        scheduled.update({alarm.id: alarm.next_trigger_time for alarm in rescheduled})
+        if expired:
+            await Alarm.bulk_update(expired, fields=['status', 'enabled'])
+        if rescheduled:
+            await Alarm.bulk_update(rescheduled, fields=['next_trigger_time'])
+        await schedule_alarms(scheduled)
+        return len(scheduled)
 
 
 alarm_controller = AlarmController()
@@ -1,6 +1,6 @@
 from typing import Any, Dict, Generic, List, NewType, Optional, Tuple, Type, TypeVar, Union
 from pydantic import BaseModel
-from tortoise.expressions import Q
+from tortoise.expressions import F, Q
 from tortoise.exceptions import DoesNotExist
 from tortoise.models import Model
 
@@ -45,6 +45,10 @@ class CRUDBase(Generic[ModelType, CreateSchemaType, UpdateSchemaType]):
         await obj.save()
         return obj
 
+    async def incr(self, field: str, value: int = 1, **filters) -> int:
+        """原子增减计数字段：UPDATE ... SET field = field + value，返回更新的行数"""
+        return await self.model.filter(**filters).update(**{field: F(field) + value})
+
     async def remove(self, id: int) -> None:
         obj = await self.get(id=id)
         await obj.delete()
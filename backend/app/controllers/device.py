@@ -1,12 +1,25 @@
-from typing import Optional
+from typing import Optional, Tuple
+from tortoise import timezone
+from tortoise.exceptions import IntegrityError
 
 from models import Device
+from models.agent import Agent, AgentTemplate
 from schemas.device import (
     DeviceCreate,
     DeviceUpdate,
 )
+from core.xz_api import xz_service
+from core.presence import forget as forget_presence
 
 from .crud import CRUDBase
+from .agent import agent_controller
+
+# 批量导入时允许写入的字段
+IMPORT_FIELDS = ['chip_type', 'device_model', 'app_version', 'auto_update', 'alias', 'serial_number']
+
+
+def _remote_msg(res):
+    return res.get('message', '') if res else '未知'
 
 
 class DeviceController(CRUDBase[Device, DeviceCreate, DeviceUpdate]):
@@ -16,5 +29,146 @@ class DeviceController(CRUDBase[Device, DeviceCreate, DeviceUpdate]):
     async def get_by_mac(self, mac_address: str) -> Optional[Device]:
         return await self.model.filter(mac_address=mac_address).first()
 
+    async def unbind(self, device: Device) -> Tuple[bool, str]:
+        """解绑设备：远端解绑、agent设备数减一、清空设备的绑定信息"""
+        if not device.user_id:
+            return False, '设备已解绑'
+        # 1. 给远端发请求
+        result = await xz_service.unbind_device(deviceId=device.device_id)
+        if not result or not result['success']:
+            return False, f'远端设备解绑失败：{_remote_msg(result)}'
+        # 2. 更新agent的devcice_count
+        if device.agent_id:
+            await agent_controller.incr('device_count', -1, agent_id=device.agent_id)
+        await forget_presence(device)
+        # 3. device和用户解绑：新增is_unbound表示这个设备解绑过；必须用orm的.save()才能自动更新update_at字段
+        device.user_id = None
+        device.agent_id = None
+        device.device_id = None
+        device.last_conversation = None
+        device.alias = None
+        device.is_unbound = True
+        await device.save()
+        return True, ''
+
+    async def bind(self, user_id: str, agent_id: Optional[str], code: str) -> Tuple[Optional[Device], str]:
+        """用验证码绑定设备，没有agent_id时按远端返回的智能体创建agent记录"""
+        if agent_id:
+            agent = await Agent.filter(user_id=user_id, agent_id=agent_id).first()
+            if not agent:
+                return None, f'用户无权限操作当前智能体：{agent_id}'
+        res = await xz_service.bind_device(agentId=agent_id, verificationCode=code)
+        if not res or not res['success']:
+            return None, f'设备绑定失败: {_remote_msg(res)}'
+        data = res['data']
+
+        # 判断是否有agent_id，如果没有则创建一条agent记录
+        if agent_id:
+            # 更新agent中device_count
+            await agent_controller.incr('device_count', 1, agent_id=agent_id)
+        else:
+            # 创建一个agent
+            agent_id = data.get('agent_id', '')
+            res = await xz_service.get_agent(agent_id)
+            if not res or not res['success']:
+                return None, f'服务端获取智能体详情失败: {_remote_msg(res)}'
+            agent = res['data'].get('agent')
+            agent['agent_id'] = agent.pop('id', agent_id)
+            agent['device_count'] = agent.pop('deviceCount', 0)
+            # 覆盖agent中的user_id，用我们库中的user_id
+            agent['user_id'] = user_id
+            # 根据agent_template_id获取模板的相关字段填入
+            template = await AgentTemplate.filter(agent_id=agent.get('agent_template_id', '')).first()
+            if template:
+                agent['avatar'] = template.avatar
+                agent['profile_id'] = template.profile_id
+                agent['system_prompt'] = template.system_prompt
+                agent['wakeup'] = template.wakeup
+            await Agent.create(**{k: v for k, v in agent.items() if v is not None})
+
+        # 判断是否有设备，如果没有则要创建一条设备记录
+        obj_in = {
+            'user_id': user_id,
+            'agent_id': agent_id,
+            'device_id': data.get('id', ''),
+            'auto_update': True if data.get('auto_update', False) else False,
+            'serial_number': data.get('serial_number', ''),
+        }
+        device = await self.get_by_mac(data.get('mac_address', ''))
+        if device:
+            return await self.update(id=device.id, obj_in=obj_in), ''
+        obj_in['mac_address'] = data.get('mac_address', '')
+        return await self.create(obj_in), ''
+
+    async def set_auto_update(self, device: Device, auto_update: bool) -> Tuple[bool, str]:
+        """开关设备OTA，先同步给远端"""
+        if not device.agent_id:
+            return False, '设备未绑定'
+        res = await xz_service.update_device_ota(
+            agentId=device.agent_id, macAddress=device.mac_address, autoUpdate=1 if auto_update else 0
+        )
+        if not res or not res['success']:
+            return False, f'远端设备更新OTA失败：{_remote_msg(res)}'
+        device.auto_update = auto_update
+        await device.save(update_fields=['auto_update', 'update_at'])
+        return True, ''
+
+    async def bulk_import(self, rows: list, on_conflict: str = 'skip', batch_size: int = 500) -> dict:
+        """
+        批量导入设备，按 mac_address 判断冲突
+        Args:
+            rows: 设备字段字典列表，必须包含 mac_address
+            on_conflict: skip 跳过已存在的设备 / update 用导入的字段更新已存在的设备
+        Returns:
+            mac_address -> 导入结果（created/updated/skipped），缺少 mac_address 的行以 #行号 记为 invalid
+        """
+        results, items = {}, {}
+        for idx, row in enumerate(rows, 1):
+            mac = (row.get('mac_address') or '').strip()
+            if not mac:
+                results[f'#{idx}'] = 'invalid'
+                continue
+            # 同一文件中重复的 mac 以最后一条为准
+            items[mac] = {k: row[k] for k in IMPORT_FIELDS if row.get(k) is not None}
+        macs = list(items)
+        for i in range(0, len(macs), batch_size):
+            batch = macs[i : i + batch_size]
+            existing = {obj.mac_address: obj for obj in await self.model.filter(mac_address__in=batch)}
+            creates, updates, fields = [], [], set()
+            for mac in batch:
+                obj = existing.get(mac)
+                if not obj:
+                    creates.append(self.model(mac_address=mac, **items[mac]))
+                    results[mac] = 'created'
+                elif on_conflict == 'update' and items[mac]:
+                    # bulk_update 不会自动更新 auto_now 字段
+                    obj.update_from_dict({**items[mac], 'update_at': timezone.now()})
+                    fields.update(items[mac])
+                    updates.append(obj)
+                    results[mac] = 'updated'
+                else:
+                    results[mac] = 'skipped'
+            if creates:
+                try:
+                    await self.model.bulk_create(creates, batch_size=batch_size)
+                except IntegrityError:
+                    # 查询后有设备被并发创建（如 /ota 自动注册），该批逐个创建，已存在的按冲突处理
+                    await self._create_each(creates, items, on_conflict, results)
+            if updates:
+                await self.model.bulk_update(updates, fields=[*fields, 'update_at'], batch_size=batch_size)
+        return results
+
+    async def _create_each(self, creates: list, items: dict, on_conflict: str, results: dict):
+        for obj in creates:
+            mac = obj.mac_address
+            try:
+                await self.model.create(mac_address=mac, **items[mac])
+            except IntegrityError:
+                if on_conflict == 'update' and items[mac]:
+                    await self.model.filter(mac_address=mac).update(**items[mac], update_at=timezone.now())
+                    results[mac] = 'updated'
+                else:
+                    results[mac] = 'skipped'
+
 
 device_controller = DeviceController()
@@ -1,13 +1,21 @@
 from typing import Optional
 from tortoise.expressions import Q
 
-from models import Ota
+from models import Ota, OtaRollout
 from schemas.resource import (
     OtaCreate,
     OtaUpdate,
+    OtaRolloutCreate,
+    OtaRolloutUpdate,
 )
+from core.celery_app import hash_firmware, build_firmware_delta
+from core.firmware import get_meta
 from .crud import CRUDBase
 
+# 固件变化后作废的元数据和差分包字段
+NO_META = {'size': None, 'sha256': None, 'chunk_size': None, 'chunk_manifest': None}
+NO_DELTA = {'delta_from': None, 'delta_url': None, 'delta_size': None, 'delta_sha256': None}
+
 
 # OTA
 class OtaController(CRUDBase[Ota, OtaCreate, OtaUpdate]):
@@ -17,5 +25,61 @@ class OtaController(CRUDBase[Ota, OtaCreate, OtaUpdate]):
     async def get_by_name(self, app_version: str, device_model: str) -> Optional[Ota]:
         return await self.model.filter(Q(app_version=app_version) & Q(device_model=device_model)).first()
 
+    async def sync_firmware_meta(self, obj: Ota):
+        """固件变更后补全元数据：优先用上传时缓存的结果，否则交给celery计算；并重新生成差分包"""
+        if not obj.ota_url:
+            return
+        data = dict(NO_DELTA)
+        meta = await get_meta(obj.ota_url)
+        if meta:
+            data.update(meta)
+        else:
+            # 旧固件的元数据先清空，计算完成前不下发
+            data.update(NO_META)
+        await self.model.filter(id=obj.id).update(**data)
+        if not meta:
+            hash_firmware.delay(obj.ota_url)
+        build_firmware_delta.delay(obj.id)
+
+    async def refresh_firmware(self, key: str, meta: Optional[dict] = None):
+        """
+        同一地址重新上传固件后，引用它的OTA记录更新元数据，这些记录及以它们为基准的差分包重新生成
+        Args:
+            key: 固件key
+            meta: 新固件的元数据，为空时先清空，由 hash_firmware 计算后写入
+        """
+        objs = await self.model.filter(ota_url=key)
+        if not objs:
+            return
+        q = Q(id__in=[obj.id for obj in objs])
+        for obj in objs:
+            q |= Q(device_model=obj.device_model, delta_from=obj.app_version)
+        ids = await self.model.filter(q).values_list('id', flat=True)
+        await self.model.filter(ota_url=key).update(**(meta or NO_META))
+        await self.model.filter(id__in=ids).update(**NO_DELTA)
+        for ota_id in ids:
+            build_firmware_delta.delay(ota_id)
+
 
 ota_controller = OtaController()
+
+
+# OTA灰度发布
+class OtaRolloutController(CRUDBase[OtaRollout, OtaRolloutCreate, OtaRolloutUpdate]):
+    def __init__(self):
+        super().__init__(model=OtaRollout)
+
+    async def get_active(self, device_model: str, exclude_id: int = None) -> Optional[OtaRollout]:
+        """同一型号同时只允许一个进行中的灰度发布"""
+        query = self.model.filter(device_model=device_model, status__in=['active', 'paused'])
+        if exclude_id:
+            query = query.exclude(id=exclude_id)
+        return await query.first()
+
+    async def complete(self, obj: OtaRollout):
+        """灰度完成：目标版本设为该型号的默认版本"""
+        await Ota.filter(device_model=obj.device_model, is_default=True).exclude(id=obj.ota_id).update(is_default=False)
+        await Ota.filter(id=obj.ota_id).update(is_default=True)
+
+
+ota_rollout_controller = OtaRolloutController()
@@ -0,0 +1,99 @@
+"""
+闹钟调度：按下次触发时间写入 Redis 有序集合，后台每秒批量取出到期的闹钟投递推送任务
+- 不再为每个闹钟投递 countdown 任务，远期闹钟不会作为未确认的 ETA 消息堆积在 Celery worker 内存中
+- 按闹钟ID分片到多个有序集合，取出用 Lua 脚本原子完成，多个进程同时轮询时每个闹钟只会被取出一次
+- 取出的闹钟先记入处理中集合，处理完成后删除；进程异常退出未处理完的，租约到期后放回重新投递
+"""
+
+import time
+from .config import settings
+from .redis_client import redis, acquire_lock, release_lock
+
+DUE_KEY = 'alarm:{{{}}}:due'  # 分片 -> 闹钟ID -> 触发时间戳，花括号保证同一分片的两个集合在同一个集群槽位
+INFLIGHT_KEY = 'alarm:{{{}}}:inflight'  # 分片 -> 闹钟ID -> 租约到期时间戳
+LEASE = 60  # 取出后多久未处理完视为失败，放回重新投递（秒）
+RESTORE_LOCK_KEY = 'alarm:restore:lock'
+RESTORE_LOCK_TTL = 600  # 重建调度的锁超时（秒），持锁进程异常退出后自动释放
+RESTORE_CHUNK_SIZE = 1000  # 重建调度时每次从数据库读取的闹钟数
+MISFIRE_GRACE = 300  # 重建调度时错过不超过该时间（秒）的闹钟仍补发
+
+# 先放回租约到期的，再取出到期的闹钟并记入处理中
+POP_SCRIPT = redis.register_script(
+    """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, id in ipairs(expired) do
+    redis.call('ZREM', KEYS[2], id)
+    redis.call('ZADD', KEYS[1], ARGV[1], id)
+end
+local ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, id in ipairs(ids) do
+    redis.call('ZREM', KEYS[1], id)
+    redis.call('ZADD', KEYS[2], ARGV[3], id)
+end
+return ids
+"""
+)
+
+
+def _shard(alarm_id):
+    return int(alarm_id) % int(settings.ALARM_SHARDS)
+
+
+async def schedule_many(alarms):
+    """
+    写入或更新闹钟的触发时间
+    Args:
+        alarms: 闹钟ID -> 触发时间（datetime）
+    """
+    if not alarms:
+        return
+    async with redis.pipeline(transaction=False) as pipe:
+        for alarm_id, trigger_at in alarms.items():
+            pipe.zadd(DUE_KEY.format(_shard(alarm_id)), {alarm_id: trigger_at.timestamp()})
+        await pipe.execute()
+
+
+async def schedule(alarm_id, trigger_at):
+    await schedule_many({alarm_id: trigger_at})
+
+
+async def unschedule(alarm_id):
+    """闹钟停用或删除时移除，已取出正在处理的也一并移除"""
+    shard = _shard(alarm_id)
+    async with redis.pipeline(transaction=False) as pipe:
+        pipe.zrem(DUE_KEY.format(shard), alarm_id)
+        pipe.zrem(INFLIGHT_KEY.format(shard), alarm_id)
+        await pipe.execute()
+
+
+async def pop_due(limit=None):
+    """取出所有分片中到期的闹钟，每个分片最多 limit 个"""
+    now = time.time()
+    limit = limit or int(settings.ALARM_BATCH_SIZE)
+    async with redis.pipeline(transaction=False) as pipe:
+        for shard in range(int(settings.ALARM_SHARDS)):
+            await POP_SCRIPT(
+                keys=[DUE_KEY.format(shard), INFLIGHT_KEY.format(shard)], args=[now, limit, now + LEASE], client=pipe
+            )
+        results = await pipe.execute()
+    return [int(alarm_id) for ids in results for alarm_id in ids]
+
+
+async def acquire_restore_lock():
+    """多个 worker 启动时都会重建调度，同一时间只允许一个执行；返回释放用的令牌，未获取到时为 None"""
+    return await acquire_lock(RESTORE_LOCK_KEY, RESTORE_LOCK_TTL)
+
+
+async def release_restore_lock(token):
+    """重建超过锁超时时，锁可能已被其他进程持有，只释放自己的"""
+    await release_lock(RESTORE_LOCK_KEY, token)
+
+
+async def ack(alarm_ids):
+    """处理完成，从处理中集合移除"""
+    if not alarm_ids:
+        return
+    async with redis.pipeline(transaction=False) as pipe:
+        for alarm_id in alarm_ids:
+            pipe.zrem(INFLIGHT_KEY.format(_shard(alarm_id)), alarm_id)
+        await pipe.execute()
@@ -0,0 +1,117 @@
+"""
+音频处理：参考音频统一转为单声道 OPUS
+- ffmpeg 分块解码为 float32 PCM，不整段读入内存
+- 采样率不在 OPUS 支持范围时用多相滤波（resample_poly）分块重采样
+- 在独立进程池中执行，不和事件循环争抢 GIL
+"""
+
+import math
+import shutil
+import asyncio
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import soundfile as sf
+import scipy.signal as signal
+from pydub import AudioSegment
+from pydub.utils import mediainfo
+from .config import settings
+
+VALID_RATES = [8000, 12000, 16000, 24000, 48000]  # OPUS 支持的采样率
+TARGET_RATE = 16000
+CHUNK_SECONDS = 1  # 每次解码/重采样的时长
+
+_executor = None
+
+
+def _decode_chunks(src_path, samplerate):
+    """ffmpeg 解码为单声道 float32 PCM，按块产出；输出采样率显式指定，与后续处理使用的一致"""
+    chunk_bytes = samplerate * CHUNK_SECONDS * 4
+    cmd = [AudioSegment.converter, '-v', 'error', '-i', src_path]
+    cmd += ['-f', 'f32le', '-ac', '1', '-ar', str(samplerate), '-']
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    try:
+        while True:
+            data = proc.stdout.read(chunk_bytes)
+            if not data:
+                break
+            yield np.frombuffer(data[: len(data) // 4 * 4], dtype=np.float32)
+        proc.stdout.close()
+        if proc.wait() != 0:
+            raise RuntimeError(f'音频解码失败: {proc.stderr.read().decode(errors="ignore")}')
+    finally:
+        # 消费方提前退出时结束 ffmpeg 进程
+        if proc.poll() is None:
+            proc.kill()
+            proc.wait()
+        proc.stderr.close()
+
+
+def _resample_chunks(chunks, src_rate, dst_rate):
+    """
+    分块多相重采样，与整段 resample_poly 结果一致
+    每块左右各带 pad 个样本的上下文（覆盖滤波器长度），块长和 pad 都取 down 的整数倍，
+    这样每块输出的样本数是整数，去掉上下文对应的输出后直接拼接
+    """
+    g = math.gcd(src_rate, dst_rate)
+    up, down = dst_rate // g, src_rate // g
+    # resample_poly 默认滤波器半长为 10 * max(up, down)（上采样后的样本数）
+    pad = down * math.ceil((10 * max(up, down) / up + 1) / down)
+    step = down * max(src_rate * CHUNK_SECONDS // down, 1)
+    trim = pad * up // down
+    # 开头补零，与整段处理时的边界一致
+    buf = np.zeros(pad, dtype=np.float32)
+    for chunk in chunks:
+        buf = np.concatenate([buf, chunk])
+        while len(buf) >= pad + step + pad:
+            out = signal.resample_poly(buf[: pad + step + pad], up, down)
+            yield out[trim:-trim]
+            buf = buf[step:]
+    rest = len(buf) - pad
+    if rest > 0:
+        out = signal.resample_poly(np.concatenate([buf, np.zeros(pad, dtype=np.float32)]), up, down)
+        yield out[trim : trim + math.ceil(rest * up / down)]
+
+
+def normalize_audio(src_path, dst_path):
+    """
+    任意格式音频转为单声道 OPUS（ogg 封装）
+    Returns:
+        输出采样率
+    """
+    samplerate = int(mediainfo(src_path).get('sample_rate') or TARGET_RATE)
+    chunks = _decode_chunks(src_path, samplerate)
+    if samplerate not in VALID_RATES:
+        chunks = _resample_chunks(chunks, samplerate, TARGET_RATE)
+        samplerate = TARGET_RATE
+    with sf.SoundFile(dst_path, 'w', samplerate, 1, format='OGG', subtype='OPUS') as f:
+        for chunk in chunks:
+            f.write(np.clip(chunk, -1.0, 1.0))
+    return samplerate
+
+
+def spool_audio(audio_data, dst_path):
+    """上传的音频（bytes 或文件对象）落盘，交给子进程按路径处理"""
+    with open(dst_path, 'wb') as f:
+        if hasattr(audio_data, 'read'):
+            audio_data.seek(0)
+            shutil.copyfileobj(audio_data, f)
+        else:
+            f.write(audio_data)
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        # spawn 启动子进程，不继承事件循环、连接池等父进程状态
+        _executor = ProcessPoolExecutor(
+            max_workers=max(int(settings.AUDIO_WORKERS), 1), mp_context=multiprocessing.get_context('spawn')
+        )
+    return _executor
+
+
+async def normalize_audio_async(src_path, dst_path):
+    """在进程池中转换音频"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_get_executor(), normalize_audio, src_path, dst_path)
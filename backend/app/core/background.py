@@ -4,8 +4,14 @@ from starlette.background import BackgroundTasks
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from tzlocal import get_localzone
 from datetime import datetime, timedelta
-from controllers import pointsgrant_controller
+from controllers import pointsgrant_controller, agent_controller, alarm_controller
 from .log import logger
+from .config import settings
+from .oss_gc import sweep as oss_gc_sweep
+from .oss_scanner import scan as oss_scan
+from .rollout import rollout_engine
+from .telemetry import flush as telemetry_flush
+from .presence import prune as presence_prune
 
 # 上下文变量：当前请求用户ID，每个请求都在独立的异步上下文中运行，contextvars 会为每个协程维护独立的上下文状态
 CTX_USER_ID: contextvars.ContextVar[str] = contextvars.ContextVar('user_id', default='0')
@@ -60,5 +66,63 @@ def setup_scheduler():
         timezone=tz,
         id='test',
     )
+    # 定期批量清理对象存储删除队列
+    scheduler.add_job(
+        oss_gc_sweep,
+        'interval',
+        seconds=int(settings.OSS_GC_INTERVAL),
+        timezone=tz,
+        id='oss_gc_sweep',
+        max_instances=1,
+        coalesce=True,
+    )
+    # 每天凌晨4点巡检对象存储，统计用量并清理孤儿对象
+    scheduler.add_job(oss_scan, 'cron', hour=4, minute=0, kwargs={'dry_run': False}, timezone=tz, id='oss_scan')
+    # 每小时按设备表校正智能体设备数
+    scheduler.add_job(
+        agent_controller.reconcile_device_counts, 'interval', hours=1, timezone=tz, id='reconcile_device_counts'
+    )
+    # 定期刷新OTA灰度内存表，启动时立即加载
+    scheduler.add_job(
+        rollout_engine.refresh,
+        'interval',
+        seconds=int(settings.OTA_ROLLOUT_REFRESH),
+        next_run_time=datetime.now(tz),
+        timezone=tz,
+        id='ota_rollout_refresh',
+        max_instances=1,
+        coalesce=True,
+    )
+    # 定期把设备上报信息批量写库
+    scheduler.add_job(
+        telemetry_flush,
+        'interval',
+        seconds=int(settings.TELEMETRY_FLUSH_INTERVAL),
+        timezone=tz,
+        id='telemetry_flush',
+        max_instances=1,
+        coalesce=True,
+    )
+    # 定期清理设备心跳记录
+    scheduler.add_job(presence_prune, 'interval', minutes=10, timezone=tz, id='presence_prune', max_instances=1)
+    # 轮询到期闹钟批量投递；启动时及每小时按数据库重建闹钟调度
+    scheduler.add_job(
+        alarm_controller.poll,
+        'interval',
+        seconds=int(settings.ALARM_POLL_INTERVAL),
+        timezone=tz,
+        id='alarm_poll',
+        max_instances=1,
+        coalesce=True,
+    )
+    scheduler.add_job(
+        alarm_controller.restore_schedules,
+        'interval',
+        hours=1,
+        next_run_time=datetime.now(tz),
+        timezone=tz,
+        id='alarm_restore',
+        max_instances=1,
+    )
     scheduler.start()
     return scheduler
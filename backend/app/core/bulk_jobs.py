@@ -0,0 +1,88 @@
+"""
+设备批量操作任务：请求返回任务ID，后台按并发上限逐项执行，每一项的结果写入 Redis 供查询
+"""
+
+import json
+import time
+import uuid
+import asyncio
+from .config import settings
+from .log import logger
+from .redis_client import redis
+
+JOB_KEY = 'device:job:{}'  # 任务概况
+JOB_ITEMS_KEY = 'device:job:{}:items'  # 每一项的结果
+JOB_TTL = 86400
+
+
+async def create_job(kind, total):
+    """创建批量任务，返回任务ID"""
+    job_id = uuid.uuid4().hex
+    key = JOB_KEY.format(job_id)
+    job = {'kind': kind, 'status': 'pending', 'total': total, 'success': 0, 'failed': 0, 'created_at': int(time.time())}
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.hset(key, mapping=job)
+        pipe.expire(key, JOB_TTL)
+        await pipe.execute()
+    return job_id
+
+
+async def record_results(job_id, results):
+    """
+    批量写入每一项的结果
+    Args:
+        results: 项 -> (是否成功, 说明)
+    """
+    if not results:
+        return
+    key, items_key = JOB_KEY.format(job_id), JOB_ITEMS_KEY.format(job_id)
+    success = sum(1 for ok, _ in results.values() if ok)
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.hset(
+            items_key, mapping={item: json.dumps({'success': ok, 'msg': msg}) for item, (ok, msg) in results.items()}
+        )
+        pipe.expire(items_key, JOB_TTL)
+        pipe.hincrby(key, 'success', success)
+        pipe.hincrby(key, 'failed', len(results) - success)
+        await pipe.execute()
+
+
+async def run_job(job_id, items, func):
+    """
+    后台执行批量任务，并发数不超过 DEVICE_BULK_CONCURRENCY，避免打满远端接口
+    Args:
+        items: 项 -> 执行参数
+        func: async func(参数) -> (是否成功, 说明)
+    """
+    await redis.hset(JOB_KEY.format(job_id), 'status', 'running')
+    semaphore = asyncio.Semaphore(max(int(settings.DEVICE_BULK_CONCURRENCY), 1))
+
+    async def _run(item, arg):
+        async with semaphore:
+            try:
+                ok, msg = await func(arg)
+            except Exception as e:
+                logger.error(f'批量任务 {job_id} 执行失败: {item} {e}')
+                ok, msg = False, str(e)
+        await record_results(job_id, {item: (ok, msg)})
+
+    await asyncio.gather(*(_run(item, arg) for item, arg in items.items()))
+    await finish_job(job_id)
+    logger.info(f'批量任务 {job_id} 执行完成，共 {len(items)} 项')
+
+
+async def finish_job(job_id, status='finished', **fields):
+    await redis.hset(JOB_KEY.format(job_id), mapping={'status': status, **fields})
+
+
+async def get_job(job_id, with_items=True):
+    """查询批量任务进度和每一项的结果"""
+    job = await redis.hgetall(JOB_KEY.format(job_id))
+    if not job:
+        return None
+    for field in ('total', 'success', 'failed', 'created_at'):
+        job[field] = int(job.get(field, 0))
+    if with_items:
+        items = await redis.hgetall(JOB_ITEMS_KEY.format(job_id))
+        job['items'] = {item: json.loads(result) for item, result in items.items()}
+    return job
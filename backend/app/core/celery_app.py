@@ -3,13 +3,15 @@ Celery 任务队列配置和任务定义
 用于异步视频生成任务
 """
 
+import os
 import hashlib
 import asyncio
+import tempfile
 from tortoise import Tortoise
 from celery import Celery, shared_task
-from celery.signals import task_prerun, worker_shutdown, worker_ready
+from celery.signals import task_prerun, worker_shutdown
 from core.config import settings
-from core.utils import resize_video_in_memory
+from core.utils import resize_video, resize_video_in_memory, file_digest
 from core.minio import oss
 from core.log import logger
 from models.agent import Profile
@@ -73,34 +75,10 @@ def close_tortoise(**kwargs):
         pass  # 已经关闭或从未初始化，忽略即可
 
 
-@worker_ready.connect
-def restore_alarm_schedules(**kwargs):
-    """Worker 启动时恢复所有未过期闹钟调度（从数据库权威重建）：覆盖的是 Redis 丢失的场景"""
-    init_tortoise()
-    import os
-    import sys
-    _app_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-    if _app_dir not in sys.path:
-        sys.path.insert(0, _app_dir)
-    from controllers.agent import alarm_controller
-
-    async def _restore():
-        await alarm_controller.restore_schedules()
-
-    try:
-        loop = asyncio.get_running_loop()
-    except RuntimeError:
-        asyncio.run(_restore())
-    else:
-        # Celery 主进程已有 running loop，用线程安全方式提交并等待
-        future = asyncio.run_coroutine_threadsafe(_restore(), loop)
-        future.result(timeout=60)
-
-
 @shared_task(bind=True, max_retries=2)
 def generate_videos(self, profile_id: int, img_url: str, subject_type: str, batch_size: int = 2):
     """
-    异步生成形象视频任务
+    异步生成形象视频任务，各情绪进度记录在 Profile.gen_ckpt，重试或 Worker 丢失后重新投递时从断点续跑
 
     Args:
         profile_id: 形象ID
@@ -111,9 +89,18 @@ def generate_videos(self, profile_id: int, img_url: str, subject_type: str, batc
 
     from core.profile_api import bl_service
     try:
-        logger.info(f'开始执行视频生成任务: profile_id={profile_id}')
+        logger.info(f'开始执行视频生成任务: profile_id={profile_id}, retries={self.request.retries}')
         # asyncio.run(bl_service.generate_and_save_test(profile_id, img_url, subject_type, batch_size))
-        asyncio.run(bl_service.generate_and_save(profile_id, img_url, subject_type, batch_size))
+        asyncio.run(
+            bl_service.generate_and_save(
+                profile_id,
+                img_url,
+                subject_type,
+                batch_size,
+                job_id=self.request.id,
+                final_attempt=self.request.retries >= self.max_retries,
+            )
+        )
         logger.info(f'视频生成任务完成: profile_id={profile_id}')
     except Exception as e:
         logger.error(f'视频生成任务异常: profile_id={profile_id}, error={e}')
@@ -177,13 +164,147 @@ def generate_single_video(self, profile_id: int, gen_img: str, subject_type: str
         raise self.retry(exc=e, countdown=60)
 
 
-@shared_task(bind=True, max_retries=1)
-def push_alarm(self, alarm_id: int):
-    """闹钟触发：推送提醒消息给设备，周期性闹钟自动重新调度"""
-    from controllers.agent import alarm_controller  # 延迟导入，避免循环依赖
+@shared_task(bind=True, max_retries=2)
+def process_profile_upload(self, profile_id: int, raw_key: str, source_type: str, emotion: str = None):
+    """
+    客户端直传视频的后处理：转换尺寸后上传到正式路径，计算hash并写入形象
+
+    Args:
+        profile_id: 形象ID
+        raw_key: 客户端直传的原始视频key
+        source_type: 上传类型（emotion_vid/profile_vid）
+        emotion: 情感/动作类型，emotion_vid 时必填
+    """
+
+    async def _run():
+        if source_type == 'profile_vid':
+            video_key = f'profile/src/{profile_id}-profile_vid.mp4'
+        else:
+            video_key = f'profile/vid/{profile_id}/{emotion}.mp4'
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            input_path = os.path.join(tmp_dir, 'input.mp4')
+            output_path = os.path.join(tmp_dir, 'output.mp4')
+            # 1. 下载原始视频
+            if not await oss.download_file_async(raw_key, input_path):
+                raise Exception('下载原始视频失败')
+
+            # 2. 转换视频尺寸
+            if not await resize_video(input_path, output_path):
+                raise Exception('视频转换失败')
+
+            # 3. 上传到正式路径
+            result = await oss.upload_file_async(video_key, file_path=output_path, content_type='video/mp4')
+            if not result:
+                raise Exception('上传视频失败')
+            video_hash = await asyncio.to_thread(file_digest, output_path)
+
+        # 4. 保存到数据库
+        final_url = f'{settings.OSS_BUCKET_URL}/{video_key}'
+        profile = await Profile.get_or_none(id=profile_id)
+        if profile:
+            if source_type == 'profile_vid':
+                profile.profile_vid = final_url
+                await profile.save(update_fields=['profile_vid'])
+            else:
+                gen_vids = profile.gen_vids or {}
+                gen_vids[emotion] = {'url': final_url, 'hash': video_hash, 'status': 'success', 'msg': ''}
+                profile.gen_vids = gen_vids
+                await profile.save(update_fields=['gen_vids'])
+
+        # 5. 删除原始视频
+        await oss.delete_file_async(raw_key)
+        return {'url': final_url, 'hash': video_hash}
+
+    try:
+        logger.info(f'开始处理直传视频: profile_id={profile_id}, key={raw_key}')
+        result = asyncio.run(_run())
+        logger.info(f'直传视频处理完成: profile_id={profile_id}, url={result["url"]}')
+        return result
+    except Exception as e:
+        logger.error(f'直传视频处理失败: profile_id={profile_id}, key={raw_key}, error={e}')
+        raise self.retry(exc=e, countdown=60)
+
+
+@shared_task(bind=True, max_retries=2)
+def hash_firmware(self, key: str):
+    """
+    固件元数据计算：大小、sha256和分块清单，写入引用该固件的OTA记录
+
+    Args:
+        key: 固件key
+    """
+    from core.firmware import firmware_meta, save_meta
+    from models.resource import Ota
+
+    async def _run():
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            file_path = os.path.join(tmp_dir, 'firmware.bin')
+            if not await oss.download_file_async(key, file_path):
+                raise Exception('下载固件失败')
+            meta = await asyncio.to_thread(firmware_meta, file_path)
+        # 缓存结果，之后创建/更新引用该固件的OTA记录时不再重复计算
+        await save_meta(key, meta)
+        await Ota.filter(ota_url=key).update(**meta)
+        return {'key': key, 'size': meta['size'], 'sha256': meta['sha256']}
+
     try:
-        logger.info(f'闹钟触发: alarm_id={alarm_id}')
-        asyncio.run(alarm_controller.trigger_alarm(alarm_id))
+        return asyncio.run(_run())
     except Exception as e:
-        logger.error(f'闹钟触发失败: alarm_id={alarm_id}, error={e}')
+        logger.error(f'固件hash计算失败: key={key}, error={e}')
         raise self.retry(exc=e, countdown=30)
+
+
+@shared_task(bind=True, max_retries=2)
+def build_firmware_delta(self, ota_id: int):
+    """
+    生成相对同型号上一默认版本的差分包
+
+    Args:
+        ota_id: OTA记录ID
+    """
+    from core.firmware import build_delta
+    from models.resource import Ota
+
+    async def _run():
+        obj = await Ota.get_or_none(id=ota_id)
+        if not obj or not obj.ota_url:
+            return None
+        base = (
+            await Ota.filter(device_model=obj.device_model, is_default=True).exclude(id=obj.id).order_by('-id').first()
+        )
+        if not base or not base.ota_url or base.app_version == obj.app_version:
+            return None
+        delta = await build_delta(obj, base)
+        if delta:
+            await Ota.filter(id=ota_id).update(**delta)
+        return delta
+
+    try:
+        return asyncio.run(_run())
+    except Exception as e:
+        logger.error(f'差分包生成失败: ota_id={ota_id}, error={e}')
+        raise self.retry(exc=e, countdown=60)
+
+
+@shared_task(bind=True, max_retries=1, rate_limit='10/s')
+def push_alarms(self, tokens: list[list[int]]):
+    """
+    闹钟批量触发：一个任务内并发推送同一批到期的闹钟，每批已合并多个闹钟，不受全局每分钟 10 个任务的限流
+    认领后推送或写库失败时，用认领后的调度代数重试：期间闹钟被修改的仍会丢弃；推送成功但写库失败的会重复推送一次
+    """
+    from controllers.agent import alarm_controller  # 延迟导入，避免循环依赖
+
+    claimed = []
+    try:
+        logger.info(f'闹钟批量触发: {len(tokens)} 个')
+        asyncio.run(alarm_controller.trigger_alarms(tokens, claimed))
+    except Exception as e:
+        logger.error(f'闹钟批量触发失败: tokens={tokens}, error={e}')
+        # 已认领的代数已加一，原 tokens 重试会被当作过期丢弃
+        raise self.retry(exc=e, args=[claimed or tokens], countdown=30)
+
+
+@shared_task
+def push_alarm(alarm_id: int):
+    """升级前按 countdown 投递的单个闹钟任务：调度已由有序集合按数据库重建，这里直接丢弃，避免重复推送"""
+    logger.info(f'丢弃过期的闹钟任务: alarm_id={alarm_id}')
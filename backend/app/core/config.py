@@ -17,6 +17,9 @@ class Settings(BaseSettings):
     USER_FE_URL: str = os.getenv('USER_FE_URL', '')
     BACK_END_PORT: int = os.getenv('BACK_END_PORT', 3000)
     ENVIRONMENT: str = os.getenv('ENVIRONMENT', 'dev')
+    # 日志配置
+    LOG_JSON: bool = os.getenv('LOG_JSON', 'false').lower() in ['true']  # 日志文件按 JSON 输出
+    LOG_SAMPLING: str = os.getenv('LOG_SAMPLING', 'mcp=1:200')  # 按 logger 采样和限流：名称=采样比例:每秒条数
     # JWT 配置
     JWT_SECRET_KEY: str = os.getenv('JWT_SECRET_KEY', 'secret_key')
     JWT_ALGORITHM: str = 'HS256'
@@ -39,6 +42,41 @@ class Settings(BaseSettings):
     OSS_BUCKET_URL: str = os.getenv('OSS_BUCKET_URL', '')
     OSS_REGION: str = os.getenv('OSS_REGION', '')
     OSS_SECURE: bool = os.getenv('OSS_SECURE', True).lower() in ['true']
+    OSS_PART_SIZE: int = os.getenv('OSS_PART_SIZE', 16 * 1024 * 1024)  # 分片上传的分片大小，不小于5MB
+    OSS_UPLOAD_PARALLEL: int = os.getenv('OSS_UPLOAD_PARALLEL', 4)  # 单个文件并行上传的分片数
+    OSS_MAX_WORKERS: int = os.getenv('OSS_MAX_WORKERS', 8)  # 对象存储专用线程池大小
+    OSS_MAX_PENDING: int = os.getenv('OSS_MAX_PENDING', 32)  # 对象存储在途请求上限，超出后调用方排队等待
+    OSS_GC_INTERVAL: int = os.getenv('OSS_GC_INTERVAL', 300)  # 对象存储删除队列清理间隔（秒）
+    OSS_SCAN_GRACE: int = os.getenv('OSS_SCAN_GRACE', 86400)  # 孤儿对象保护期（秒），新上传还未写库的对象不清理
+    AUDIO_WORKERS: int = os.getenv('AUDIO_WORKERS', 2)  # 音频转码进程池大小
+    UPLOAD_SLOT_EXPIRES: int = os.getenv('UPLOAD_SLOT_EXPIRES', 3600)  # 直传地址有效期（秒）
+    UPLOAD_MAX_VIDEO_SIZE: int = os.getenv('UPLOAD_MAX_VIDEO_SIZE', 200 * 1024 * 1024)  # 直传视频大小上限
+    UPLOAD_MAX_FIRMWARE_SIZE: int = os.getenv('UPLOAD_MAX_FIRMWARE_SIZE', 64 * 1024 * 1024)  # 直传固件大小上限
+    FIRMWARE_CHUNK_SIZE: int = os.getenv('FIRMWARE_CHUNK_SIZE', 1024 * 1024)  # 固件分块清单的分块大小
+    OTA_ROLLOUT_REFRESH: int = os.getenv('OTA_ROLLOUT_REFRESH', 30)  # OTA灰度内存表刷新间隔（秒）
+    DEVICE_BULK_CONCURRENCY: int = os.getenv('DEVICE_BULK_CONCURRENCY', 8)  # 设备批量操作请求远端的并发数
+    TELEMETRY_FLUSH_INTERVAL: int = os.getenv('TELEMETRY_FLUSH_INTERVAL', 60)  # 设备上报信息批量写库间隔（秒）
+    TELEMETRY_SEEN_RESOLUTION: int = os.getenv('TELEMETRY_SEEN_RESOLUTION', 300)  # 最后在线时间的记录粒度（秒）
+    PRESENCE_TTL: int = os.getenv('PRESENCE_TTL', 600)  # 最后心跳在该时间（秒）内视为在线
+    PRESENCE_RETAIN: int = os.getenv('PRESENCE_RETAIN', 30 * 86400)  # 设备心跳记录保留时间（秒）
+    ALARM_SHARDS: int = os.getenv('ALARM_SHARDS', 16)  # 闹钟调度有序集合分片数
+    ALARM_POLL_INTERVAL: int = os.getenv('ALARM_POLL_INTERVAL', 1)  # 到期闹钟轮询间隔（秒）
+    ALARM_BATCH_SIZE: int = os.getenv('ALARM_BATCH_SIZE', 200)  # 每个分片每次最多取出的到期闹钟数
+    ALARM_PUSH_CONCURRENCY: int = os.getenv('ALARM_PUSH_CONCURRENCY', 32)  # 闹钟批量触发时并发推送数
+    MCP_INPROCESS_HTTP: bool = os.getenv('MCP_INPROCESS_HTTP', 'true').lower() in ['true']  # sse/http 进程内转发
+    MCP_HTTP_POOL_SIZE: int = os.getenv('MCP_HTTP_POOL_SIZE', 256)  # MCP sse/http 共享连接池大小
+    MCP_SUPERVISOR_INTERVAL: int = os.getenv('MCP_SUPERVISOR_INTERVAL', 5)  # MCP worker 心跳和对账间隔（秒）
+    MCP_CALL_TIMEOUT: int = os.getenv('MCP_CALL_TIMEOUT', 120)  # MCP 工具调用超时（秒），超时回错误给设备
+    MCP_STDIO_READ_LIMIT: int = os.getenv('MCP_STDIO_READ_LIMIT', 1024 * 1024)  # MCP 子进程输出读缓冲，超长行分块拼接
+    MCP_MAX_FRAME_SIZE: int = os.getenv('MCP_MAX_FRAME_SIZE', 32 * 1024 * 1024)  # MCP 单条消息上限，超过丢弃
+    MCP_SEND_HIGH_WATER: int = os.getenv('MCP_SEND_HIGH_WATER', 8 * 1024 * 1024)  # 发送队列高水位，超过暂停读取
+    MCP_SEND_LOW_WATER: int = os.getenv('MCP_SEND_LOW_WATER', 2 * 1024 * 1024)  # 发送队列低水位，低于恢复读取
+    MCP_SEND_STALL_TIMEOUT: int = os.getenv('MCP_SEND_STALL_TIMEOUT', 30)  # 发送队列持续满载超时（秒），超时丢弃消息
+    MCP_HTTP_TIMEOUT: int = os.getenv('MCP_HTTP_TIMEOUT', 120)  # MCP http 单次请求超时（秒）
+    MCP_PROBE_TIMEOUT: int = os.getenv('MCP_PROBE_TIMEOUT', 10)  # MCP 启动和测试时 JSON-RPC 握手探活超时（秒）
+    MCP_SPARE_TTL: int = os.getenv('MCP_SPARE_TTL', 120)  # 测试通过的 MCP 进程暂存时间（秒），期间创建接入点直接复用
+    MCP_RESTORE_CONCURRENCY: int = os.getenv('MCP_RESTORE_CONCURRENCY', 8)  # 启动恢复 MCP 连接的最大并发数
+    MCP_RESTORE_JITTER: float = os.getenv('MCP_RESTORE_JITTER', 2)  # 启动恢复 MCP 连接的随机延迟上限（秒）
     # 各类API配置
     GD_KEY: str = os.getenv('GD_KEY', '')
     BD_KEY: str = os.getenv('BD_KEY', '')
@@ -0,0 +1,55 @@
+"""
+cron 表达式缓存：同一表达式和时区只解析一次，下次触发时间在到达之前直接复用
+- 大部分周期性闹钟共用少量表达式，批量调度时按表达式分组，每个表达式只计算一次
+"""
+
+from datetime import datetime, timezone
+from functools import lru_cache
+from zoneinfo import ZoneInfo
+from croniter import croniter
+
+DEFAULT_TZ = 'Asia/Shanghai'  # 闹钟 cron 按北京时间解析
+CRON_CACHE_SIZE = 1024
+
+_next_cache = {}  # (表达式, 时区) -> (计算时刻, 下次触发时间)
+
+
+@lru_cache(maxsize=CRON_CACHE_SIZE)
+def _compile(expr, tz_name):
+    """解析表达式，非法时返回 None（同样缓存，避免反复解析）"""
+    try:
+        return croniter(expr, datetime.now(ZoneInfo(tz_name)))
+    except Exception:
+        return None
+
+
+def next_fire(expr, tz_name=DEFAULT_TZ, now=None):
+    """
+    下次触发时间
+    Returns:
+        UTC 时间，表达式非法时为 None
+    """
+    if not expr:
+        return None
+    now = now or datetime.now(timezone.utc)
+    key = (expr, tz_name)
+    cached = _next_cache.get(key)
+    # 在上次计算时刻与下次触发之间，结果不变
+    if cached and cached[0] <= now < cached[1]:
+        return cached[1]
+    cron = _compile(expr, tz_name)
+    if cron is None:
+        return None
+    # 缓存的 croniter 是有状态的迭代器，每次从当前时间重新开始
+    cron.set_current(now.astimezone(ZoneInfo(tz_name)), force=True)
+    fire = cron.get_next(datetime).astimezone(timezone.utc)
+    if len(_next_cache) >= CRON_CACHE_SIZE:
+        _next_cache.clear()
+    _next_cache[key] = (now, fire)
+    return fire
+
+
+def next_fires(exprs, tz_name=DEFAULT_TZ, now=None):
+    """批量计算，相同表达式只算一次：表达式 -> 下次触发时间"""
+    now = now or datetime.now(timezone.utc)
+    return {expr: next_fire(expr, tz_name, now) for expr in set(exprs)}
@@ -0,0 +1,111 @@
+"""
+固件元数据：大小、sha256、分块清单，以及基于上一默认版本的差分包
+设备按分块清单校验已下载的部分，中断后用 Range 续传；版本匹配时可以只下载差分包
+"""
+
+import os
+import json
+import asyncio
+import hashlib
+import shutil
+import tempfile
+from .config import settings
+from .log import logger
+from .minio import oss
+from .redis_client import redis
+
+META_KEY = 'firmware:meta:{}'
+META_TTL = 7 * 86400
+
+
+def firmware_meta(fileobj, chunk_size=None):
+    """
+    一次读取同时计算整体 sha256 和各分块 sha256
+    Args:
+        fileobj: 文件对象或本地路径
+        chunk_size: 分块大小，默认 FIRMWARE_CHUNK_SIZE
+    """
+    if isinstance(fileobj, str):
+        with open(fileobj, 'rb') as f:
+            return firmware_meta(f, chunk_size)
+    chunk_size = chunk_size or int(settings.FIRMWARE_CHUNK_SIZE)
+    digest = hashlib.sha256()
+    manifest = []
+    size = 0
+    fileobj.seek(0)
+    while chunk := fileobj.read(chunk_size):
+        digest.update(chunk)
+        manifest.append(hashlib.sha256(chunk).hexdigest())
+        size += len(chunk)
+    fileobj.seek(0)
+    return {'size': size, 'sha256': digest.hexdigest(), 'chunk_size': chunk_size, 'chunk_manifest': manifest}
+
+
+async def save_meta(key, meta):
+    """上传时计算的元数据先缓存，创建/更新 OTA 记录时直接使用"""
+    await redis.set(META_KEY.format(key), json.dumps(meta), ex=META_TTL)
+
+
+async def get_meta(key):
+    meta = await redis.get(META_KEY.format(key))
+    return json.loads(meta) if meta else None
+
+
+async def delete_meta(key):
+    """同一地址重新上传后，旧文件的元数据作废"""
+    await redis.delete(META_KEY.format(key))
+
+
+def firmware_info(obj, current_version=None):
+    """OTA 接口返回给设备的固件信息，设备当前版本与差分包基准版本一致时带上差分包"""
+    info = {'version': obj.app_version, 'url': f'{settings.OSS_BUCKET_URL}/{obj.ota_url}'}
+    if obj.sha256:
+        info.update(size=obj.size, sha256=obj.sha256, chunk_size=obj.chunk_size, chunks=obj.chunk_manifest or [])
+    if obj.delta_url and obj.delta_from and obj.delta_from == current_version:
+        info['delta'] = {
+            'from': obj.delta_from,
+            'url': f'{settings.OSS_BUCKET_URL}/{obj.delta_url}',
+            'size': obj.delta_size,
+            'sha256': obj.delta_sha256,
+        }
+    return info
+
+
+async def build_delta(obj, base):
+    """
+    生成 base -> obj 的差分包并上传，依赖 bsdiff 命令
+    Returns:
+        差分包信息，未安装 bsdiff 或差分包不比完整固件小时返回 None
+    """
+    bsdiff = shutil.which('bsdiff')
+    if not bsdiff:
+        logger.info('未安装 bsdiff，跳过差分包生成')
+        return None
+    delta_key = f'firmware/delta/{obj.device_model}-{base.app_version}-{obj.app_version}.patch'
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        old_path = os.path.join(tmp_dir, 'old.bin')
+        new_path = os.path.join(tmp_dir, 'new.bin')
+        patch_path = os.path.join(tmp_dir, 'delta.patch')
+        if not await oss.download_file_async(base.ota_url, old_path):
+            raise Exception(f'下载基准固件失败: {base.ota_url}')
+        if not await oss.download_file_async(obj.ota_url, new_path):
+            raise Exception(f'下载固件失败: {obj.ota_url}')
+        process = await asyncio.create_subprocess_exec(
+            bsdiff, old_path, new_path, patch_path, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
+        )
+        _, stderr = await process.communicate()
+        if process.returncode != 0:
+            raise Exception(f'生成差分包失败: {stderr.decode(errors="ignore")}')
+        delta_size = os.path.getsize(patch_path)
+        if delta_size >= os.path.getsize(new_path):
+            logger.info(f'差分包不小于完整固件，跳过: {delta_key}')
+            return None
+        if not await oss.upload_file_async(delta_key, file_path=patch_path):
+            raise Exception(f'上传差分包失败: {delta_key}')
+        delta_sha256 = (await asyncio.to_thread(firmware_meta, patch_path))['sha256']
+    return {
+        'delta_from': base.app_version,
+        'delta_url': delta_key,
+        'delta_size': delta_size,
+        'delta_sha256': delta_sha256,
+    }
@@ -1,10 +1,10 @@
 import shutil
-import asyncio
 from aerich import Command
 from fastapi import FastAPI
 from fastapi.middleware import Middleware
 from fastapi.middleware.cors import CORSMiddleware
 from tortoise.expressions import Q
+from tortoise.functions import Count
 from api import api_router, ota_router, callback_router
 from models.admin import Api, Menu, Role, RoleMenu, RoleApi, SystemConfig
 from models.agent import AgentTemplate, Agent, LLM, Voice, McpTool
@@ -30,7 +30,7 @@ from .log import logger
 from .config import settings
 from .middlewares import BackGroundTaskMiddleware, HttpAuditLogMiddleware, OTACORSMiddleware
 from .xz_api import xz_service
-from .mcp_manager import mcp_manager
+from .mcp_supervisor import mcp_supervisor
 
 
 def make_middlewares():
@@ -98,9 +98,27 @@ async def init_db():
         shutil.rmtree('migrations')  # 删除旧的迁移文件
         await command.init_db(safe=True)  # 重新初始化
 
+    await dedupe_devices()  # mac_address 加唯一约束前清理重复的设备
     await command.upgrade(run_in_transaction=True)
 
 
+async def dedupe_devices():
+    """同一 mac_address 的重复设备只保留一条：优先保留已绑定用户的，其次最近更新的"""
+    macs = (
+        await Device.filter(mac_address__not_isnull=True)
+        .annotate(n=Count('id'))
+        .group_by('mac_address')
+        .filter(n__gt=1)
+        .values_list('mac_address', flat=True)
+    )
+    for mac in macs:
+        devices = await Device.filter(mac_address=mac).order_by('-update_at', '-id')
+        keep = next((device for device in devices if device.user_id), devices[0])
+        ids = [device.id for device in devices if device.id != keep.id]
+        await Device.filter(id__in=ids).delete()
+        logger.warning(f'设备 {mac} 存在 {len(devices)} 条记录，保留 {keep.id}，删除 {ids}')
+
+
 async def init_menus():
     # 每次重启删除所有菜单并重新创建
     await Menu.all().delete()
@@ -638,15 +656,13 @@ async def init_mcps():
                 )
             )
         await McpTool.bulk_create(objs)
-    # 产品MCP还要添加到manager中启动
+    # 需要保持连接的记录在 Redis 中跨重启保留，同步后移除已删除或已停用的
+    enabled_ids = await McpTool.filter(enabled=True).values_list('endpoint_id', flat=True)
+    await mcp_supervisor.prune_desired(enabled_ids)
+    # 产品MCP记为需要保持连接，由负责的 worker 启动后对账连接
     mcps = await McpTool.filter(source='product', enabled=True).all()
     for mcp in mcps:
-        data = await mcp.to_dict()
-        status, msg = await mcp_manager.connect(data)
-        if status:
-            logger.info(f'MCP {mcp.name} connected successfully')
-        else:
-            logger.error(f'MCP {mcp.name} connect failed: {msg}')
+        await mcp_supervisor.set_desired(await mcp.to_dict())
 
 
 async def init_system_config():
@@ -705,26 +721,6 @@ async def init_data(app: FastAPI):
     await init_agent()
     await init_llm()
     await init_voices()
-    await init_mcps()
     await init_system_config()
     await init_products()
 
-
-async def check_mcp_status_periodically(check_interval=60):
-    """定期检查 MCP 连接状态并更新数据库"""
-    logger.info('Starting MCP status check task')
-    while True:
-        await asyncio.sleep(check_interval)
-        try:
-            mcps = await McpTool.filter(source='product')
-            for mcp in mcps:
-                status_info = mcp_manager.get_connection_status(mcp.endpoint_id)
-                new_status = status_info['status']
-                # 只在状态变化时更新
-                if mcp.status != new_status:
-                    mcp.status = new_status
-                    await mcp.save()
-                    logger.info(f'MCP {mcp.name} status updated to {new_status}')
-            # logger.info('MCP status check completed')
-        except Exception as e:
-            logger.error(f'Error checking MCP status: {e}')
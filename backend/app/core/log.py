@@ -1,6 +1,124 @@
 import os
+import json
+import time
+import queue
+import random
+import atexit
 import logging
-from logging.handlers import TimedRotatingFileHandler
+import threading
+from logging.handlers import QueueHandler, QueueListener, TimedRotatingFileHandler
+from .config import settings
+
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s'
+# LogRecord 自带的属性，其余的视为 extra 传入的字段
+RESERVED_ATTRS = {*vars(logging.makeLogRecord({})), 'message', 'asctime'}
+
+_queue_handlers = []
+_start_lock = threading.Lock()
+
+
+class JsonFormatter(logging.Formatter):
+    """一行一条 JSON，extra 传入的字段原样输出"""
+
+    def format(self, record):
+        data = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'file': f'{record.filename}:{record.lineno}',
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in RESERVED_ATTRS and not key.startswith('_'):
+                data[key] = value
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class SampleFilter(logging.Filter):
+    """DEBUG/INFO 按比例采样并限制每秒条数，WARNING 及以上不受限；被限流的条数记在下一条放行的日志上"""
+
+    def __init__(self, sample_rate=1.0, rate_limit=0):
+        super().__init__()
+        self.sample_rate = sample_rate
+        self.rate_limit = rate_limit
+        self.window = 0
+        self.count = 0
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return False
+        if not self.rate_limit:
+            return True
+        now = int(time.monotonic())
+        with self.lock:
+            if now != self.window:
+                if self.suppressed:
+                    record.suppressed = self.suppressed
+                self.window, self.count, self.suppressed = now, 0, 0
+            self.count += 1
+            if self.count > self.rate_limit:
+                self.suppressed += 1
+                return False
+        return True
+
+
+class AsyncQueueHandler(QueueHandler):
+    """
+    日志记录放入队列后立即返回，由后台线程格式化并写入文件和控制台，写盘不再阻塞事件循环
+    - 不在调用方格式化：消息和参数留到后台线程渲染，被采样或限流丢弃的记录不会渲染
+    - fork 出的子进程（celery worker 等）没有父进程的后台线程，首次写日志时重新启动
+    """
+
+    def __init__(self, handlers):
+        super().__init__(queue.SimpleQueue())
+        self.targets = handlers
+        self.listener = None
+        self.pid = None
+
+    def prepare(self, record):
+        return record
+
+    def emit(self, record):
+        if self.pid != os.getpid():
+            self.start()
+        super().emit(record)
+
+    def start(self):
+        with _start_lock:
+            if self.pid == os.getpid():
+                return
+            # 子进程重建队列，父进程遗留的记录不重复写
+            self.queue = queue.SimpleQueue()
+            self.listener = QueueListener(self.queue, *self.targets, respect_handler_level=True)
+            self.listener.start()
+            self.pid = os.getpid()
+
+    def stop(self):
+        if self.listener and self.pid == os.getpid():
+            self.listener.stop()
+            self.listener = None
+            self.pid = None
+
+
+def _parse_sampling(spec):
+    """LOG_SAMPLING 格式：logger=采样比例:每秒条数，多个用逗号分隔，如 mcp=1:200"""
+    sampling = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        name, _, value = item.partition('=')
+        rate, _, limit = value.partition(':')
+        sampling[name.strip()] = (float(rate or 1), int(limit or 0))
+    return sampling
+
+
+def _stop_listeners():
+    for handler in _queue_handlers:
+        handler.stop()
 
 
 def get_logger(log_name='app.log'):
@@ -17,19 +135,27 @@ def get_logger(log_name='app.log'):
     os.makedirs(log_dir, exist_ok=True)
     log_file = os.path.join(log_dir, log_name)
 
-    # 配置日志格式
-    log_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s')
+    # 配置日志格式：文件可选 JSON，控制台保持文本
+    log_formatter = logging.Formatter(TEXT_FORMAT)
+    file_formatter = JsonFormatter() if settings.LOG_JSON else log_formatter
 
     # 创建 FileHandler
     # file_handler = RotatingFileHandler(log_file, maxBytes=5 * 1024 * 1024, backupCount=3)
     file_handler = TimedRotatingFileHandler(log_file, when='D', interval=1, backupCount=10, encoding='utf-8')
-    file_handler.setFormatter(log_formatter)
-    logger.addHandler(file_handler)
+    file_handler.setFormatter(file_formatter)
     # 添加控制台输出
     console_handler = logging.StreamHandler()
     console_handler.setFormatter(log_formatter)
-    logger.addHandler(console_handler)
+    # 文件和控制台都挂在后台线程上，logger 只挂队列
+    queue_handler = AsyncQueueHandler([file_handler, console_handler])
+    sample_rate, rate_limit = _parse_sampling(settings.LOG_SAMPLING).get(logger_name, (1.0, 0))
+    if sample_rate < 1 or rate_limit:
+        queue_handler.addFilter(SampleFilter(sample_rate, rate_limit))
+    logger.addHandler(queue_handler)
     logger.propagate = False  # 不传递到 root logger，避免重复输出
+    if not _queue_handlers:
+        atexit.register(_stop_listeners)  # 退出前写完队列中的日志
+    _queue_handlers.append(queue_handler)
     return logger
 
 
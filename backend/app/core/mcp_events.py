@@ -0,0 +1,98 @@
+"""
+MCP 接入点状态事件：连接建立、断线重连、重试耗尽、停止时由负责的 worker 直接发出，替代每分钟轮询写库
+- 事件先在本进程合并，同一接入点短时间内多次变化只保留最后一次，由单个写库任务批量写入
+- 同时发布到 Redis 频道，各 worker 收到后推送给本进程的订阅方（管理后台的 SSE 连接）
+"""
+
+import json
+import time
+import asyncio
+import contextlib
+from tortoise import timezone
+from models import McpTool
+from .log import mcp_logger as logger
+from .redis_client import redis
+
+EVENTS_CHANNEL = 'mcp:events'
+FLUSH_INTERVAL = 1  # 合并窗口（秒）
+RETRY_DELAY = 10  # 写库失败后的重试间隔（秒）
+SUBSCRIBER_QUEUE_SIZE = 100  # 单个订阅方积压上限，超过丢弃（前端可重新拉取列表）
+
+states = {}  # endpoint_id -> 本进程最近一次事件的状态
+_pending = {}  # endpoint_id -> 待写库和发布的事件
+_wakeup = asyncio.Event()
+_subscribers = set()
+
+
+def emit(endpoint_id, status, error=None):
+    """记录状态变化，不等待写库，调用方可在任意连接流程中直接调用"""
+    endpoint_id = str(endpoint_id)
+    event = {'endpoint_id': endpoint_id, 'status': status, 'ts': int(time.time())}
+    if error:
+        event['error'] = str(error)[:200]
+    states[endpoint_id] = status
+    _pending[endpoint_id] = event
+    _wakeup.set()
+
+
+async def run_writer():
+    """单个写库任务：合并窗口内的事件批量写库，并发布给各 worker"""
+    global _pending
+    while True:
+        await _wakeup.wait()
+        await asyncio.sleep(FLUSH_INTERVAL)
+        _wakeup.clear()
+        events, _pending = _pending, {}
+        try:
+            await _publish(events)
+        except Exception as e:
+            logger.error(f'MCP status events publish failed: {e}')
+        try:
+            await _flush(events)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f'MCP status write failed: {e}')
+            # 保留期间产生的更新事件，失败的放回等待下次写入
+            _pending = {**events, **_pending}
+            await asyncio.sleep(RETRY_DELAY)
+            _wakeup.set()
+
+
+async def _flush(events):
+    by_status = {}
+    for event in events.values():
+        by_status.setdefault(event['status'], []).append(event['endpoint_id'])
+    now = timezone.now()
+    for status, ids in by_status.items():
+        # 状态未变化的不写
+        updated = await McpTool.filter(endpoint_id__in=ids).exclude(status=status).update(status=status, update_at=now)
+        if updated:
+            logger.info(f'MCP {ids} status updated to {status}')
+
+
+async def _publish(events):
+    async with redis.pipeline(transaction=False) as pipe:
+        for event in events.values():
+            pipe.publish(EVENTS_CHANNEL, json.dumps(event))
+        await pipe.execute()
+
+
+def dispatch(event):
+    """把 Redis 频道收到的事件推送给本进程的订阅方"""
+    for queue in list(_subscribers):
+        try:
+            queue.put_nowait(event)
+        except asyncio.QueueFull:
+            pass
+
+
+@contextlib.contextmanager
+def subscribe():
+    """订阅状态事件，退出时自动取消"""
+    queue = asyncio.Queue(SUBSCRIBER_QUEUE_SIZE)
+    _subscribers.add(queue)
+    try:
+        yield queue
+    finally:
+        _subscribers.discard(queue)
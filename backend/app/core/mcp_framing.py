@@ -0,0 +1,228 @@
+"""
+MCP 消息分帧：JSON-RPC 请求与响应按 id 关联，统计每个工具的调用耗时，超时未响应的请求回错误
+- 不需要修改的消息按原始文本转发，不重新序列化
+- 每个 websocket 一个有序发送队列，替代每条消息创建一个发送任务
+- 发送队列按字节数设高低水位：超过高水位时暂停读取 MCP server 的输出（子进程写满管道后自然阻塞），降到低水位后恢复
+"""
+
+import time
+import asyncio
+import orjson
+from .config import settings
+from .log import mcp_logger as logger
+
+LATENCY_BUCKETS = (50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)  # 耗时分桶上界（毫秒）
+TRANSPORT_ERROR_CODE = -32000  # 转发失败、超时等由桥接层生成的错误
+
+
+def loads(raw):
+    return orjson.loads(raw)
+
+
+def dumps(message):
+    return orjson.dumps(message).decode('utf-8')
+
+
+def error_response(msg_id, message):
+    """请求失败时回给调用方的 JSON-RPC 错误，避免设备一直等待"""
+    return {'jsonrpc': '2.0', 'id': msg_id, 'error': {'code': TRANSPORT_ERROR_CODE, 'message': message}}
+
+
+class LatencyHistogram:
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.errors = 0
+        self.timeouts = 0
+
+    def observe(self, ms, error=False):
+        idx = next((i for i, bound in enumerate(LATENCY_BUCKETS) if ms <= bound), len(LATENCY_BUCKETS))
+        self.buckets[idx] += 1
+        self.count += 1
+        self.total += ms
+        if error:
+            self.errors += 1
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'sum_ms': round(self.total, 1),
+            'errors': self.errors,
+            'timeouts': self.timeouts,
+            'buckets': self.buckets[:],
+        }
+
+
+# (接入点ID, 工具名) -> 耗时分布，本进程内累计
+histograms = {}
+# 接入点ID -> 消息计数：oversized 超长丢弃、dropped 发送失败、队列满载超时或调用超时后迟到而丢弃、paused 因队列满载暂停读取
+frame_counters = {}
+
+
+def count_frame(mcp_id, field, n=1):
+    counters = frame_counters.setdefault(mcp_id, {'oversized': 0, 'dropped': 0, 'paused': 0})
+    counters[field] += n
+
+
+def _histogram(mcp_id, tool):
+    key = (mcp_id, tool)
+    if key not in histograms:
+        histograms[key] = LatencyHistogram()
+    return histograms[key]
+
+
+def snapshot():
+    """本进程的统计：tools 为接入点ID -> 工具名 -> 耗时统计，frames 为接入点ID -> 消息计数"""
+    tools = {}
+    for (mcp_id, tool), histogram in histograms.items():
+        tools.setdefault(mcp_id, {})[tool] = histogram.snapshot()
+    return {'tools': tools, 'frames': {mcp_id: dict(counters) for mcp_id, counters in frame_counters.items()}}
+
+
+def merge(snapshots):
+    """合并多个进程的统计，并按分桶估算 p50/p95"""
+    data, frames = {}, {}
+    for snap in snapshots:
+        for mcp_id, counters in snap.get('frames', {}).items():
+            item = frames.setdefault(mcp_id, {})
+            for field, n in counters.items():
+                item[field] = item.get(field, 0) + n
+        for mcp_id, tools in snap.get('tools', {}).items():
+            for tool, stat in tools.items():
+                item = data.setdefault(mcp_id, {}).setdefault(
+                    tool, {'count': 0, 'sum_ms': 0, 'errors': 0, 'timeouts': 0, 'buckets': [0] * len(stat['buckets'])}
+                )
+                for field in ('count', 'sum_ms', 'errors', 'timeouts'):
+                    item[field] += stat[field]
+                item['buckets'] = [a + b for a, b in zip(item['buckets'], stat['buckets'])]
+    bounds = [*LATENCY_BUCKETS, None]
+    for tools in data.values():
+        for item in tools.values():
+            item['avg_ms'] = round(item['sum_ms'] / item['count'], 1) if item['count'] else 0
+            for name, q in (('p50_ms', 0.5), ('p95_ms', 0.95)):
+                seen, item[name] = 0, None
+                for bound, n in zip(bounds, item['buckets']):
+                    seen += n
+                    if item['count'] and seen >= item['count'] * q:
+                        item[name] = bound
+                        break
+            item['buckets'] = dict(zip([f'le_{bound}' if bound else 'inf' for bound in bounds], item['buckets']))
+    return {'tools': data, 'frames': frames}
+
+
+class McpChannel:
+    """
+    一个接入点与小智 websocket 之间的通道
+    - outbound：设备 -> MCP server 的请求，记录在途
+    - inbound：MCP server -> 设备的响应，按 id 取出在途请求并统计耗时，然后放入有序发送队列
+    """
+
+    def __init__(self, mcp_id, websocket):
+        self.mcp_id = mcp_id
+        self.websocket = websocket
+        self.inflight = {}  # JSON-RPC id -> (工具名, 开始时间)
+        self.timed_out = {}  # 已回超时错误的 JSON-RPC id -> 保留截止时间，之后到达的响应丢弃
+        self.queue = asyncio.Queue()
+        self.queued_bytes = 0
+        self.writable = asyncio.Event()  # 未超过高水位时置位
+        self.writable.set()
+        self.closed = False
+        self.sender = asyncio.create_task(self._send_loop())
+        self.sweeper = asyncio.create_task(self._sweep_loop())
+
+    def close(self):
+        self.closed = True
+        self.sender.cancel()
+        self.sweeper.cancel()
+        # 唤醒等待队列可写的读取方，关闭后的消息直接丢弃
+        self.writable.set()
+
+    def outbound(self, message):
+        msg_id = message.get('id')
+        method = message.get('method')
+        if msg_id is None or not method:
+            return
+        tool = method
+        if method == 'tools/call':
+            tool = (message.get('params') or {}).get('name') or method
+        # 设备复用了已超时的 id，新请求的响应正常转发
+        self.timed_out.pop(msg_id, None)
+        self.inflight[msg_id] = (tool, time.monotonic())
+
+    async def inbound(self, message, raw=None):
+        msg_id = message.get('id')
+        if msg_id is not None and 'method' not in message:
+            # 超时后才到达的响应：设备已收到超时错误，不再转发第二个响应
+            if self.timed_out.pop(msg_id, None) is not None:
+                count_frame(self.mcp_id, 'dropped')
+                logger.debug('[Process-%s] drop late response id=%s', self.mcp_id, msg_id)
+                return
+            call = self.inflight.pop(msg_id, None)
+            if call:
+                tool, started = call
+                ms = (time.monotonic() - started) * 1000
+                _histogram(self.mcp_id, tool).observe(ms, error='error' in message)
+                logger.debug('[Process-%s] %s id=%s %.0fms', self.mcp_id, tool, msg_id, ms)
+        text = raw if raw is not None else dumps(message)
+        # 队列超过高水位时在这里等待，调用方（子进程输出读取、SSE 读取）随之暂停
+        if not self.writable.is_set():
+            count_frame(self.mcp_id, 'paused')
+            try:
+                await asyncio.wait_for(self.writable.wait(), timeout=int(settings.MCP_SEND_STALL_TIMEOUT))
+            except asyncio.TimeoutError:
+                count_frame(self.mcp_id, 'dropped')
+                logger.warning(f'[Process-{self.mcp_id}] send queue stalled, drop message id={msg_id}')
+                # 丢弃的是响应时回一个简短的错误，设备不用等到超时
+                if msg_id is not None and 'method' not in message:
+                    self._enqueue(dumps(error_response(msg_id, 'MCP response dropped: send queue stalled')))
+                return
+        self._enqueue(text)
+
+    def _enqueue(self, text):
+        if self.closed:
+            count_frame(self.mcp_id, 'dropped')
+            return
+        size = len(text)
+        self.queued_bytes += size
+        self.queue.put_nowait((text, size))
+        if self.queued_bytes >= int(settings.MCP_SEND_HIGH_WATER):
+            self.writable.clear()
+
+    async def _send_loop(self):
+        low_water = int(settings.MCP_SEND_LOW_WATER)
+        while True:
+            text, size = await self.queue.get()
+            try:
+                await self.websocket.send(text)
+                # 参数形式，未开启 DEBUG 时不渲染消息
+                logger.debug('[Process-%s] sent: %s', self.mcp_id, text)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                count_frame(self.mcp_id, 'dropped')
+                logger.warning(f'[Process-{self.mcp_id}] Failed sent: {e}')
+            finally:
+                self.queued_bytes -= size
+                if self.queued_bytes <= low_water:
+                    self.writable.set()
+
+    async def _sweep_loop(self):
+        """在途超过 MCP_CALL_TIMEOUT 的请求记为超时，并回错误给设备；之后到达的响应在 inbound 中丢弃"""
+        timeout = int(settings.MCP_CALL_TIMEOUT)
+        while True:
+            await asyncio.sleep(min(timeout, 5))
+            now = time.monotonic()
+            deadline = now - timeout
+            # 超时的 id 保留一个超时周期，足够覆盖迟到的响应
+            for msg_id, expires in list(self.timed_out.items()):
+                if expires <= now:
+                    self.timed_out.pop(msg_id, None)
+            for msg_id, (tool, started) in list(self.inflight.items()):
+                if started > deadline:
+                    continue
+                self.inflight.pop(msg_id, None)
+                self.timed_out[msg_id] = now + timeout
+                _histogram(self.mcp_id, tool).timeouts += 1
+                logger.warning(f'[Process-{self.mcp_id}] {tool} id={msg_id} timed out after {timeout}s')
+                self._enqueue(dumps(error_response(msg_id, f'MCP call timed out after {timeout}s')))
@@ -1,11 +1,15 @@
-import os
 import sys
-import re
 import json
+import time
 import asyncio
-import aiohttp
+import functools
 import websockets
+from .config import settings
 from .log import mcp_logger as logger
+from .mcp_transport import create_transport
+from .mcp_framing import McpChannel, loads
+from .mcp_events import emit as emit_status, states as status_events
+from .presence import heartbeat_serial
 
 
 def build_server_command(protocol, cfg):
@@ -53,38 +57,42 @@ async def connect_with_retry(uri, mcp):
             reconnect_attempt += 1
             logger.warning(f'[{mcp_id}] WebSocket connection closed (attempt {reconnect_attempt}): {e}')
             backoff = min(backoff * 2, 120)
+            emit_status(mcp_id, 'reconnecting', e)
         except Exception as e:
             reconnect_attempt += 1
             logger.error(f'[{mcp_id}] Process error (attempt {reconnect_attempt}): {e}')
             backoff = min(backoff * 2, 120)
+            emit_status(mcp_id, 'reconnecting', e)
     # 重试耗尽，抛出异常让 task 标记为失败
+    emit_status(mcp_id, 'failed', f'Failed to connect after {max_retries} attempts')
     raise Exception(f'[{mcp_id}] Failed to connect after {max_retries} attempts')
 
 
 async def connect_to_server(uri, mcp):
     """Connect to WebSocket server and pipe stdio for the given server target."""
     mcp_id = mcp['endpoint_id']
+    websocket = None
     try:
         async with websockets.connect(uri) as websocket:
             logger.info(f'{mcp_id} successfully connected to WebSocket server {uri}')
-            # Acquire shared process for this mcp (one process per mcp_id)
-            process = await process_manager.acquire(mcp)
-            logger.info(f'{mcp_id} acquired MCP process')
-            # 检查子进程是否存活（404、认证失败等会导致子进程立即退出）
-            try:
-                await asyncio.wait_for(process.wait(), timeout=3.0)
-                raise RuntimeError(f'MCP process exited with code {process.returncode} shortly after startup')
-            except asyncio.TimeoutError:
-                pass  # 进程 3s 内没死，存活
+            # Acquire shared transport for this mcp (one transport per mcp_id)
+            transport = await process_manager.acquire(mcp)
+            logger.info(f'{mcp_id} acquired MCP transport')
+            # JSON-RPC 握手探活（启动失败、404、认证失败等都会在这里报错），不再固定等待 3s
+            ok, msg = await transport.probe()
+            if not ok:
+                await process_manager.terminate(mcp_id)
+                raise RuntimeError(msg)
             # Register this websocket with the shared process manager so stdout reader can route messages
             await process_manager.register_ws(mcp_id, websocket)
             logger.info(f'{mcp_id} registered websocket')
+            emit_status(mcp_id, 'running')
             # 通知 connect() 连接已真正建立
             event = mcp.get('_connected_event')
             if event:
                 event.set()
             # Only create the websocket->process writer task here. The process->websocket routing is handled by the shared stdout reader in ProcessManager.
-            await pipe_websocket_to_process(websocket, process, mcp_id)
+            await pipe_websocket_to_process(websocket, transport, mcp_id)
             # When pipe_websocket_to_process returns, connection closed or task ended.
             logger.info(f'{mcp_id} websocket->process pipe ended')
     except websockets.exceptions.ConnectionClosed as e:
@@ -95,27 +103,28 @@ async def connect_to_server(uri, mcp):
         raise e  # Re-throw exception
     finally:
         # Always unregister websocket so shared stdout reader won't try to send to a closed socket
+        # 传输保留在池中，重连时直接复用；停止服务时由 disconnect 关闭
         try:
-            await process_manager.terminate(mcp_id)
-            logger.info(f'{mcp_id} terminate websocket')
+            await process_manager.release(mcp_id, websocket)
+            logger.info(f'{mcp_id} release websocket')
         except Exception as e:
-            logger.exception(f'{mcp_id} Error during terminate websocket: {e}')
+            logger.exception(f'{mcp_id} Error during release websocket: {e}')
 
 
-async def pipe_websocket_to_process(websocket, process, mcp_id):
-    """Read data from WebSocket and write to shared process stdin"""
+async def pipe_websocket_to_process(websocket, transport, mcp_id):
+    """Read data from WebSocket and send to the shared MCP transport"""
     try:
         while True:
             # Read message from WebSocket
             message = await websocket.recv()
-            logger.info(f'[ws-{mcp_id}] 收到websocket信息：{type(message)} {message}')
+            logger.debug('[ws-%s] 收到websocket信息：%s', mcp_id, message)
             # parse text message to dict
             try:
-                text = message.encode('utf-8')
-                msg_dict = json.loads(text)
+                msg_dict = loads(message)
             except Exception as e:
                 logger.error(f'[ws-{mcp_id}] Received non-JSON or parse error: {e} - ignoring')
                 continue
+            raw = message if isinstance(message, str) else message.decode('utf-8')
             # Prefix id with device_id to allow shared process to echo id back for routing
             # if 'id' in msg_dict:
             #     orig_id = msg_dict['id']
@@ -126,13 +135,18 @@ async def pipe_websocket_to_process(websocket, process, mcp_id):
                 serial = msg_dict.get('params', {}).get('serialNumber', '')
                 if serial:
                     msg_dict['params'].setdefault('arguments', {})['serial_number'] = serial
-            # write into shared process stdin (one writer per websocket task, but it's OK to write to same pipe)
+                    raw = None  # 消息已修改，需要重新序列化
+                    # 设备发起的 MCP 调用同时记为一次心跳
+                    await heartbeat_serial(serial)
+            # 记录在途请求，用于关联响应和统计耗时
+            channel = process_manager.ws_map.get(mcp_id)
+            if channel:
+                channel.outbound(msg_dict)
+            # send to shared transport (stdin of the stdio process, or HTTP request for sse/http)
             try:
-                line = (json.dumps(msg_dict, ensure_ascii=False) + '\n').encode('utf-8')
-                process.stdin.write(line)
-                await process.stdin.drain()
+                await transport.send(msg_dict, raw)
             except Exception as e:
-                logger.error(f'[ws-{mcp_id}] Error writing to process stdin: {e}')
+                logger.error(f'[ws-{mcp_id}] Error sending to MCP transport: {e}')
                 raise
     except asyncio.CancelledError:
         logger.error(f'[ws-{mcp_id}] pipe_websocket_to_process cancelled')
@@ -144,142 +158,159 @@ async def pipe_websocket_to_process(websocket, process, mcp_id):
         raise
 
 
+def _signature(mcp):
+    """接入点的启动配置，配置不变时可以复用池中的传输"""
+    protocol = getattr(mcp['protocol'], 'value', mcp['protocol'])
+    return protocol, json.dumps(mcp.get('config') or {}, sort_keys=True)
+
+
 class ProcessManager:
+    """
+    MCP 传输池：每个接入点一个传输（stdio 子进程 / 进程内 sse、http）
+    websocket 断开重连、配置不变的重启都复用池中的传输；测试时启动的传输暂存为备用，创建接入点后直接接管
+    """
+
     def __init__(self):
-        self.processes = {}  # mcp_id -> subprocess.Process
-        self.ws_map = {}  # mcp_id -> websocket
-        self.stdout_tasks = {}  # mcp_id -> asyncio.Task reading stdout
-        self.stderr_tasks = {}  # mcp_id -> asyncio.Task reading stderr
+        self.processes = {}  # mcp_id -> MCP transport (stdio subprocess / in-process sse/http)
+        self.signatures = {}  # mcp_id -> 启动配置
+        self.spares = {}  # 启动配置 -> (测试通过的传输, 暂存时间)
+        self.ws_map = {}  # mcp_id -> McpChannel (websocket + 在途请求 + 有序发送队列)
         self.lock = asyncio.Lock()
 
     async def acquire(self, mcp):
-        """Get or start process for this mcp."""
+        """Get or start transport for this mcp."""
         mcp_id = mcp['endpoint_id']
+        sig = _signature(mcp)
+        stale = None
         async with self.lock:
-            if mcp_id in self.processes:
-                logger.info(f'[Process-{mcp_id}] Reusing MCP process')
-                return self.processes[mcp_id]
-            protocol = mcp['protocol']
-            cfg = mcp.get('config', {})
-            cmd = build_server_command(protocol, cfg)
-            env = cfg.get('env', {})
-            merged_env = os.environ.copy()
-            merged_env.update(env)
-            process = await asyncio.create_subprocess_exec(
-                *cmd,
-                stdin=asyncio.subprocess.PIPE,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE,
-                env=merged_env,
-            )
-            self.processes[mcp_id] = process
-            # start stdout reader and stderr logger tasks
-            t_out = asyncio.create_task(self._stdout_reader(process, mcp_id))
-            t_err = asyncio.create_task(self._stderr_reader(process, mcp_id))
-            self.stdout_tasks[mcp_id] = t_out
-            self.stderr_tasks[mcp_id] = t_err
-            logger.info(f'[Process-{mcp_id}] Started MCP process: {cmd}')
-            return process
-
-    async def register_ws(self, mcp_id, websocket):
-        """Register a websocket for a given mcp_id and device_id."""
+            transport = self.processes.get(mcp_id)
+            if transport and self.signatures.get(mcp_id) == sig and not transport.closed.is_set():
+                logger.info(f'[Process-{mcp_id}] Reusing MCP transport')
+                return transport
+            if transport:
+                # 配置变化或已退出，重新启动
+                stale = self.processes.pop(mcp_id)
+                self.signatures.pop(mcp_id, None)
+            spare = self._take_spare(sig)
+        if stale:
+            await stale.close()
+        await self._expire_spares()
+        if spare:
+            spare.mcp_id = mcp_id
+            spare.on_message = functools.partial(self._route, mcp_id)
+            transport = spare
+            logger.info(f'[Process-{mcp_id}] Adopted tested MCP transport')
+        else:
+            cmd = build_server_command(mcp['protocol'], mcp.get('config', {}))
+            transport = create_transport(mcp, functools.partial(self._route, mcp_id), cmd)
+            # 启动（建立 SSE 连接等）放在锁外，避免一个接入点启动慢拖住其他接入点
+            await transport.start()
         async with self.lock:
-            # ensure process exists (caller should have called acquire already)
-            self.ws_map[mcp_id] = websocket
-            logger.info(f'{mcp_id} register_ws: mcp')
+            existing = self.processes.get(mcp_id)
+            if not existing:
+                self.processes[mcp_id] = transport
+                self.signatures[mcp_id] = sig
+                return transport
+        await transport.close()
+        return existing
 
-    async def terminate(self, mcp_id):
-        """Terminate the shared process for given mcp_id"""
+    async def probe_config(self, mcp):
+        """
+        测试接入点配置：池中已有相同配置的传输直接探活，否则临时启动一个，测试通过后暂存备用
+        Returns:
+            (是否可用, 说明)
+        """
+        mcp_id = mcp.get('endpoint_id')
+        sig = _signature(mcp)
         async with self.lock:
-            self.ws_map.pop(mcp_id, None)
-            proc = self.processes.pop(mcp_id, None)
-            # cancel stdout/stderr tasks
-            t_out = self.stdout_tasks.pop(mcp_id, None)
-            t_err = self.stderr_tasks.pop(mcp_id, None)
-        if t_out:
-            t_out.cancel()
-        if t_err:
-            t_err.cancel()
-        if not proc:
-            return
+            transport = self.processes.get(mcp_id) if mcp_id else None
+            if transport and (self.signatures.get(mcp_id) != sig or transport.closed.is_set()):
+                transport = None
+            if not transport:
+                transport = self._take_spare(sig)
+        if transport:
+            ok, msg = await transport.probe()
+            if ok and not mcp_id:
+                await self._park_spare(sig, transport)
+            return ok, msg
+        cmd = build_server_command(mcp['protocol'], mcp.get('config', {}))
+        transport = create_transport({**mcp, 'endpoint_id': mcp.get('name') or 'test'}, self._discard, cmd)
         try:
-            proc.terminate()
-            await asyncio.wait_for(proc.wait(), timeout=5)
-        except asyncio.TimeoutError:
-            proc.kill()
-            await proc.wait()
+            await transport.start()
+            ok, msg = await transport.probe()
         except Exception as e:
-            logger.error(f'[Process:{mcp_id}] Error terminating process: {e}')
-        logger.info(f'[Process:{mcp_id}] MCP process terminated')
+            ok, msg = False, f'MCP start failed: {e}'
+        if ok:
+            await self._park_spare(sig, transport)
+        else:
+            await transport.close()
+        return ok, msg
 
-    async def _stdout_reader(self, process, mcp_id):
-        """Single stdout reader per shared process; route messages to registered websockets.
+    def _take_spare(self, sig):
+        """调用方持有 self.lock"""
+        item = self.spares.pop(sig, None)
+        if item and not item[0].closed.is_set():
+            return item[0]
+        return None
 
-        Expected: process writes JSON lines. The JSON must have an 'id' like "<device_id>-<orig_id>".
-        """
-        name = f'stdout-{mcp_id}'
-        try:
-            while True:
-                raw = await process.stdout.readline()
-                if not raw:
-                    logger.info(f'[{name}] stdout closed')
-                    break
-                try:
-                    text = raw.decode('utf-8').strip()
-                except Exception:
-                    logger.error(f'[{name}] stdout decode error')
-                    continue
-                try:
-                    data_dict = json.loads(text)
-                except Exception:
-                    logger.error(f'[{name}] stdout non-json line: {text!r}')
-                    continue
-                ws = self.ws_map.get(mcp_id)
-                if ws:
-                    asyncio.create_task(self._safe_send(ws, data_dict, mcp_id))
-                else:
-                    logger.warning(f'[{name}] no websocket registered (message {data_dict})')
+    async def _park_spare(self, sig, transport):
+        async with self.lock:
+            old = self.spares.pop(sig, None)
+            self.spares[sig] = (transport, time.time())
+        if old and old[0] is not transport:
+            await old[0].close()
+        await self._expire_spares()
 
-        except asyncio.CancelledError:
-            logger.info(f'[{name}] stdout reader cancelled')
-            raise
-        except Exception:
-            logger.exception(f'[{name}] Error in stdout reader')
-            raise
-        finally:
-            logger.info(f'[{name}] stdout reader exiting')
+    async def _expire_spares(self):
+        deadline = time.time() - int(settings.MCP_SPARE_TTL)
+        async with self.lock:
+            expired = [sig for sig, (_, parked_at) in self.spares.items() if parked_at < deadline]
+            transports = [self.spares.pop(sig)[0] for sig in expired]
+        for transport in transports:
+            await transport.close()
 
-    async def _stderr_reader(self, process, mcp_id):
-        name = f'stderr-{mcp_id}'
-        try:
-            while True:
-                raw = await process.stderr.readline()
-                if not raw:
-                    logger.info(f'[{name}] stderr closed')
-                    break
-                logger.info(f'[{name}]: {raw.decode("utf-8").strip()}')
-        except asyncio.CancelledError:
-            logger.error(f'[{name}] stderr reader cancelled')
-            raise
-        except Exception:
-            logger.exception(f'[{name}] Error in stderr reader')
-            raise
-        finally:
-            logger.info(f'[{name}] stderr reader exiting')
+    async def _discard(self, data_dict, raw=None):
+        """备用传输还没有接入点时收到的消息直接丢弃"""
+        logger.debug(f'discard message from spare MCP transport: {data_dict.get("id")}')
 
-    def _decode_unicode_escapes(self, raw_text):
-        """Decode literal \\uXXXX escape sequences in string to actual Unicode chars (for log readability only)."""
-        return re.sub(r'\\u([0-9a-fA-F]{4})', lambda m: chr(int(m.group(1), 16)), raw_text)
+    async def register_ws(self, mcp_id, websocket):
+        """Register a websocket for a given mcp_id and device_id."""
+        async with self.lock:
+            # ensure transport exists (caller should have called acquire already)
+            old = self.ws_map.pop(mcp_id, None)
+            if old:
+                old.close()
+            self.ws_map[mcp_id] = McpChannel(mcp_id, websocket)
+            logger.info(f'{mcp_id} register_ws: mcp')
 
-    async def _safe_send(self, websocket, data_dict, mcp_id):
-        """Send data to websocket and catch exceptions to avoid crashing the reader."""
-        try:
-            text = json.dumps(data_dict, ensure_ascii=False)
-            await websocket.send(text)
-            # Decode inner \uXXXX escapes for human-readable logging
-            logger.info(f'[Process-{mcp_id}] sent: {self._decode_unicode_escapes(text)}')
-        except Exception as e:
-            logger.warning(f'[Process-{mcp_id}] Failed sent: {e}')
+    async def release(self, mcp_id, websocket=None):
+        """Unregister the websocket but keep the transport warm in the pool"""
+        async with self.lock:
+            channel = self.ws_map.get(mcp_id)
+            # 新连接已经注册了自己的 websocket 时不要误删
+            if not channel or (websocket is not None and channel.websocket is not websocket):
+                return
+            self.ws_map.pop(mcp_id, None)
+        channel.close()
+
+    async def terminate(self, mcp_id):
+        """Close the shared transport for given mcp_id"""
+        async with self.lock:
+            channel = self.ws_map.pop(mcp_id, None)
+            transport = self.processes.pop(mcp_id, None)
+            self.signatures.pop(mcp_id, None)
+        if channel:
+            channel.close()
+        if transport:
+            await transport.close()
+
+    async def _route(self, mcp_id, data_dict, raw=None):
+        """Route a message from the MCP server to the registered websocket, in order."""
+        channel = self.ws_map.get(mcp_id)
+        if channel:
+            await channel.inbound(data_dict, raw)
+        else:
+            logger.warning(f'[Process-{mcp_id}] no websocket registered (message id {data_dict.get("id")})')
 
 
 process_manager = ProcessManager()
@@ -291,74 +322,19 @@ class MCPManager:
         self._lock = asyncio.Lock()
 
     async def test(self, obj_in):
-        name = obj_in.name
-        config = obj_in.config
-        protocol = obj_in.protocol
-        if protocol == 'stdio':
-            cmd = build_server_command(protocol, config)
-            env_vars = config.get('env', {})
-            merged_env = os.environ.copy()
-            merged_env.update(env_vars)
-            try:
-                proc = await asyncio.create_subprocess_exec(
-                    *cmd,
-                    stdin=asyncio.subprocess.PIPE,
-                    stdout=asyncio.subprocess.PIPE,
-                    stderr=asyncio.subprocess.PIPE,
-                    env=merged_env,
-                )
-                try:
-                    init_req = (
-                        json.dumps(
-                            {
-                                'jsonrpc': '2.0',
-                                'id': 1,
-                                'method': 'initialize',
-                                'params': {
-                                    'protocolVersion': '2024-11-05',
-                                    'capabilities': {},
-                                    'clientInfo': {'name': 'test', 'version': '1.0'},
-                                },
-                            }
-                        )
-                        + '\n'
-                    )
-                    proc.stdin.write(init_req.encode())
-                    await proc.stdin.drain()
-                    line = await asyncio.wait_for(proc.stdout.readline(), timeout=10)
-                    if not line:
-                        return False, 'MCP 进程无响应'
-                    resp = json.loads(line.decode())
-                    if resp.get('result'):
-                        logger.info(f'[{name}] MCP stdio 测试通过')
-                        return True, ''
-                    return False, f'MCP initialize 失败: {resp.get("error", "未知")}'
-                finally:
-                    proc.terminate()
-                    try:
-                        await asyncio.wait_for(proc.wait(), timeout=5)
-                    except asyncio.TimeoutError:
-                        proc.kill()
-                        await proc.wait()
-            except asyncio.TimeoutError:
-                return False, 'MCP 进程响应超时 (10s)'
-            except Exception as e:
-                logger.error(f'[{name}] MCP stdio 测试异常: {e}')
-                return False, f'MCP 进程测试失败: {e}'
+        """用 JSON-RPC 握手测试接入点配置，已在池中的接入点直接复用"""
+        mcp = {
+            'endpoint_id': obj_in.endpoint_id,
+            'name': obj_in.name,
+            'protocol': obj_in.protocol,
+            'config': obj_in.config or {},
+        }
+        ok, msg = await process_manager.probe_config(mcp)
+        if ok:
+            logger.info(f'[{obj_in.name}] MCP {obj_in.protocol} 测试通过')
         else:
-            url = config.get('url', '')
-            headers = config.get('headers', {})
-            try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(url, headers=headers) as response:
-                        logger.info(f'[{name}] MCP test response: {response.status}')
-                        if 200 <= response.status < 400:
-                            return True, ''
-                        else:
-                            return False, f'HTTP {response.status}: {await response.text()}'
-            except Exception as e:
-                logger.error(f'[{name}] Error connecting to MCP: {e}')
-                return False, f'Error connecting to MCP: {e}'
+            logger.error(f'[{obj_in.name}] MCP 测试失败: {msg}')
+        return ok, msg
 
     async def connect(self, mcp):
         # 为每个MCP创建一个连接
@@ -377,11 +353,7 @@ class MCPManager:
                     pass
             self.connections.pop(id, None)
             logger.info(f'[{id}] existing task cancelled')
-        # 确保旧的 process 被清理（防止 task 在重试等待时被取消，process 未清理）
-        try:
-            await process_manager.terminate(id)
-        except Exception as e:
-            logger.info(f'{id} cleanup process (may not exist): {e}')
+        # 旧的传输不再关闭：配置不变时 acquire 直接复用，配置变化时 acquire 会重新启动
 
         uri = f'wss://api.xiaozhi.me/mcp/?token={token}'
         connected_event = asyncio.Event()
@@ -423,6 +395,7 @@ class MCPManager:
                 await process_manager.terminate(mcp_id)
             except Exception as e:
                 logger.exception(f'{mcp_id} terminate error: {e}')
+        emit_status(mcp_id, 'uncreated')
         return True, 'Disconnected'
 
     def is_connected(self, mcp_id: str) -> bool:
@@ -442,6 +415,9 @@ class MCPManager:
             if exc:
                 return {'connected': False, 'status': 'failed', 'error': str(exc)}
             return {'connected': False, 'status': 'completed'}
+        # 运行中的 task 可能正在断线重连，以最近一次事件为准
+        if status_events.get(str(mcp_id)) == 'reconnecting':
+            return {'connected': False, 'status': 'reconnecting'}
         return {'connected': True, 'status': 'running'}
 
 
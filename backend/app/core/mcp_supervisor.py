@@ -0,0 +1,359 @@
+"""
+MCP 连接调度：多个 worker 进程时每个接入点只由一个 worker 负责连接
+- 各 worker 定期把心跳写入 Redis，存活的 worker 按最高随机权重哈希（rendezvous hashing）分配接入点，worker 增减时只迁移受影响的接入点
+- 需要保持连接的接入点记录在 Redis 中，负责的 worker 定期对账：该连的连上，不归自己或已停止的断开
+- 启动、停止、查询状态通过 pub/sub 转给负责的 worker 执行，执行结果发回请求方 worker 的回复频道
+- 接入点状态由负责的 worker 写入 Redis，任意 worker 都能直接读取；状态变化事件也经同一个订阅连接推送给本进程的订阅方
+- 服务启动后在后台恢复连接：并发数受 MCP_RESTORE_CONCURRENCY 限制，启动时间随机错开，不阻塞服务就绪
+"""
+
+import os
+import json
+import time
+import uuid
+import random
+import socket
+import asyncio
+import hashlib
+import contextlib
+from .config import settings
+from .log import mcp_logger as logger
+from .mcp_manager import mcp_manager
+from .mcp_framing import snapshot, merge
+from .mcp_events import EVENTS_CHANNEL, dispatch as dispatch_status
+from .redis_client import redis
+
+WORKERS_KEY = 'mcp:workers'  # worker -> 最后心跳时间
+DESIRED_KEY = 'mcp:desired'  # 需要保持连接的接入点：endpoint_id -> 接入点配置
+STATUS_KEY = 'mcp:status'  # 接入点状态：endpoint_id -> 状态
+METRICS_KEY = 'mcp:metrics'  # 各 worker 的工具调用耗时统计：worker -> 统计
+CONTROL_CHANNEL = 'mcp:control'
+REPLY_CHANNEL = 'mcp:reply:{}'
+REQUEST_TIMEOUT = 30  # 转发命令等待回复的超时（秒），需大于连接超时
+RETRY_DELAY = 60  # 对账时连接超时的接入点，间隔多久再重试（秒）
+RESUBSCRIBE_MAX_DELAY = 30  # 订阅断开后重新订阅的最大退避间隔（秒）
+
+
+def _weight(worker_id, endpoint_id):
+    return hashlib.sha256(f'{worker_id}:{endpoint_id}'.encode()).digest()
+
+
+def pick_owner(workers, endpoint_id):
+    """从存活的 worker 中选出负责该接入点的 worker"""
+    return max(workers, key=lambda worker_id: _weight(worker_id, endpoint_id)) if workers else None
+
+
+class MCPSupervisor:
+    def __init__(self):
+        self.worker_id = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}'
+        self.workers = [self.worker_id]  # 最近一次心跳时看到的存活 worker
+        self.pending = {}  # request_id -> Future，等待其他 worker 的回复
+        self.retry_at = {}  # endpoint_id -> 下次允许对账重连的时间
+        self.restoring = {}  # endpoint_id -> 后台恢复连接的 task
+        self.synced = False  # 服务启动时的接入点同步是否完成
+        self.tasks = []
+        self.locks = {}  # endpoint_id -> Lock，同一接入点的对账与命令执行互斥，避免同时连接和断开
+        self.semaphore = asyncio.Semaphore(int(settings.MCP_RESTORE_CONCURRENCY))
+
+    def owner(self, endpoint_id):
+        return pick_owner(self.workers, str(endpoint_id))
+
+    def owns(self, endpoint_id):
+        return self.owner(endpoint_id) == self.worker_id
+
+    def _lock(self, endpoint_id):
+        return self.locks.setdefault(endpoint_id, asyncio.Lock())
+
+    async def start(self):
+        """worker 启动：注册心跳、订阅控制频道，并立即对账一次"""
+        await self._heartbeat()
+        pubsub = await self._subscribe()
+        self.tasks = [asyncio.create_task(self._listen(pubsub)), asyncio.create_task(self._run())]
+        logger.info(f'MCP supervisor started: {self.worker_id}')
+
+    def restore(self, sync):
+        """
+        后台同步接入点并恢复连接，服务不等待
+        Args:
+            sync: async func()，同步接入点并记为需要保持连接
+        """
+
+        async def run():
+            try:
+                await sync()
+            except Exception as e:
+                logger.error(f'MCP sync failed: {e}')
+            self.synced = True
+            await self.reconcile()
+
+        self.tasks.append(asyncio.create_task(run()))
+
+    async def stop(self):
+        """worker 退出：注销心跳并断开本 worker 的连接，其他 worker 下一次对账时接管"""
+        tasks = [*self.tasks, *self.restoring.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        try:
+            await redis.zrem(WORKERS_KEY, self.worker_id)
+            await redis.hdel(METRICS_KEY, self.worker_id)
+        except Exception as e:
+            logger.error(f'MCP supervisor unregister failed: {e}')
+        for endpoint_id in list(mcp_manager.connections):
+            await mcp_manager.disconnect({'endpoint_id': endpoint_id})
+        logger.info(f'MCP supervisor stopped: {self.worker_id}')
+
+    async def _heartbeat(self):
+        now = time.time()
+        ttl = int(settings.MCP_SUPERVISOR_INTERVAL) * 3
+        async with redis.pipeline(transaction=True) as pipe:
+            pipe.zadd(WORKERS_KEY, {self.worker_id: now})
+            pipe.zremrangebyscore(WORKERS_KEY, '-inf', now - ttl)
+            pipe.zrange(WORKERS_KEY, 0, -1)
+            *_, workers = await pipe.execute()
+        if sorted(workers) != sorted(self.workers):
+            logger.info(f'MCP workers changed: {workers}')
+        self.workers = workers or [self.worker_id]
+
+    async def _run(self):
+        interval = int(settings.MCP_SUPERVISOR_INTERVAL)
+        while True:
+            try:
+                await self._heartbeat()
+                await self.reconcile()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f'MCP supervisor tick failed: {e}')
+            await asyncio.sleep(interval)
+
+    async def reconcile(self):
+        """按最新的 worker 列表对账本 worker 负责的接入点"""
+        desired = {endpoint_id: json.loads(mcp) for endpoint_id, mcp in (await redis.hgetall(DESIRED_KEY)).items()}
+        for endpoint_id in list(mcp_manager.connections):
+            if endpoint_id not in desired or not self.owns(endpoint_id):
+                async with self._lock(endpoint_id):
+                    logger.info(f'[{endpoint_id}] released by {self.worker_id}')
+                    await mcp_manager.disconnect({'endpoint_id': endpoint_id})
+                    if endpoint_id not in desired:
+                        await self._save_status(endpoint_id)
+        # 连接失败（重试耗尽）的保持失败状态，等待手动重启；连接超时的间隔一段时间再重试
+        now = time.time()
+        acquired = [
+            {**mcp, 'endpoint_id': endpoint_id}
+            for endpoint_id, mcp in desired.items()
+            if self.owns(endpoint_id)
+            and endpoint_id not in mcp_manager.connections
+            and endpoint_id not in self.restoring
+            and self.retry_at.get(endpoint_id, 0) <= now
+        ]
+        if acquired:
+            logger.info(f'MCP acquired by {self.worker_id}: {[mcp["endpoint_id"] for mcp in acquired]}')
+        for mcp in acquired:
+            self.restoring[mcp['endpoint_id']] = asyncio.create_task(self._restore(mcp))
+        for endpoint_id in list(mcp_manager.connections):
+            if endpoint_id not in self.restoring:
+                await self._save_status(endpoint_id)
+        # 耗时统计按 worker 上报，查询时合并
+        await redis.hset(METRICS_KEY, self.worker_id, json.dumps(snapshot()))
+
+    async def _restore(self, mcp):
+        """后台恢复一个接入点的连接：随机延迟后排队，同时连接的数量不超过 MCP_RESTORE_CONCURRENCY"""
+        endpoint_id = mcp['endpoint_id']
+        try:
+            if endpoint_id not in self.retry_at:
+                await self._save_status(endpoint_id, {'connected': False, 'status': 'pending'})
+            await asyncio.sleep(random.uniform(0, float(settings.MCP_RESTORE_JITTER)))
+            async with self.semaphore, self._lock(endpoint_id):
+                # 排队期间可能已被手动启动、停止或分配给其他 worker
+                if endpoint_id in mcp_manager.connections or not self.owns(endpoint_id):
+                    return
+                if not await redis.hexists(DESIRED_KEY, endpoint_id):
+                    await self._save_status(endpoint_id)
+                    return
+                await self._save_status(endpoint_id, {'connected': False, 'status': 'connecting'})
+                ok, msg = await mcp_manager.connect(mcp)
+                if ok:
+                    self.retry_at.pop(endpoint_id, None)
+                    await self._save_status(endpoint_id)
+                else:
+                    self.retry_at[endpoint_id] = time.time() + RETRY_DELAY
+                    await self._save_status(endpoint_id, {'connected': False, 'status': 'retrying', 'error': msg})
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f'[{endpoint_id}] MCP restore failed: {e}')
+            self.retry_at[endpoint_id] = time.time() + RETRY_DELAY
+        finally:
+            self.restoring.pop(endpoint_id, None)
+
+    async def _save_status(self, endpoint_id, status=None):
+        status = status or mcp_manager.get_connection_status(endpoint_id)
+        status.update(worker=self.worker_id, updated_at=int(time.time()))
+        await redis.hset(STATUS_KEY, endpoint_id, json.dumps(status))
+        return status
+
+    async def _subscribe(self):
+        pubsub = redis.pubsub()
+        await pubsub.subscribe(CONTROL_CHANNEL, EVENTS_CHANNEL, REPLY_CHANNEL.format(self.worker_id))
+        return pubsub
+
+    async def _listen(self, pubsub):
+        """订阅断开（如 Redis 重启超出客户端的重试）后退避重新订阅，否则本 worker 不再响应转发的命令和状态事件"""
+        delay = 1
+        while True:
+            try:
+                if pubsub is None:
+                    pubsub = await self._subscribe()
+                    logger.info(f'MCP supervisor resubscribed: {self.worker_id}')
+                    delay = 1
+                async for message in pubsub.listen():
+                    self._on_message(message)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f'MCP supervisor subscription lost, retry in {delay}s: {e}')
+            finally:
+                if pubsub is not None:
+                    with contextlib.suppress(Exception):
+                        await pubsub.aclose()
+                    pubsub = None
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, RESUBSCRIBE_MAX_DELAY)
+
+    def _on_message(self, message):
+        if message.get('type') != 'message':
+            return
+        try:
+            data = json.loads(message['data'])
+        except Exception:
+            return
+        if message['channel'] == EVENTS_CHANNEL:
+            dispatch_status(data)
+        elif message['channel'] == CONTROL_CHANNEL:
+            if self.owns(data.get('endpoint_id')):
+                asyncio.create_task(self._handle(data))
+        else:
+            future = self.pending.get(data.get('request_id'))
+            if future and not future.done():
+                future.set_result(data.get('result'))
+
+    async def _handle(self, data):
+        """负责的 worker 执行转发来的命令，并把结果发回请求方"""
+        try:
+            result = await self._execute(data['cmd'], data['endpoint_id'], data.get('mcp'))
+        except Exception as e:
+            logger.error(f'[{data["endpoint_id"]}] MCP command {data["cmd"]} failed: {e}')
+            result = {'ok': False, 'msg': str(e)}
+        reply = {'request_id': data['request_id'], 'result': result}
+        await redis.publish(REPLY_CHANNEL.format(data['reply_to']), json.dumps(reply))
+
+    async def _execute(self, cmd, endpoint_id, mcp=None):
+        async with self._lock(endpoint_id):
+            if cmd == 'start':
+                self.retry_at.pop(endpoint_id, None)
+                ok, msg = await mcp_manager.connect(mcp)
+            elif cmd == 'stop':
+                ok, msg = await mcp_manager.disconnect({'endpoint_id': endpoint_id})
+            else:
+                ok, msg = True, ''
+            status = await self._save_status(endpoint_id)
+        return {'ok': ok, 'msg': msg, 'status': status}
+
+    async def _request(self, cmd, endpoint_id, mcp=None):
+        """命令由负责的 worker 执行：是自己就直接执行，否则通过 pub/sub 转发并等待回复"""
+        endpoint_id = str(endpoint_id)
+        if self.owns(endpoint_id):
+            return await self._execute(cmd, endpoint_id, mcp)
+        request_id = uuid.uuid4().hex
+        future = asyncio.get_running_loop().create_future()
+        self.pending[request_id] = future
+        data = {
+            'cmd': cmd,
+            'endpoint_id': endpoint_id,
+            'mcp': mcp,
+            'request_id': request_id,
+            'reply_to': self.worker_id,
+        }
+        try:
+            await redis.publish(CONTROL_CHANNEL, json.dumps(data, default=str))
+            return await asyncio.wait_for(future, timeout=REQUEST_TIMEOUT)
+        except asyncio.TimeoutError:
+            return {'ok': False, 'msg': f'MCP worker {self.owner(endpoint_id)} no response'}
+        finally:
+            self.pending.pop(request_id, None)
+
+    async def connect(self, mcp):
+        """启动（或重启）接入点，并记为需要保持连接"""
+        endpoint_id = str(mcp['endpoint_id'])
+        mcp = {k: v for k, v in mcp.items() if not k.startswith('_')}
+        mcp['endpoint_id'] = endpoint_id
+        await redis.hset(DESIRED_KEY, endpoint_id, json.dumps(mcp, default=str))
+        result = await self._request('start', endpoint_id, mcp)
+        return result['ok'], result['msg']
+
+    async def disconnect(self, mcp):
+        """停止接入点，不再保持连接"""
+        endpoint_id = str(mcp['endpoint_id'])
+        await redis.hdel(DESIRED_KEY, endpoint_id)
+        result = await self._request('stop', endpoint_id)
+        return result['ok'], result['msg']
+
+    async def set_desired(self, mcp):
+        """只记录需要保持连接，由负责的 worker 对账时连接（服务启动时使用）"""
+        await redis.hset(DESIRED_KEY, str(mcp['endpoint_id']), json.dumps(mcp, default=str))
+
+    async def prune_desired(self, valid_ids):
+        """
+        移除不再有效的接入点（已删除或已停用），负责的 worker 对账时断开，不再重试连接
+        Args:
+            valid_ids: 仍需保持连接的接入点ID
+        """
+        valid_ids = {str(endpoint_id) for endpoint_id in valid_ids}
+        stale = [endpoint_id for endpoint_id in await redis.hkeys(DESIRED_KEY) if endpoint_id not in valid_ids]
+        if stale:
+            await redis.hdel(DESIRED_KEY, *stale)
+            await redis.hdel(STATUS_KEY, *stale)
+            logger.info(f'MCP desired pruned: {stale}')
+        return stale
+
+    async def get_connection_status(self, endpoint_id):
+        """读取负责的 worker 最近一次上报的状态"""
+        status = await redis.hget(STATUS_KEY, str(endpoint_id))
+        if not status:
+            return {'connected': False, 'status': 'uncreated'}
+        return json.loads(status)
+
+    async def query_status(self, endpoint_id):
+        """向负责的 worker 实时查询状态"""
+        result = await self._request('status', endpoint_id)
+        return result.get('status') or await self.get_connection_status(endpoint_id)
+
+    async def restore_progress(self):
+        """
+        各接入点的恢复进度，状态不是由存活 worker 上报的（如服务重启前遗留的）记为 pending
+        Returns:
+            ready 为 True 表示所有接入点都已连接或已失败
+        """
+        desired = await redis.hgetall(DESIRED_KEY)
+        ids = list(desired)
+        statuses = await redis.hmget(STATUS_KEY, ids) if ids else []
+        workers = set(self.workers)
+        tools, counts = [], {}
+        for endpoint_id, status in zip(ids, statuses):
+            status = json.loads(status) if status else {}
+            if status.get('worker') not in workers:
+                status = {'connected': False, 'status': 'pending'}
+            counts[status['status']] = counts.get(status['status'], 0) + 1
+            tools.append({'endpoint_id': endpoint_id, 'name': json.loads(desired[endpoint_id]).get('name'), **status})
+        ready = self.synced and not counts.get('pending') and not counts.get('connecting')
+        return {'ready': ready, 'synced': self.synced, 'total': len(ids), 'counts': counts, 'tools': tools}
+
+    async def get_metrics(self):
+        """合并所有存活 worker 的工具调用耗时统计"""
+        metrics = await redis.hgetall(METRICS_KEY)
+        workers = set(self.workers)
+        return merge(json.loads(data) for worker_id, data in metrics.items() if worker_id in workers)
+
+
+mcp_supervisor = MCPSupervisor()
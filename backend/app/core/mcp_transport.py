@@ -0,0 +1,513 @@
+"""
+MCP 传输层：把小智 websocket 收到的 JSON-RPC 消息转给 MCP server，并把 server 的消息回调给调用方
+- stdio：启动子进程，按行读写 stdin/stdout
+- sse / http：在当前事件循环内直接通过共享的 aiohttp 会话访问远端 MCP server，不再为每个接入点启动 mcp_proxy 进程
+"""
+
+import os
+import uuid
+import asyncio
+import aiohttp
+from urllib.parse import urljoin
+from .config import settings
+from .log import mcp_logger as logger
+from .mcp_framing import loads, dumps, error_response, count_frame, TRANSPORT_ERROR_CODE
+
+_session = None
+
+
+def get_session():
+    """所有 sse/http 接入点共享一个 aiohttp 会话和连接池"""
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit=int(settings.MCP_HTTP_POOL_SIZE), keepalive_timeout=60)
+        # SSE 长连接不能设置总超时，只限制建连时间
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=10)
+        _session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    return _session
+
+
+async def close_session():
+    global _session
+    if _session and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+async def _iter_lines(stream, mcp_id=None):
+    """
+    按行读取响应流，不受 StreamReader 单行长度上限的限制（工具结果可能是很长的一行）
+    超过 MCP_MAX_FRAME_SIZE 的行整行丢弃
+    """
+    max_size = int(settings.MCP_MAX_FRAME_SIZE)
+    parts, size, oversized = [], 0, False
+    async for chunk in stream.iter_any():
+        *lines, rest = chunk.split(b'\n')
+        for line in lines:
+            if oversized or size + len(line) > max_size:
+                count_frame(mcp_id, 'oversized')
+                logger.warning(f'[{mcp_id}] drop oversized line: {size + len(line)} bytes')
+            else:
+                parts.append(line)
+                yield b''.join(parts).decode('utf-8').rstrip('\r')
+            parts, size, oversized = [], 0, False
+        if rest and not oversized:
+            size += len(rest)
+            if size > max_size:
+                oversized, parts = True, []
+            else:
+                parts.append(rest)
+    if parts and not oversized:
+        yield b''.join(parts).decode('utf-8').rstrip('\r')
+
+
+async def iter_sse(stream, mcp_id=None):
+    """
+    解析 text/event-stream 响应流
+    Yields:
+        (event, data)
+    """
+    event, data = 'message', []
+    async for line in _iter_lines(stream, mcp_id):
+        if not line:
+            if data:
+                yield event, '\n'.join(data)
+            event, data = 'message', []
+        elif line.startswith(':'):
+            continue
+        else:
+            field, _, value = line.partition(':')
+            value = value[1:] if value.startswith(' ') else value
+            if field == 'event':
+                event = value
+            elif field == 'data':
+                data.append(value)
+    if data:
+        yield event, '\n'.join(data)
+
+
+class BaseTransport:
+    """
+    Args:
+        mcp_id: 接入点ID
+        on_message: async func(dict, raw)，MCP server 发出的每条消息都会回调，raw 为单条消息的原始文本（没有时为 None）
+    """
+
+    def __init__(self, mcp_id, on_message):
+        self.mcp_id = mcp_id
+        self.on_message = on_message
+        self.closed = asyncio.Event()
+        self.returncode = None
+        self.probes = {}  # 探活请求 id -> Future，响应不转发给设备
+
+    async def start(self):
+        raise NotImplementedError
+
+    async def send(self, msg_dict, raw=None):
+        """
+        Args:
+            raw: 消息未被修改时的原始文本，直接转发不重新序列化
+        """
+        raise NotImplementedError
+
+    async def close(self):
+        self.closed.set()
+
+    async def wait(self):
+        """等待传输关闭，与 asyncio.subprocess.Process.wait 一致"""
+        await self.closed.wait()
+        return self.returncode
+
+    def _probe_message(self, msg_id):
+        return {'jsonrpc': '2.0', 'id': msg_id, 'method': 'ping'}
+
+    async def probe(self, timeout=None):
+        """
+        JSON-RPC 握手探活：收到对应 id 的响应即认为存活，不再固定等待
+        Returns:
+            (是否存活, 说明)
+        """
+        timeout = timeout or int(settings.MCP_PROBE_TIMEOUT)
+        msg_id = f'probe-{uuid.uuid4().hex[:8]}'
+        future = asyncio.get_running_loop().create_future()
+        self.probes[msg_id] = future
+        closed = asyncio.ensure_future(self.wait())
+        try:
+            await self.send(self._probe_message(msg_id))
+            done, _ = await asyncio.wait({future, closed}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        except Exception as e:
+            return False, f'MCP probe failed: {e}'
+        finally:
+            closed.cancel()
+            self.probes.pop(msg_id, None)
+        if future in done:
+            error = future.result().get('error') or {}
+            if error.get('code') == TRANSPORT_ERROR_CODE:
+                return False, error.get('message', '')
+            return True, ''
+        if closed in done:
+            return False, f'MCP transport exited with code {self.returncode}'
+        return False, f'MCP server no response in {timeout}s'
+
+    def _resolve_probe(self, message):
+        future = self.probes.pop(message.get('id'), None) if self.probes else None
+        if future is None:
+            return False
+        if not future.done():
+            future.set_result(message)
+        return True
+
+    def _check_open(self):
+        if self.closed.is_set():
+            raise ConnectionError(f'MCP transport closed: {self.mcp_id}')
+
+    async def _deliver(self, payload, raw=None):
+        if not isinstance(payload, list):
+            if not self._resolve_probe(payload):
+                await self.on_message(payload, raw)
+            return
+        # 批量消息拆开逐条回调
+        for message in payload:
+            if not self._resolve_probe(message):
+                await self.on_message(message, None)
+
+
+class StdioTransport(BaseTransport):
+    """stdio 接入点：一个接入点一个子进程"""
+
+    def __init__(self, mcp_id, on_message, cmd, env=None):
+        super().__init__(mcp_id, on_message)
+        self.cmd = cmd
+        self.env = env or {}
+        self.process = None
+        self.tasks = []
+
+    async def start(self):
+        merged_env = os.environ.copy()
+        merged_env.update(self.env)
+        self.process = await asyncio.create_subprocess_exec(
+            *self.cmd,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env=merged_env,
+            limit=int(settings.MCP_STDIO_READ_LIMIT),
+        )
+        self.tasks = [asyncio.create_task(self._stdout_reader()), asyncio.create_task(self._stderr_reader())]
+        logger.info(f'[Process-{self.mcp_id}] Started MCP process: {self.cmd}')
+
+    async def send(self, msg_dict, raw=None):
+        self._check_open()
+        # 按行分帧，原始文本中带换行（格式化过的 JSON）时要重新序列化
+        if raw is None or '\n' in raw:
+            raw = dumps(msg_dict)
+        self.process.stdin.write((raw + '\n').encode('utf-8'))
+        await self.process.stdin.drain()
+
+    async def wait(self):
+        self.returncode = await self.process.wait()
+        return self.returncode
+
+    async def close(self):
+        await super().close()
+        for task in self.tasks:
+            task.cancel()
+        proc = self.process
+        if not proc:
+            return
+        try:
+            proc.terminate()
+            await asyncio.wait_for(proc.wait(), timeout=5)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+        except ProcessLookupError:
+            pass
+        except Exception as e:
+            logger.error(f'[Process:{self.mcp_id}] Error terminating process: {e}')
+        logger.info(f'[Process:{self.mcp_id}] MCP process terminated')
+
+    async def _read_frame(self):
+        """
+        读取一行：超过 StreamReader 缓冲上限的长行分块读取后拼接，超过 MCP_MAX_FRAME_SIZE 的整行丢弃
+        Returns:
+            一行数据；EOF 返回 b''；丢弃的行返回 None
+        """
+        stream = self.process.stdout
+        max_size = int(settings.MCP_MAX_FRAME_SIZE)
+        chunks, size, oversized = [], 0, False
+        while True:
+            done = True
+            try:
+                chunk = await stream.readuntil(b'\n')
+            except asyncio.IncompleteReadError as e:
+                chunk = e.partial  # EOF，最后一行没有换行符
+            except asyncio.LimitOverrunError as e:
+                chunk = await stream.readexactly(e.consumed)
+                done = False
+            size += len(chunk)
+            if size > max_size:
+                oversized, chunks = True, []
+            elif not oversized:
+                chunks.append(chunk)
+            if done:
+                break
+        if oversized:
+            count_frame(self.mcp_id, 'oversized')
+            logger.warning(f'[stdout-{self.mcp_id}] drop oversized line: {size} bytes')
+            return None
+        return b''.join(chunks)
+
+    async def _stdout_reader(self):
+        """Single stdout reader per process; every JSON line is handed to on_message."""
+        name = f'stdout-{self.mcp_id}'
+        try:
+            while True:
+                raw = await self._read_frame()
+                if raw is None:
+                    continue
+                if not raw:
+                    logger.info(f'[{name}] stdout closed')
+                    break
+                try:
+                    text = raw.decode('utf-8').strip()
+                except Exception:
+                    logger.error(f'[{name}] stdout decode error')
+                    continue
+                try:
+                    data_dict = loads(text)
+                except Exception:
+                    logger.error(f'[{name}] stdout non-json line: {text!r}')
+                    continue
+                await self._deliver(data_dict, text)
+        except asyncio.CancelledError:
+            logger.info(f'[{name}] stdout reader cancelled')
+            raise
+        except Exception:
+            logger.exception(f'[{name}] Error in stdout reader')
+            raise
+        finally:
+            self.closed.set()
+            logger.info(f'[{name}] stdout reader exiting')
+
+    async def _stderr_reader(self):
+        name = f'stderr-{self.mcp_id}'
+        try:
+            while True:
+                try:
+                    raw = await self.process.stderr.readline()
+                except ValueError:
+                    # 超长的行已被 StreamReader 丢弃，继续读
+                    logger.info(f'[{name}]: <line too long, skipped>')
+                    continue
+                if not raw:
+                    logger.info(f'[{name}] stderr closed')
+                    break
+                logger.info('[%s]: %s', name, raw.decode('utf-8', 'replace').strip())
+        except asyncio.CancelledError:
+            logger.error(f'[{name}] stderr reader cancelled')
+            raise
+        except Exception:
+            logger.exception(f'[{name}] Error in stderr reader')
+            raise
+        finally:
+            logger.info(f'[{name}] stderr reader exiting')
+
+
+class SseTransport(BaseTransport):
+    """
+    旧版 HTTP+SSE 接入点：GET 建立 SSE 长连接，服务端先推送 endpoint 事件告知消息地址，
+    之后客户端 POST 消息，响应通过 SSE 的 message 事件推回
+    """
+
+    def __init__(self, mcp_id, on_message, url, headers=None):
+        super().__init__(mcp_id, on_message)
+        self.url = url
+        self.headers = {k: str(v) for k, v in (headers or {}).items()}
+        self.endpoint = None
+        self.response = None
+        self.reader = None
+
+    async def start(self):
+        session = get_session()
+        self.response = await session.get(self.url, headers={**self.headers, 'Accept': 'text/event-stream'})
+        if self.response.status != 200:
+            text = await self.response.text()
+            self.response.release()
+            raise RuntimeError(f'SSE connect failed: HTTP {self.response.status} {text[:200]}')
+        endpoint = asyncio.get_running_loop().create_future()
+        self.reader = asyncio.create_task(self._reader(endpoint))
+        try:
+            self.endpoint = await asyncio.wait_for(endpoint, timeout=10)
+        except Exception:
+            await self.close()
+            raise
+        logger.info(f'[SSE-{self.mcp_id}] connected, endpoint {self.endpoint}')
+
+    async def _reader(self, endpoint):
+        name = f'SSE-{self.mcp_id}'
+        try:
+            async for event, data in iter_sse(self.response.content, self.mcp_id):
+                if event == 'endpoint':
+                    if not endpoint.done():
+                        endpoint.set_result(urljoin(self.url, data))
+                    continue
+                if event != 'message':
+                    continue
+                try:
+                    payload = loads(data)
+                except Exception:
+                    logger.error(f'[{name}] non-json event: {data!r}')
+                    continue
+                await self._deliver(payload, data)
+            logger.info(f'[{name}] stream closed')
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f'[{name}] Error in SSE reader: {e}')
+        finally:
+            if not endpoint.done():
+                endpoint.set_exception(RuntimeError('SSE stream closed before endpoint event'))
+            self.returncode = 0
+            self.closed.set()
+
+    async def send(self, msg_dict, raw=None):
+        self._check_open()
+        session = get_session()
+        timeout = aiohttp.ClientTimeout(total=int(settings.MCP_HTTP_TIMEOUT))
+        headers = {**self.headers, 'Content-Type': 'application/json'}
+        data = raw if raw is not None else dumps(msg_dict)
+        try:
+            async with session.post(self.endpoint, headers=headers, data=data, timeout=timeout) as response:
+                if response.status >= 400:
+                    raise RuntimeError(f'HTTP {response.status}: {(await response.text())[:200]}')
+        except (aiohttp.ClientError, asyncio.TimeoutError, RuntimeError) as e:
+            logger.error(f'[SSE-{self.mcp_id}] post failed: {e}')
+            if 'id' in msg_dict and 'method' in msg_dict:
+                await self._deliver(error_response(msg_dict['id'], f'MCP request failed: {e}'))
+
+    async def close(self):
+        await super().close()
+        if self.reader:
+            self.reader.cancel()
+        if self.response:
+            self.response.close()
+
+
+class StreamableHttpTransport(BaseTransport):
+    """
+    Streamable HTTP 接入点：每条消息单独 POST，响应是 JSON 或者 SSE 流；
+    initialize 响应头中的 Mcp-Session-Id 之后每次请求都要带上
+    """
+
+    def __init__(self, mcp_id, on_message, url, headers=None):
+        super().__init__(mcp_id, on_message)
+        self.url = url
+        self.headers = {k: str(v) for k, v in (headers or {}).items()}
+        self.session_id = None
+        self.protocol_version = None
+        self.pending = set()
+
+    async def start(self):
+        # 无状态协议，连接在第一次 POST 时建立
+        logger.info(f'[HTTP-{self.mcp_id}] ready {self.url}')
+
+    def _request_headers(self):
+        headers = {**self.headers, 'Accept': 'application/json, text/event-stream', 'Content-Type': 'application/json'}
+        if self.session_id:
+            headers['Mcp-Session-Id'] = self.session_id
+        if self.protocol_version:
+            headers['Mcp-Protocol-Version'] = self.protocol_version
+        return headers
+
+    def _probe_message(self, msg_id):
+        # 还没有会话时服务端可能拒绝 ping，用 initialize 握手探活
+        if self.session_id:
+            return super()._probe_message(msg_id)
+        params = {
+            'protocolVersion': '2024-11-05',
+            'capabilities': {},
+            'clientInfo': {'name': 'holobox-probe', 'version': '1.0'},
+        }
+        return {'jsonrpc': '2.0', 'id': msg_id, 'method': 'initialize', 'params': params}
+
+    async def send(self, msg_dict, raw=None):
+        self._check_open()
+        data = raw if raw is not None else dumps(msg_dict)
+        # initialize 要拿到会话ID后才能发后续消息，同步等待；其余请求并发处理，长耗时的工具调用不阻塞后续消息
+        if msg_dict.get('method') == 'initialize':
+            self.session_id = None
+            await self._post(msg_dict, data)
+            return
+        task = asyncio.create_task(self._post(msg_dict, data))
+        self.pending.add(task)
+        task.add_done_callback(self.pending.discard)
+
+    async def _post(self, msg_dict, data):
+        name = f'HTTP-{self.mcp_id}'
+        session = get_session()
+        timeout = aiohttp.ClientTimeout(total=int(settings.MCP_HTTP_TIMEOUT))
+        try:
+            async with session.post(self.url, headers=self._request_headers(), data=data, timeout=timeout) as response:
+                if response.status == 404 and self.session_id:
+                    # 会话已失效，等待调用方重新 initialize
+                    self.session_id = None
+                    raise RuntimeError('MCP session expired')
+                if response.status >= 400:
+                    raise RuntimeError(f'HTTP {response.status}: {(await response.text())[:200]}')
+                session_id = response.headers.get('Mcp-Session-Id')
+                if session_id:
+                    self.session_id = session_id
+                if response.status == 202:
+                    return
+                content_type = response.headers.get('Content-Type', '')
+                if content_type.startswith('text/event-stream'):
+                    async for event, text in iter_sse(response.content, self.mcp_id):
+                        if event == 'message':
+                            await self._on_payload(loads(text), text)
+                elif content_type.startswith('application/json'):
+                    body = await response.read()
+                    await self._on_payload(loads(body), body.decode('utf-8'))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f'[{name}] post failed: {e}')
+            if 'id' in msg_dict and 'method' in msg_dict:
+                await self._deliver(error_response(msg_dict['id'], f'MCP request failed: {e}'))
+
+    async def _on_payload(self, payload, raw):
+        for message in payload if isinstance(payload, list) else [payload]:
+            result = message.get('result')
+            if isinstance(result, dict) and result.get('protocolVersion'):
+                self.protocol_version = result['protocolVersion']
+        await self._deliver(payload, raw)
+
+    async def close(self):
+        await super().close()
+        for task in list(self.pending):
+            task.cancel()
+        if self.session_id:
+            # 主动结束服务端会话，失败不影响关闭
+            try:
+                session = get_session()
+                timeout = aiohttp.ClientTimeout(total=5)
+                async with session.delete(self.url, headers=self._request_headers(), timeout=timeout):
+                    pass
+            except Exception as e:
+                logger.info(f'[HTTP-{self.mcp_id}] delete session failed: {e}')
+            self.session_id = None
+
+
+def create_transport(mcp, on_message, cmd=None):
+    """
+    按接入点协议创建传输
+    Args:
+        cmd: 子进程命令，stdio 接入点以及关闭 MCP_INPROCESS_HTTP 时的 sse/http 接入点（mcp_proxy）使用
+    """
+    mcp_id = mcp['endpoint_id']
+    protocol = mcp['protocol']
+    cfg = mcp.get('config', {})
+    if protocol in ('sse', 'http') and settings.MCP_INPROCESS_HTTP:
+        cls = SseTransport if protocol == 'sse' else StreamableHttpTransport
+        return cls(mcp_id, on_message, cfg.get('url'), cfg.get('headers'))
+    return StdioTransport(mcp_id, on_message, cmd, cfg.get('env', {}))
@@ -2,24 +2,32 @@ import os
 import json
 import base64
 import asyncio
+import functools
+import threading
+import time
+import weakref
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import certifi
+import urllib3
 import soundfile as sf
-import scipy.signal as signal
-import numpy as np
-from pydub import AudioSegment
 from io import BytesIO
 from minio import Minio
 from minio.error import S3Error
 from minio.deleteobjects import DeleteObject
-from minio.commonconfig import ENABLED, Filter
+from minio.commonconfig import ENABLED, Filter, CopySource
 from minio.lifecycleconfig import LifecycleConfig, Rule, Expiration
 
 from obs import ObsClient
 from obs import PutObjectHeader
 from obs import DeleteObjectsRequest
 from obs import Object
+from obs import CompletePart, CompleteMultipartUploadRequest
 
 from .config import settings
 from .log import logger
+from .audio import normalize_audio, normalize_audio_async, spool_audio
 
 # 获取环境变量中的MinIO配置
 minio_endpoint = settings.OSS_ENDPOINT
@@ -28,20 +36,136 @@ minio_secret_key = settings.OSS_ACCESS_KEY_SECRET
 minio_bucket_name = settings.OSS_BUCKET_NAME
 minio_region = settings.OSS_REGION
 minio_secure = settings.OSS_SECURE
+# 分片上传配置：单个上传最多同时在内存中持有 part_size * upload_parallel 字节
+part_size = max(int(settings.OSS_PART_SIZE), 5 * 1024 * 1024)
+upload_parallel = max(int(settings.OSS_UPLOAD_PARALLEL), 1)
+# 异步接口配置：每个后端独立的线程池，以及在途请求上限（背压）
+max_workers = max(int(settings.OSS_MAX_WORKERS), 1)
+max_pending = max(int(settings.OSS_MAX_PENDING), max_workers)
+
+
+def url_to_key(url):
+    """文件访问地址转换为对象 key，兼容直接存 key 的字段"""
+    if not url:
+        return ''
+    if settings.OSS_BUCKET_URL and url.startswith(settings.OSS_BUCKET_URL):
+        url = url[len(settings.OSS_BUCKET_URL) :]
+    return url.lstrip('/')
+
+
+class BaseStorage:
+    """
+    对象存储异步接口基类：SDK 是阻塞调用，统一放到后端专用的线程池执行，不占用 asyncio 默认线程池（其它 to_thread 调用共用）；
+    在途请求数超过 max_pending 时调用方在协程层面排队，避免请求无限堆积在线程池队列里
+    """
+
+    def _init_executor(self, name):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f'oss-{name}')
+        # asyncio.Semaphore 绑定事件循环，celery 任务每次 asyncio.run 都是新循环，按循环分别创建
+        self._limiters = weakref.WeakKeyDictionary()
+
+    def _limiter(self):
+        loop = asyncio.get_running_loop()
+        limiter = self._limiters.get(loop)
+        if limiter is None:
+            limiter = self._limiters[loop] = asyncio.Semaphore(max_pending)
+        return limiter
+
+    async def _run(self, func, *args, **kwargs):
+        """在专用线程池中执行阻塞的 SDK 调用"""
+        async with self._limiter():
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
 
+    async def upload_file_async(self, key, file_path=None, file_data=None, content_type='application/octet-stream'):
+        """异步上传文件"""
+        return await self._run(self.upload_file, key, file_path, file_data, content_type)
+
+    async def upload_stream_async(self, key, stream, length=-1, content_type='application/octet-stream'):
+        """异步流式上传文件对象"""
+        return await self._run(self.upload_stream, key, stream, length, content_type)
+
+    def upload_audio(self, key, audio_path=None, audio_data=None, audio_text=''):
+        """音频转为 OPUS 后上传，在当前线程内处理"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            if not audio_path:
+                audio_path = os.path.join(tmp_dir, 'src')
+                spool_audio(audio_data, audio_path)
+            dst_path = os.path.join(tmp_dir, 'audio.ogg')
+            normalize_audio(audio_path, dst_path)
+            return self.put_audio(key, dst_path, audio_text)
+
+    async def upload_audio_async(self, key, audio_path=None, audio_data=None, audio_text=''):
+        """异步上传音频：落盘和上传走存储线程池，解码/重采样/编码走音频进程池"""
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            if not audio_path:
+                audio_path = os.path.join(tmp_dir, 'src')
+                await self._run(spool_audio, audio_data, audio_path)
+            dst_path = os.path.join(tmp_dir, 'audio.ogg')
+            try:
+                await normalize_audio_async(audio_path, dst_path)
+            except Exception as e:
+                logger.error(f'Error converting audio: {e}')
+                return False
+            return await self._run(self.put_audio, key, dst_path, audio_text)
+
+    async def delete_file_async(self, key):
+        """异步删除文件"""
+        return await self._run(self.delete_file, key)
+
+    async def download_file_async(self, key, save_path):
+        """异步下载文件到本地"""
+        return await self._run(self.download_file, key, save_path)
 
-class MinIO:
+    async def get_size_async(self, key):
+        """异步获取对象大小"""
+        return await self._run(self.get_size, key)
+
+    async def copy_file_async(self, src_key, dst_key):
+        """异步复制对象"""
+        return await self._run(self.copy_file, src_key, dst_key)
+
+    async def presign_upload_async(self, key, expires=3600, content_type=None):
+        """异步生成直传地址"""
+        return await self._run(self.presign_upload, key, expires, content_type)
+
+    async def iter_object_pages(self, prefix=None, page_size=1000):
+        """异步按页遍历对象，内存中只保留当前页"""
+        pages = self.list_object_pages(prefix, page_size)
+        while True:
+            page = await self._run(next, pages, None)
+            if page is None:
+                break
+            yield page
+
+    async def delete_batch_async(self, keys):
+        """异步批量删除文件"""
+        keys = [key for key in dict.fromkeys(keys) if key]
+        if not keys:
+            return True
+        return await self._run(self.delete_batch, keys)
+
+
+class MinIO(BaseStorage):
     def __init__(self):
+        timeout = 300
         self.client = Minio(
             minio_endpoint.split()[0],
             access_key=minio_access_key,
             secret_key=minio_secret_key,
             secure=minio_secure,  # 是否启用HTTPS，需要根据部署的minio进行选择
             region=minio_region,
+            # 除连接池大小外与 SDK 默认配置一致，连接数要覆盖线程池 x 并行分片数
+            http_client=urllib3.PoolManager(
+                timeout=urllib3.Timeout(connect=timeout, read=timeout),
+                maxsize=max_workers * upload_parallel,
+                cert_reqs='CERT_REQUIRED',
+                ca_certs=os.environ.get('SSL_CERT_FILE') or certifi.where(),
+                retries=urllib3.Retry(total=5, backoff_factor=0.2, status_forcelist=[500, 502, 503, 504]),
+            ),
         )
+        self._init_executor('minio')
         self.bucket_name = minio_bucket_name
-        self.valid_rates = [8000, 12000, 16000, 24000, 48000]
-        self.target_rate = 16000
 
         # 确保存储桶存在
         found = self.client.bucket_exists(self.bucket_name)
@@ -86,36 +210,23 @@ class MinIO:
             logger.error(f'Error setting bucket policy: {e}')
             return False
 
-    def upload_audio(self, key, audio_path=None, audio_data=None, audio_text=''):
-        if audio_path:
-            data, samplerate = sf.read(audio_path)
-        elif audio_data:
-            # 尝试用 pydub 读取任意格式（支持 webm/ogg/opus）
-            audio = AudioSegment.from_file(BytesIO(audio_data))
-            samplerate = audio.frame_rate
-            samples = np.array(audio.get_array_of_samples(), dtype=np.float32)
-            data = samples / np.iinfo(audio.array_type).max
-        if samplerate not in self.valid_rates:
-            num_samples = round(len(data) * self.target_rate / samplerate)
-            data = signal.resample(data, num_samples)
-            samplerate = self.target_rate
-        with BytesIO() as f:
-            sf.write(f, data, samplerate, format='ogg', subtype='OPUS')
-            f.seek(0)
-            text64 = base64.b64encode(audio_text.encode())
-            try:
+    def put_audio(self, key, file_path, audio_text=''):
+        """上传处理好的 OPUS 音频，文本放在元数据中"""
+        text64 = base64.b64encode(audio_text.encode())
+        try:
+            with open(file_path, 'rb') as f:
                 self.client.put_object(
                     self.bucket_name,
                     key,
                     f,
-                    length=f.getbuffer().nbytes,
+                    length=os.path.getsize(file_path),
                     metadata={'text': text64.decode()},
                     content_type='audio/ogg',
                 )
-                return True
-            except S3Error as e:
-                logger.error(f'Error uploading audio: {e}')
-                return False
+            return True
+        except S3Error as e:
+            logger.error(f'Error uploading audio: {e}')
+            return False
 
     def download_audio(self, key, save_path):
         try:
@@ -184,6 +295,30 @@ class MinIO:
             logger.error(f'Error deleting batch: {e}')
             return False
 
+    def get_size(self, key):
+        """对象大小，不存在时返回 None"""
+        try:
+            return self.client.stat_object(self.bucket_name, key).size
+        except S3Error as e:
+            if e.code != 'NoSuchKey':
+                logger.error(f'Error getting object size: {e}')
+            return None
+
+    def copy_file(self, src_key, dst_key):
+        """桶内复制对象，不经过本地"""
+        try:
+            self.client.copy_object(self.bucket_name, dst_key, CopySource(self.bucket_name, src_key))
+            return True
+        except S3Error as e:
+            logger.error(f'Error copying object: {e}')
+            return False
+
+    def presign_upload(self, key, expires=3600, content_type=None):
+        """生成客户端直传的预签名 PUT 地址"""
+        url = self.client.presigned_put_object(self.bucket_name, key, expires=timedelta(seconds=expires))
+        headers = {'Content-Type': content_type} if content_type else {}
+        return {'url': url, 'method': 'PUT', 'headers': headers}
+
     def check_key_exists(self, key):
         try:
             self.client.stat_object(self.bucket_name, key)
@@ -199,12 +334,7 @@ class MinIO:
         if file_path:
             stat = os.stat(file_path)
             with open(file_path, 'rb') as f:
-                try:
-                    self.client.put_object(self.bucket_name, key, f, stat.st_size, content_type)
-                    return True
-                except S3Error as e:
-                    logger.error(f'Error uploading file {key}: {e}')
-                    return False
+                return self.upload_stream(key, f, stat.st_size, content_type)
         elif file_data:
             with BytesIO(file_data) as f:
                 try:
@@ -215,6 +345,27 @@ class MinIO:
                     return False
         return False
 
+    def upload_stream(self, key, stream, length=-1, content_type='application/octet-stream'):
+        """
+        流式上传文件对象：按分片读取，超过一个分片时走 multipart 并行上传
+        :param stream: 可读的文件对象（如 UploadFile.file），从当前位置读到结尾
+        :param length: 数据长度，未知时传 -1
+        """
+        try:
+            self.client.put_object(
+                self.bucket_name,
+                key,
+                stream,
+                length if length is not None else -1,
+                content_type,
+                part_size=part_size,
+                num_parallel_uploads=upload_parallel,
+            )
+            return True
+        except Exception as e:
+            logger.error(f'Error uploading stream {key}: {e}')
+            return False
+
     def list_objects(self, prefix=None):
         keys = []
         try:
@@ -228,58 +379,44 @@ class MinIO:
             logger.error(f'Error listing objects: {e}')
             return keys
 
-    async def upload_file_async(self, key, file_path=None, file_data=None, content_type='application/octet-stream'):
-        """异步上传文件"""
-        return await asyncio.to_thread(self.upload_file, key, file_path, file_data, content_type)
-
-    async def upload_audio_async(self, key, audio_path=None, audio_data=None, audio_text=''):
-        """异步上传音频"""
-        return await asyncio.to_thread(self.upload_audio, key, audio_path, audio_data, audio_text)
-
-    async def delete_file_async(self, key):
-        """异步删除文件"""
-        return await asyncio.to_thread(self.delete_file, key)
-
-
-class OBSStorage:
+    def list_object_pages(self, prefix=None, page_size=1000):
+        """按页遍历对象，每页为 (key, size, 修改时间戳) 列表"""
+        page = []
+        for obj in self.client.list_objects(self.bucket_name, prefix=prefix, recursive=True):
+            if obj.object_name.endswith('/'):
+                continue
+            mtime = obj.last_modified.timestamp() if obj.last_modified else 0
+            page.append((obj.object_name, obj.size or 0, mtime))
+            if len(page) >= page_size:
+                yield page
+                page = []
+        if page:
+            yield page
+
+
+class OBSStorage(BaseStorage):
     def __init__(self):
         self.client = ObsClient(
             access_key_id=minio_access_key,
             secret_access_key=minio_secret_key,
             server=minio_endpoint,  # https://obs.cn-north-4.myhuaweicloud.com
+            pool_size=max_workers * upload_parallel,
         )
+        self._init_executor('obs')
         self.bucket_name = minio_bucket_name
-        self.valid_rates = [8000, 12000, 16000, 24000, 48000]
-        self.target_rate = 16000
 
         # 确保存储桶存在
         if not self.client.headBucket(self.bucket_name).status < 300:
             self.client.createBucket(self.bucket_name)
 
-    def upload_audio(self, key, audio_path=None, audio_data=None, audio_text=''):
-        if audio_path:
-            data, samplerate = sf.read(audio_path)
-        elif audio_data:
-            audio = AudioSegment.from_file(BytesIO(audio_data))
-            samplerate = audio.frame_rate
-            samples = np.array(audio.get_array_of_samples(), dtype=np.float32)
-            data = samples / np.iinfo(audio.array_type).max
-
-        if samplerate not in self.valid_rates:
-            num_samples = round(len(data) * self.target_rate / samplerate)
-            data = signal.resample(data, num_samples)
-            samplerate = self.target_rate
-
-        with BytesIO() as f:
-            sf.write(f, data, samplerate, format='ogg', subtype='OPUS')
-            f.seek(0)
-
-            headers = PutObjectHeader()
-            headers.contentType = 'audio/ogg'
-            headers.metadata = {'text': base64.b64encode(audio_text.encode()).decode()}
-
+    def put_audio(self, key, file_path, audio_text=''):
+        """上传处理好的 OPUS 音频，文本放在元数据中"""
+        headers = PutObjectHeader()
+        headers.contentType = 'audio/ogg'
+        headers.metadata = {'text': base64.b64encode(audio_text.encode()).decode()}
+        with open(file_path, 'rb') as f:
             resp = self.client.putObject(self.bucket_name, key, body=f, headers=headers)
-            return resp.status < 300
+        return resp.status < 300
 
     def download_audio(self, key, save_path):
         resp = self.client.getObject(self.bucket_name, key)
@@ -300,8 +437,8 @@ class OBSStorage:
         headers.contentType = content_type
 
         if file_path:
-            resp = self.client.putFile(self.bucket_name, key, file_path, headers=headers)
-            return resp.status < 300
+            with open(file_path, 'rb') as f:
+                return self.upload_stream(key, f, os.path.getsize(file_path), content_type)
 
         if file_data:
             resp = self.client.putObject(self.bucket_name, key, BytesIO(file_data), headers=headers)
@@ -309,14 +446,71 @@ class OBSStorage:
 
         return False
 
-    def download_file(self, key, save_path):
-        resp = self.client.getObject(self.bucket_name, key, loadStreamInMemory=True)
+    def _upload_part(self, key, upload_id, part_number, data):
+        resp = self.client.uploadPart(self.bucket_name, key, part_number, upload_id, content=data)
         if resp.status >= 300:
+            raise Exception(f'upload part {part_number} failed: {resp.errorCode} {resp.errorMessage}')
+        return resp.body.etag
+
+    def upload_stream(self, key, stream, length=-1, content_type='application/octet-stream'):
+        """
+        流式上传文件对象：按分片读取，超过一个分片时走 multipart 并行上传
+        :param stream: 可读的文件对象（如 UploadFile.file），从当前位置读到结尾
+        :param length: 数据长度，OBS 分片上传不依赖该值，仅为与 MinIO 接口保持一致
+        """
+        data = stream.read(part_size)
+        if len(data) < part_size:
+            headers = PutObjectHeader()
+            headers.contentType = content_type
+            resp = self.client.putContent(self.bucket_name, key, data, headers=headers)
+            return resp.status < 300
+
+        resp = self.client.initiateMultipartUpload(self.bucket_name, key, contentType=content_type)
+        if resp.status >= 300:
+            logger.error(f'Error initiating multipart upload {key}: {resp.errorCode} {resp.errorMessage}')
+            return False
+        upload_id = resp.body.uploadId
+        # 信号量限制在途分片数，读取速度快于上传时阻塞读取，内存占用不超过 upload_parallel 个分片
+        slots = threading.BoundedSemaphore(upload_parallel)
+        futures = []
+        try:
+            with ThreadPoolExecutor(max_workers=upload_parallel) as pool:
+                part_number = 1
+                while data:
+                    slots.acquire()
+                    failed = next((f for f in futures if f.done() and f.exception()), None)
+                    if failed:
+                        slots.release()
+                        raise failed.exception()
+                    future = pool.submit(self._upload_part, key, upload_id, part_number, data)
+                    future.add_done_callback(lambda _: slots.release())
+                    futures.append(future)
+                    part_number += 1
+                    data = stream.read(part_size)
+            parts = [CompletePart(partNum=i + 1, etag=f.result()) for i, f in enumerate(futures)]
+            resp = self.client.completeMultipartUpload(
+                self.bucket_name, key, upload_id, CompleteMultipartUploadRequest(parts=parts)
+            )
+            if resp.status >= 300:
+                raise Exception(f'complete multipart upload failed: {resp.errorCode} {resp.errorMessage}')
+            return True
+        except Exception as e:
+            logger.error(f'Error uploading stream {key}: {e}')
+            self.client.abortMultipartUpload(self.bucket_name, key, upload_id)
             return False
-        data = resp.body.buffer
-        with open(save_path, 'wb') as f:
-            f.write(data)
 
+    def download_file(self, key, save_path):
+        resp = self.client.getObject(self.bucket_name, key)
+        if resp.status >= 300:
+            return False
+        # 分块写入磁盘，不整体读入内存
+        response = resp.body.response
+        try:
+            with open(save_path, 'wb') as f:
+                while chunk := response.read(64 * 1024):
+                    f.write(chunk)
+        finally:
+            response.close()
         return True
 
     def delete_file(self, key):
@@ -324,16 +518,39 @@ class OBSStorage:
         return resp.status < 300
 
     def delete_batch(self, keys):
-        objects = [Object(key=key, versionId=None) for key in keys]
-
-        req = DeleteObjectsRequest(quiet=True, objects=objects, encoding_type='url')
+        # OBS批量删除每次最多1000个对象
+        for i in range(0, len(keys), 1000):
+            objects = [Object(key=key, versionId=None) for key in keys[i : i + 1000]]
+            req = DeleteObjectsRequest(quiet=True, objects=objects, encoding_type='url')
+            resp = self.client.deleteObjects(self.bucket_name, req)
+            if resp.status >= 300:
+                logger.error(f'Error deleting batch: {resp.errorCode} {resp.errorMessage}')
+                return False
+            for error in resp.body.error or []:
+                logger.error(f'Error deleting object {error.key}: {error.message}')
+        return True
 
-        resp = self.client.deleteObjects(self.bucket_name, req)
+    def get_size(self, key):
+        """对象大小，不存在时返回 None"""
+        resp = self.client.getObjectMetadata(self.bucket_name, key)
+        if resp.status >= 300:
+            return None
+        return int(resp.body.contentLength or 0)
 
+    def copy_file(self, src_key, dst_key):
+        """桶内复制对象，不经过本地"""
+        resp = self.client.copyObject(self.bucket_name, src_key, self.bucket_name, dst_key)
         if resp.status >= 300:
+            logger.error(f'Error copying object: {resp.errorCode} {resp.errorMessage}')
             return False
         return True
 
+    def presign_upload(self, key, expires=3600, content_type=None):
+        """生成客户端直传的预签名 PUT 地址，Content-Type 参与签名，客户端上传时必须带上"""
+        headers = {'Content-Type': content_type} if content_type else {}
+        resp = self.client.createSignedUrl('PUT', self.bucket_name, key, expires=expires, headers=headers)
+        return {'url': resp.signedUrl, 'method': 'PUT', 'headers': resp.actualSignedRequestHeaders or headers}
+
     def check_key_exists(self, key):
         resp = self.client.headObject(self.bucket_name, key)
         return resp.status < 300
@@ -350,17 +567,23 @@ class OBSStorage:
             marker = resp.body.next_marker
         return keys
 
-    async def upload_file_async(self, key, file_path=None, file_data=None, content_type='application/octet-stream'):
-        """异步上传文件"""
-        return await asyncio.to_thread(self.upload_file, key, file_path, file_data, content_type)
-
-    async def upload_audio_async(self, key, audio_path=None, audio_data=None, audio_text=''):
-        """异步上传音频"""
-        return await asyncio.to_thread(self.upload_audio, key, audio_path, audio_data, audio_text)
-
-    async def delete_file_async(self, key):
-        """异步删除文件"""
-        return await asyncio.to_thread(self.delete_file, key)
+    def list_object_pages(self, prefix=None, page_size=1000):
+        """按页遍历对象，每页为 (key, size, 修改时间戳) 列表"""
+        marker = None
+        while True:
+            resp = self.client.listObjects(self.bucket_name, prefix=prefix, marker=marker, max_keys=page_size)
+            if resp.status >= 300:
+                raise RuntimeError(f'Error listing objects: {resp.errorCode} {resp.errorMessage}')
+            page = []
+            for obj in resp.body.contents:
+                # SDK 返回的是本地时间字符串：%Y/%m/%d %H:%M:%S
+                mtime = time.mktime(time.strptime(obj.lastModified, '%Y/%m/%d %H:%M:%S')) if obj.lastModified else 0
+                page.append((obj.key, obj.size or 0, mtime))
+            if page:
+                yield page
+            if not resp.body.is_truncated:
+                break
+            marker = resp.body.next_marker
 
 
 # 创建对象存储示例
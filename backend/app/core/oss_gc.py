@@ -0,0 +1,44 @@
+"""
+对象存储延迟删除队列：业务只负责把待删除的 key 放入 Redis 集合，由后台任务批量清理
+"""
+
+from .log import logger
+from .minio import oss, url_to_key
+from .redis_client import redis
+
+GC_KEY = 'oss:gc:keys'
+GC_BATCH_SIZE = 1000  # 单次批量删除上限与存储后端保持一致
+
+
+async def enqueue_delete(urls):
+    """待删除的文件地址/key 加入删除队列，Redis 不可用时直接批量删除"""
+    keys = [key for key in {url_to_key(url) for url in urls} if key]
+    if not keys:
+        return 0
+    try:
+        await redis.sadd(GC_KEY, *keys)
+    except Exception as e:
+        logger.error(f'加入删除队列失败，直接删除: {e}')
+        await oss.delete_batch_async(keys)
+    return len(keys)
+
+
+async def sweep():
+    """批量清理删除队列中的对象，失败的 key 放回队列等待下次清理"""
+    total = 0
+    while True:
+        keys = await redis.spop(GC_KEY, GC_BATCH_SIZE)
+        if not keys:
+            break
+        try:
+            ok = await oss.delete_batch_async(keys)
+        except Exception as e:
+            logger.error(f'批量删除对象失败: {e}')
+            ok = False
+        if not ok:
+            await redis.sadd(GC_KEY, *keys)
+            break
+        total += len(keys)
+    if total:
+        logger.info(f'对象存储清理完成，共删除 {total} 个对象')
+    return total
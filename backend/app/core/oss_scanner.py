@@ -0,0 +1,163 @@
+"""
+对象存储巡检：分页遍历桶内对象，与数据库引用逐页比对，统计存储用量并清理孤儿对象
+每页只按当前页的 key 反查数据库，内存占用与桶的大小无关
+"""
+
+import re
+import time
+import json
+from tortoise.expressions import Q
+from models.agent import Profile, Voice, Agent, AgentTemplate
+from models.resource import Ota
+from .config import settings
+from .log import logger
+from .minio import oss, url_to_key
+from .oss_gc import enqueue_delete, sweep
+from .redis_client import redis, acquire_lock, release_lock
+
+USAGE_KEY = 'oss:usage'  # 各前缀用量
+USAGE_USER_KEY = 'oss:usage:user'  # 各用户用量
+SCAN_LOCK_KEY = 'oss:scan:lock'
+SCAN_LOCK_TTL = 3600
+SYSTEM_OWNER = 'system'
+ORPHAN_OWNER = 'orphan'
+
+# 形象相关的 key 中带有形象ID：profile/img/{id}-xxx.png、profile/vid/{id}/xxx.mp4、profile/src/{id}-xxx
+PROFILE_ID_RE = re.compile(r'^profile/\w+/(\d+)[-/]')
+
+
+def _profile_keys(profile):
+    """形象记录引用的全部对象 key"""
+    urls = [profile['ori_img'], profile['gen_img'], profile['profile_vid'], profile['avatar']]
+    for vids in (profile['gen_vids'], profile['sys_vids']):
+        urls += [info.get('url') for info in (vids or {}).values()]
+    # 视频生成中已上传但还未写入 gen_vids 的断点
+    ckpt = profile['gen_ckpt'] or {}
+    urls += [state.get('url') for state in (ckpt.get('emotions') or {}).values()]
+    return {url_to_key(url) for url in urls if url}
+
+
+async def _owners_profile(keys):
+    """profile/ 前缀：按 key 中的形象ID 反查形象记录（含软删除，可恢复）"""
+    ids = {int(m.group(1)) for m in map(PROFILE_ID_RE.match, keys) if m}
+    owners = {}
+    if ids:
+        fields = ['user_id', 'ori_img', 'gen_img', 'profile_vid', 'avatar', 'gen_vids', 'sys_vids', 'gen_ckpt']
+        for profile in await Profile.filter(id__in=ids).values(*fields):
+            for key in _profile_keys(profile) & keys:
+                owners[key] = profile['user_id'] or SYSTEM_OWNER
+    # 智能体头像、智能体模板可能直接引用形象文件
+    rest = keys - owners.keys()
+    if rest:
+        urls = {f'{settings.OSS_BUCKET_URL}/{key}': key for key in rest}
+        for row in await Agent.filter(avatar__in=list(urls)).values('user_id', 'avatar'):
+            owners[urls[row['avatar']]] = row['user_id'] or SYSTEM_OWNER
+        q = Q(profile_img__in=list(urls)) | Q(profile_vid__in=list(urls))
+        for row in await AgentTemplate.filter(q).values('profile_img', 'profile_vid'):
+            for url in (row['profile_img'], row['profile_vid']):
+                if url in urls:
+                    owners[urls[url]] = SYSTEM_OWNER
+    return owners
+
+
+async def _owners_audio(keys):
+    """audio/ 前缀：音色参考音频"""
+    owners = {}
+    refs = list(keys) + [f'{settings.OSS_BUCKET_URL}/{key}' for key in keys]
+    for row in await Voice.filter(ref_audio__in=refs).values('user_id', 'ref_audio'):
+        owners[url_to_key(row['ref_audio'])] = row['user_id'] or SYSTEM_OWNER
+    return owners
+
+
+async def _owners_firmware(keys):
+    """firmware/ 前缀：OTA 固件及差分包"""
+    owners = {}
+    q = Q(ota_url__in=list(keys)) | Q(whole_url__in=list(keys)) | Q(delta_url__in=list(keys))
+    for row in await Ota.filter(q).values('ota_url', 'whole_url', 'delta_url'):
+        for url in (row['ota_url'], row['whole_url'], row['delta_url']):
+            if url in keys:
+                owners[url] = SYSTEM_OWNER
+    return owners
+
+
+# 巡检的前缀及对应的引用查询
+SCAN_PREFIXES = {
+    'profile/img/': _owners_profile,
+    'profile/vid/': _owners_profile,
+    'profile/src/': _owners_profile,
+    'profile/raw/': _owners_profile,  # 直传的原始视频，处理完即删除，残留的都是孤儿
+    'audio/': _owners_audio,
+    'firmware/pro/': _owners_firmware,
+    'firmware/delta/': _owners_firmware,
+    'firmware/raw/': _owners_firmware,  # 直传的原始固件，确认后复制到正式路径即删除，残留的都是孤儿
+}
+
+
+async def scan(dry_run=True, prefixes=None):
+    """
+    巡检对象存储
+    Args:
+        dry_run: 只统计不删除
+        prefixes: 指定巡检的前缀，默认全部
+    Returns:
+        各前缀的用量统计，未获取到巡检锁时返回 None
+    """
+    # 多个 worker 都会跑定时任务，同一时间只允许一个巡检
+    token = await acquire_lock(SCAN_LOCK_KEY, SCAN_LOCK_TTL)
+    if not token:
+        logger.info('对象存储巡检正在进行，跳过')
+        return None
+    try:
+        return await _scan(dry_run, prefixes or list(SCAN_PREFIXES))
+    finally:
+        # 巡检超过锁超时时，锁可能已被其他巡检持有，只释放自己的
+        await release_lock(SCAN_LOCK_KEY, token)
+
+
+async def _scan(dry_run, prefixes):
+    start = time.time()
+    deadline = start - int(settings.OSS_SCAN_GRACE)
+    usage, users = {}, {}
+    for prefix in prefixes:
+        stat = usage[prefix] = {'count': 0, 'size': 0, 'orphan_count': 0, 'orphan_size': 0}
+        async for page in oss.iter_object_pages(prefix):
+            owners = await SCAN_PREFIXES[prefix]({key for key, _, _ in page})
+            orphans = []
+            for key, size, mtime in page:
+                owner = owners.get(key)
+                if owner is None:
+                    stat['orphan_count'] += 1
+                    stat['orphan_size'] += size
+                    # 保护期内的对象可能是刚上传、还没写库的，不清理
+                    if mtime < deadline:
+                        orphans.append(key)
+                    owner = ORPHAN_OWNER
+                stat['count'] += 1
+                stat['size'] += size
+                user = users.setdefault(owner, {'count': 0, 'size': 0})
+                user['count'] += 1
+                user['size'] += size
+            if orphans and not dry_run:
+                await enqueue_delete(orphans)
+        logger.info(f'对象存储巡检 {prefix}: {stat}')
+
+    summary = {'prefixes': usage, 'dry_run': dry_run, 'scanned_at': int(start), 'cost': round(time.time() - start, 1)}
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.set(USAGE_KEY, json.dumps(summary))
+        pipe.delete(USAGE_USER_KEY)
+        if users:
+            pipe.hset(USAGE_USER_KEY, mapping={user: json.dumps(stat) for user, stat in users.items()})
+        await pipe.execute()
+    if not dry_run:
+        await sweep()
+    return summary
+
+
+async def get_usage(user_id=None):
+    """读取最近一次巡检的用量统计"""
+    summary = await redis.get(USAGE_KEY)
+    data = json.loads(summary) if summary else {}
+    if user_id:
+        stat = await redis.hget(USAGE_USER_KEY, user_id)
+        data['user'] = json.loads(stat) if stat else {'count': 0, 'size': 0}
+    return data
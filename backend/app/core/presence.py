@@ -0,0 +1,143 @@
+"""
+设备在线状态：OTA 检查和 MCP 调用都记为一次心跳，按最后心跳时间写入 Redis 有序集合
+- presence:all 记录全部设备，另按智能体、型号、用户分组各建一个有序集合
+- 最后心跳时间在 PRESENCE_TTL 之内视为在线，在线数用 ZCOUNT 按分数区间统计，不需要逐台请求远端
+"""
+
+import time
+from models import Device
+from .config import settings
+from .log import logger
+from .redis_client import redis
+
+ALL_KEY = 'presence:all'  # mac -> 最后心跳时间
+GROUP_KEY = 'presence:{}:{}'  # 分组（agent/model/user）-> mac -> 最后心跳时间
+GROUPS = {'agent': 'agent_id', 'model': 'device_model', 'user': 'user_id'}
+HEARTBEAT_THROTTLE = 10  # 同一设备两次心跳写入的最小间隔（秒）
+SERIAL_CACHE_TTL = 300  # 序列号 -> 设备信息的本地缓存时间（秒）
+
+_last_beat = {}  # mac -> 本进程最后一次写入心跳的时间
+_serial_cache = {}  # serial_number -> (缓存时间, 设备信息)
+
+
+def _group_keys(device):
+    return [GROUP_KEY.format(group, device[field]) for group, field in GROUPS.items() if device.get(field)]
+
+
+async def heartbeat(device):
+    """
+    记录设备心跳
+    Args:
+        device: 设备信息，包含 mac_address、agent_id、device_model、user_id
+    """
+    mac = device.get('mac_address')
+    if not mac:
+        return
+    now = time.time()
+    if now - _last_beat.get(mac, 0) < HEARTBEAT_THROTTLE:
+        return
+    _last_beat[mac] = now
+    try:
+        async with redis.pipeline(transaction=False) as pipe:
+            for key in [ALL_KEY, *_group_keys(device)]:
+                pipe.zadd(key, {mac: now})
+            await pipe.execute()
+    except Exception as e:
+        logger.error(f'记录设备心跳失败: {mac} {e}')
+
+
+async def heartbeat_device(device):
+    """用数据库中的设备记录上报心跳"""
+    await heartbeat({field: getattr(device, field) for field in ('mac_address', *GROUPS.values())})
+
+
+async def heartbeat_serial(serial_number):
+    """MCP 调用只带设备序列号，按序列号查到设备后上报心跳"""
+    if not serial_number:
+        return
+    now = time.time()
+    cached = _serial_cache.get(serial_number)
+    if cached and now - cached[0] < SERIAL_CACHE_TTL:
+        device = cached[1]
+    else:
+        try:
+            rows = await Device.filter(serial_number=serial_number).limit(1).values('mac_address', *GROUPS.values())
+        except Exception as e:
+            logger.error(f'按序列号查询设备失败: {serial_number} {e}')
+            return
+        device = rows[0] if rows else None
+        _serial_cache[serial_number] = (now, device)
+    if device:
+        await heartbeat(device)
+
+
+async def forget(device):
+    """设备解绑或删除时从分组中移除，避免在原智能体、原用户下继续计为在线"""
+    try:
+        async with redis.pipeline(transaction=False) as pipe:
+            for key in _group_keys({field: getattr(device, field) for field in GROUPS.values()}):
+                pipe.zrem(key, device.mac_address)
+            await pipe.execute()
+    except Exception as e:
+        logger.error(f'移除设备在线状态失败: {device.mac_address} {e}')
+    _last_beat.pop(device.mac_address, None)
+
+
+def _online_since():
+    return time.time() - int(settings.PRESENCE_TTL)
+
+
+async def online_count(agent_id=None, device_model=None, user_id=None):
+    """在线设备数，指定多个条件时分别统计"""
+    filters = {'agent': agent_id, 'model': device_model, 'user': user_id}
+    keys = {group: GROUP_KEY.format(group, value) for group, value in filters.items() if value}
+    keys = keys or {'all': ALL_KEY}
+    since = _online_since()
+    async with redis.pipeline(transaction=False) as pipe:
+        for key in keys.values():
+            pipe.zcount(key, since, '+inf')
+        counts = await pipe.execute()
+    return dict(zip(keys, counts))
+
+
+async def online_map(mac_addresses):
+    """
+    批量查询设备在线状态
+    Returns:
+        mac -> (是否在线, 最后心跳时间戳)
+    """
+    macs = [mac for mac in mac_addresses if mac]
+    if not macs:
+        return {}
+    scores = await redis.zmscore(ALL_KEY, macs)
+    since = _online_since()
+    return {
+        mac: (score is not None and score >= since, int(score) if score else None) for mac, score in zip(macs, scores)
+    }
+
+
+async def prune():
+    """清理长时间没有心跳的记录，分组集合按需清理"""
+    since = _online_since()
+    expired = time.time() - int(settings.PRESENCE_RETAIN)
+    removed = await redis.zremrangebyscore(ALL_KEY, '-inf', expired)
+    cursor = 0
+    while True:
+        cursor, keys = await redis.scan(cursor, match='presence:*:*', count=500)
+        if keys:
+            async with redis.pipeline(transaction=False) as pipe:
+                for key in keys:
+                    # 分组只用于统计在线数，离线的成员直接清理
+                    pipe.zremrangebyscore(key, '-inf', since)
+                await pipe.execute()
+        if not cursor:
+            break
+    # 本进程的节流记录同步清理，避免常驻内存无限增长
+    for mac, beat in list(_last_beat.items()):
+        if beat < since:
+            _last_beat.pop(mac, None)
+    for serial, (cached_at, _) in list(_serial_cache.items()):
+        if time.time() - cached_at >= SERIAL_CACHE_TTL:
+            _serial_cache.pop(serial, None)
+    if removed:
+        logger.info(f'清理设备心跳记录 {removed} 条')
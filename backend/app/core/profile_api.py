@@ -7,6 +7,7 @@ import os
 from PIL import Image
 from openai import AsyncOpenAI
 from models.agent import Profile
+from models.finance import Gift
 from models.enums import GiftType
 from controllers.finance import product_controller, gift_controller
 from .config import settings
@@ -76,13 +77,13 @@ class BailianService:
     def validate_image_size(self, img_bytes, min_dim=384, max_dim=5000):
         """
         验证图片尺寸是否满足百炼API要求
-        :param img_bytes: 图片字节数据
+        :param img_bytes: 图片字节数据或文件对象（只读取图片头）
         :param min_dim: 最小边尺寸要求
         :param max_dim: 最大边尺寸要求
         :return: (True, None)表示验证通过，(False, 错误信息)表示验证失败
         """
         try:
-            img = Image.open(io.BytesIO(img_bytes))
+            img = Image.open(img_bytes if hasattr(img_bytes, 'read') else io.BytesIO(img_bytes))
             width, height = img.size
             min_side = min(width, height)
             max_side = max(width, height)
@@ -166,29 +167,39 @@ class BailianService:
             logger.error(f'百炼返回数据错误: {e}')
             return None, '百炼返回数据错误'
 
-    async def generate_video(self, img_url, subject_type, emotion='normal'):
+    async def generate_video(self, img_url, subject_type, emotion='normal', task_id=None, on_submit=None):
         """
         生成视频
         :param img_url: 图片地址
         :param emotion: 情绪类型
+        :param task_id: 已提交过的百炼任务ID，传入时直接轮询结果而不重新提交
+        :param on_submit: 任务提交成功后的回调 async (task_id) -> None，用于记录断点
         """
         vid_prompt = vid_prompts[subject_type]
         prompt = '\n'.join([vid_prompt['background'], vid_prompt['action'].get(emotion, '')])
 
         max_attempts = 3  # 最大重试次数
         attempt = 1
+        last_task_id, task_status = task_id, None
 
         while attempt <= max_attempts:
-            logger.info(f'百炼视频生成: {emotion} 第{attempt}次尝试')
-
-            task_id, task_status = await self.post_generate_video(prompt, img_url)
-            if not task_id:
-                if attempt >= max_attempts:
-                    return None, '百炼视频生成任务创建失败'
-                logger.warning(f'任务创建失败，等待后重试 [{attempt}/{max_attempts}]')
-                await asyncio.sleep(2)
-                attempt += 1
-                continue
+            if task_id:
+                # 续跑：百炼任务已提交过，直接轮询，避免重复计费
+                logger.info(f'百炼视频生成: {emotion} 续跑已提交任务 {task_id}')
+                task_status = 'PENDING'
+            else:
+                logger.info(f'百炼视频生成: {emotion} 第{attempt}次尝试')
+                task_id, task_status = await self.post_generate_video(prompt, img_url)
+                if not task_id:
+                    if attempt >= max_attempts:
+                        return None, '百炼视频生成任务创建失败'
+                    logger.warning(f'任务创建失败，等待后重试 [{attempt}/{max_attempts}]')
+                    await asyncio.sleep(2)
+                    attempt += 1
+                    continue
+                if on_submit:
+                    await on_submit(task_id)
+            last_task_id = task_id
 
             # 轮询获取结果
             max_retries = 40  # 最多等待400秒
@@ -203,91 +214,161 @@ class BailianService:
                 return video_url, 'success'
 
             logger.error(f'百炼视频生成失败: {task_id} {task_status} [{attempt}/{max_attempts}]')
+            task_id = None  # 下一次尝试重新提交任务
             await asyncio.sleep(5)
             attempt += 1
-        return None, f'百炼视频生成超时或失败: {task_id} {task_status}'
+        return None, f'百炼视频生成超时或失败: {last_task_id} {task_status}'
+
+    async def _save_checkpoint(self, profile_id, ckpt):
+        """持久化视频生成断点"""
+        await Profile.filter(id=profile_id).update(gen_ckpt=ckpt)
+
+    async def _generate_emotion(self, profile_id, img_url, subject_type, emotion, state, save):
+        """
+        单个情绪视频的完整流程：提交/轮询 -> 下载 -> 转换尺寸 -> 上传OSS，每完成一步记录断点
+        :param state: 该情绪的断点字典，step 依次为 submitted / generated / uploaded，失败为 failed
+        :param save: 持久化断点的回调
+        """
+        if state.get('step') in ('uploaded', 'failed'):
+            logger.info(f'{profile_id} 情绪 {emotion} 已完成（{state["step"]}），跳过')
+            return
+
+        if state.get('step') != 'generated':
 
-    async def generate_and_save(self, profile_id, img_url, subject_type, batch_size=2):
+            async def on_submit(task_id):
+                state.update(step='submitted', task_id=task_id)
+                await save()
+
+            try:
+                video_url, msg = await self.generate_video(
+                    img_url, subject_type, emotion, task_id=state.get('task_id'), on_submit=on_submit
+                )
+            except Exception as e:
+                logger.error(f'生成情绪 {emotion} 的视频时发生异常: {e}')
+                video_url, msg = None, str(e)
+            if not video_url:
+                state.update(step='failed', msg=msg)
+                await save()
+                return
+            state.update(step='generated', video_url=video_url)
+            await save()
+
+        # 下载视频并上传到 OSS（百炼返回的视频地址有效期24小时，足够覆盖任务重试）
+        video_key = f'profile/vid/{profile_id}/{emotion}.mp4'
+        video_data, content_type = await self.download_file(state['video_url'], 'video/mp4')
+        if not video_data:
+            raise Exception(f'下载视频失败: {emotion}')
+        resized_data = await resize_video_in_memory(video_data)
+        if not resized_data:
+            logger.error(f'视频转换失败: {emotion}')
+            state.update(step='failed', msg='视频转换失败')
+            await save()
+            return
+        upload_result = await oss.upload_file_async(video_key, file_data=resized_data, content_type=content_type)
+        if not upload_result:
+            logger.error(f'视频上传失败: {emotion}')
+            state.update(step='failed', msg='上传到OSS失败')
+            await save()
+            return
+        state.update(
+            step='uploaded',
+            key=video_key,
+            url=f'{settings.OSS_BUCKET_URL}/{video_key}',
+            hash=hashlib.sha256(resized_data).hexdigest(),
+        )
+        await save()
+
+    async def generate_and_save(self, profile_id, img_url, subject_type, batch_size=2, job_id=None, final_attempt=True):
+        """
+        批量生成情绪视频并保存，按情绪记录断点到 Profile.gen_ckpt
+        :param job_id: celery 任务ID，同一任务重试/重新投递时从断点续跑，新任务则重新开始
+        :param final_attempt: 是否为最后一次尝试，非最后一次时异常直接抛出交给 celery 重试
+        """
         # 获取形象
         profile = await Profile.get(id=profile_id)
         # 获取所有情绪类型
         emotions = list(vid_prompts[subject_type]['action'].keys())
-        results = {}
+        ckpt = profile.gen_ckpt or {}
+        if not job_id or ckpt.get('job_id') != job_id:
+            ckpt = {'job_id': job_id, 'emotions': {}, 'compensated': False}
+        elif ckpt.get('compensated'):
+            logger.info(f'{profile_id} 视频生成任务 {job_id} 已完成，跳过')
+            return
+        else:
+            logger.info(f'{profile_id} 从断点续跑视频生成任务 {job_id}: {ckpt["emotions"]}')
+        states = ckpt['emotions']
+        for emotion in emotions:
+            states.setdefault(emotion, {})
+
+        async def save():
+            await self._save_checkpoint(profile_id, ckpt)
+
+        status = 'success'
         try:
+            await save()
             # 分批处理情绪视频生成任务
             for i in range(0, len(emotions), batch_size):
                 batch_emotions = emotions[i : i + batch_size]
                 logger.info(f'正在处理情绪批次: {batch_emotions}')
-                # 创建当前批次的任务
-                batch_tasks = [self.generate_video(img_url, subject_type, emotion) for emotion in batch_emotions]
+                batch_tasks = [
+                    self._generate_emotion(profile_id, img_url, subject_type, emotion, states[emotion], save)
+                    for emotion in batch_emotions
+                ]
                 batch_results = await asyncio.gather(*batch_tasks, return_exceptions=True)
-                # 处理当前批次的结果
-                for j, result in enumerate(batch_results):
-                    emotion = batch_emotions[j]
-                    # 处理可能的异常情况
+                # 非预期异常（网络、数据库等）直接抛出，交给 celery 重试并从断点续跑
+                for result in batch_results:
                     if isinstance(result, Exception):
-                        logger.error(f'生成情绪 {emotion} 的视频时发生异常: {result}')
-                        results[emotion] = {'url': None, 'status': 'failed', 'msg': str(result)}
-                        continue
-                    video_url, status = result
-                    if status == 'success':
-                        results[emotion] = {'url': video_url, 'status': 'success', 'msg': ''}
-                    else:
-                        results[emotion] = {'url': None, 'status': 'failed', 'msg': status}
+                        raise result
                 # 在批次之间增加延迟以减少API压力
                 if i + batch_size < len(emotions):
                     await asyncio.sleep(1)
-            # 下载视频并上传到 OSS
-            for emotion, info in results.items():
-                if info['status'] == 'success' and info['url']:
-                    video_key = f'profile/vid/{profile_id}/{emotion}.mp4'
-                    video_data, content_type = await self.download_file(info['url'], 'video/mp4')
-                    if video_data:
-                        # 转换视频尺寸
-                        resized_data = await resize_video_in_memory(video_data)
-                        if not resized_data:
-                            logger.error(f'视频转换失败: {emotion}')
-                            info['url'] = ''
-                            info['hash'] = ''
-                            info['status'] = 'failed'
-                            info['msg'] = '视频转换失败'
-                            continue
-                        upload_result = await oss.upload_file_async(
-                            video_key, file_data=resized_data, content_type=content_type
-                        )
-                        if upload_result:
-                            info['url'] = f'{settings.OSS_BUCKET_URL}/{video_key}'
-                            info['hash'] = hashlib.sha256(resized_data).hexdigest()
-                        else:
-                            logger.error(f'视频上传失败: {emotion}')
-                            info['url'] = ''
-                            info['hash'] = ''
-                            info['status'] = 'failed'
-                            info['msg'] = '上传到OSS失败'
-            profile.gen_vids = results
-            profile.status = 'success'
-            await profile.save(update_fields=['gen_vids', 'status'])
-            logger.info(f'{profile_id} 百炼视频生成结果已保存')
         except Exception as e:
-            logger.error(f'{profile_id} 百炼视频生成结果保存失败: {e}')
-            # 如果出现异常，仍然尝试更新数据库状态
-            profile.status = 'failed'
-            await profile.save(update_fields=['status'])
-        finally:
-            # 计算视频成功数量
-            success_count = sum(1 for info in results.values() if info.get('status') == 'success')
-            failed_count = len(emotions) - success_count
-            logger.info(f'{profile_id} 百炼视频生成结果: 成功 {success_count} 失败 {failed_count}')
-            # 积分补偿
-            if failed_count > 0:
-                product = await product_controller.get_by_key('single_vid_create')
-                points = product.points_price * failed_count
-                await gift_controller.create_gift(
-                    user_id=profile.user_id,
-                    points=points,
-                    gift_type=GiftType.COMPENSATION,
-                    note=f'百炼视频生成 {failed_count} 个失败，积分补偿',
-                )
+            logger.error(f'{profile_id} 百炼视频生成中断: {e}')
+            if not final_attempt:
+                # 交给 celery 重试，已完成的情绪不会重复生成
+                raise
+            status = 'failed'
+
+        results = {}
+        for emotion in emotions:
+            state = states[emotion]
+            if state.get('step') == 'uploaded':
+                results[emotion] = {'url': state['url'], 'hash': state['hash'], 'status': 'success', 'msg': ''}
+            else:
+                results[emotion] = {'url': '', 'hash': '', 'status': 'failed', 'msg': state.get('msg', '')}
+        profile.gen_vids = results
+        profile.status = status
+        await profile.save(update_fields=['gen_vids', 'status'])
+        logger.info(f'{profile_id} 百炼视频生成结果已保存')
+
+        # 计算视频成功数量
+        success_count = sum(1 for info in results.values() if info.get('status') == 'success')
+        failed_count = len(emotions) - success_count
+        logger.info(f'{profile_id} 百炼视频生成结果: 成功 {success_count} 失败 {failed_count}')
+        # 积分补偿：补偿前先记下标记，备注带上任务ID；重试/重新投递时标记已存在则按备注查是否已补偿过
+        if failed_count > 0 and not await self._compensation_exists(profile.user_id, ckpt):
+            ckpt['compensating'] = True
+            await save()
+            product = await product_controller.get_by_key('single_vid_create')
+            points = product.points_price * failed_count
+            note = f'百炼视频生成 {failed_count} 个失败，积分补偿'
+            await gift_controller.create_gift(
+                user_id=profile.user_id,
+                points=points,
+                gift_type=GiftType.COMPENSATION,
+                note=f'{note}（任务 {job_id}）' if job_id else note,
+            )
+        ckpt['compensated'] = True
+        await save()
+
+    @staticmethod
+    async def _compensation_exists(user_id, ckpt):
+        """上次执行已开始补偿时，按任务ID查找补偿记录"""
+        if not ckpt.get('compensating') or not ckpt.get('job_id'):
+            return False
+        return await Gift.filter(
+            user_id=user_id, gift_type=GiftType.COMPENSATION, note__contains=ckpt['job_id']
+        ).exists()
 
     async def generate_and_save_test(self, profile_id, img_url, subject_type, batch_size=2):
         # 获取所有情绪类型
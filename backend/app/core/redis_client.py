@@ -1,3 +1,4 @@
+import uuid
 from redis.asyncio import Redis, ConnectionPool
 from .config import settings
 from .log import logger
@@ -13,6 +14,31 @@ pool = ConnectionPool(
 
 redis = Redis(connection_pool=pool)
 
+# 值与加锁时写入的令牌一致才删除，锁超时后被其他进程获取的不会误删
+RELEASE_LOCK_SCRIPT = redis.register_script(
+    """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+)
+
+
+async def acquire_lock(key: str, ttl: int) -> str | None:
+    """
+    获取锁
+    Returns:
+        释放锁用的令牌，锁已被占用时返回 None
+    """
+    token = uuid.uuid4().hex
+    return token if await redis.set(key, token, ex=ttl, nx=True) else None
+
+
+async def release_lock(key: str, token: str) -> bool:
+    """释放自己持有的锁"""
+    return bool(await RELEASE_LOCK_SCRIPT(keys=[key], args=[token]))
+
 
 async def get_cache(key: str):
     try:
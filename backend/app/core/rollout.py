@@ -0,0 +1,124 @@
+"""
+OTA 灰度发布引擎
+- 每个型号的默认固件和进行中的灰度发布缓存在内存表中，/ota 接口按型号直接查表，不查数据库
+- 按 salt + MAC 的稳定哈希分桶（0-99），桶号小于灰度比例的设备下发目标版本，调大比例时已命中的设备保持命中
+- 下发目标版本后记录设备的原版本，下次上报的版本等于目标版本记为成功，否则记为失败
+- 失败率超过阈值自动暂停灰度
+"""
+
+import time
+import hashlib
+from models import Ota, OtaRollout
+from .config import settings
+from .log import logger
+from .redis_client import redis
+
+OFFERS_KEY = 'ota:rollout:{}:offers'  # 已下发目标版本、等待结果的设备：mac -> 原版本
+STATS_KEY = 'ota:rollout:{}:stats'  # 下发、成功、失败计数
+
+
+def cohort_bucket(salt, mac_address):
+    """设备在灰度中的分桶号（0-99），同一个灰度内保持不变"""
+    digest = hashlib.sha256(f'{salt}:{mac_address}'.encode()).digest()
+    return int.from_bytes(digest[:8], 'big') % 100
+
+
+class RolloutEngine:
+    def __init__(self):
+        self.defaults = {}  # device_model -> 默认 Ota
+        self.rollouts = {}  # device_model -> (OtaRollout, 目标 Ota)
+        self.refreshed_at = 0
+
+    async def refresh(self):
+        """从数据库重新加载内存表，并把 Redis 中的计数同步到数据库"""
+        defaults = {}
+        for obj in await Ota.filter(is_default=True).order_by('id'):
+            defaults[obj.device_model] = obj
+        rollouts = {}
+        objs = await OtaRollout.filter(status__in=['active', 'paused'])
+        targets = {obj.id: obj for obj in await Ota.filter(id__in=[r.ota_id for r in objs])}
+        for rollout in objs:
+            target = targets.get(rollout.ota_id)
+            if not target:
+                continue
+            await self._sync_stats(rollout)
+            if rollout.status == 'active':
+                rollouts[rollout.device_model] = (rollout, target)
+        self.defaults, self.rollouts = defaults, rollouts
+        self.refreshed_at = time.time()
+
+    async def _sync_stats(self, rollout):
+        stats = await redis.hgetall(STATS_KEY.format(rollout.id))
+        if not stats:
+            return
+        rollout.offered = int(stats.get('offered', 0))
+        rollout.succeeded = int(stats.get('succeeded', 0))
+        rollout.failed = int(stats.get('failed', 0))
+        await OtaRollout.filter(id=rollout.id).update(
+            offered=rollout.offered, succeeded=rollout.succeeded, failed=rollout.failed
+        )
+        await self._check_halt(rollout)
+
+    async def _check_halt(self, rollout):
+        """失败率超过阈值时暂停灰度"""
+        total = rollout.succeeded + rollout.failed
+        if rollout.status != 'active' or total < rollout.min_samples:
+            return
+        rate = rollout.failed / total
+        if rate <= rollout.fail_threshold:
+            return
+        reason = f'失败率 {rate:.1%} 超过阈值 {rollout.fail_threshold:.1%}（成功 {rollout.succeeded}，失败 {rollout.failed}）'
+        rollout.status = 'halted'
+        rollout.halt_reason = reason
+        await OtaRollout.filter(id=rollout.id).update(status='halted', halt_reason=reason)
+        self.rollouts.pop(rollout.device_model, None)
+        logger.error(f'OTA灰度自动暂停: {rollout.device_model} {rollout.app_version} {reason}')
+
+    async def observe(self, mac_address, device_model, app_version):
+        """设备上报版本：之前下发过目标版本的设备，根据本次上报的版本判定升级结果"""
+        item = self.rollouts.get(device_model)
+        if not item:
+            return
+        rollout, _ = item
+        offers_key = OFFERS_KEY.format(rollout.id)
+        from_version = await redis.hget(offers_key, mac_address)
+        # 本次上报的还是原版本说明下发后下次检查时仍未升级，视为失败；上报其他版本（比如手动刷机）不计入
+        if from_version is None or (app_version != rollout.app_version and app_version != from_version):
+            return
+        if not await redis.hdel(offers_key, mac_address):
+            return
+        field = 'succeeded' if app_version == rollout.app_version else 'failed'
+        count = await redis.hincrby(STATS_KEY.format(rollout.id), field, 1)
+        setattr(rollout, field, count)
+        if field == 'failed':
+            await self._check_halt(rollout)
+
+    async def decide(self, mac_address, device_model, app_version):
+        """
+        决定下发给设备的固件
+        Returns:
+            Ota，没有可用固件时返回 None
+        """
+        item = self.rollouts.get(device_model)
+        if item:
+            rollout, target = item
+            if app_version == rollout.app_version:
+                return target
+            if cohort_bucket(rollout.salt, mac_address) < rollout.percentage:
+                # 只记录第一次下发时的原版本，重复检查不重复计数
+                if await redis.hsetnx(OFFERS_KEY.format(rollout.id), mac_address, app_version):
+                    await redis.hincrby(STATS_KEY.format(rollout.id), 'offered', 1)
+                return target
+        return self.defaults.get(device_model)
+
+    async def reset(self, rollout_id):
+        """删除灰度的计数和待判定设备"""
+        await redis.delete(OFFERS_KEY.format(rollout_id), STATS_KEY.format(rollout_id))
+
+    async def ensure_fresh(self):
+        """内存表超过刷新间隔未更新时重新加载（定时任务之外的兜底）"""
+        if time.time() - self.refreshed_at > int(settings.OTA_ROLLOUT_REFRESH) * 2:
+            await self.refresh()
+
+
+rollout_engine = RolloutEngine()
@@ -0,0 +1,90 @@
+"""
+设备上报信息延迟写库：OTA 检查时上报的芯片、型号、版本和最后在线时间先写入 Redis，后台定期批量写库
+- 上报的信息与数据库一致、且最后在线时间未超过记录粒度时直接跳过，开机高峰时大部分请求不产生写库
+- 同一设备在一个写库周期内多次上报只保留最后一次
+"""
+
+import json
+from datetime import datetime
+from tortoise import timezone
+from models import Device
+from .config import settings
+from .log import logger
+from .redis_client import redis
+
+PENDING_KEY = 'device:telemetry:pending'  # 待写库的设备：mac -> 上报信息
+TELEMETRY_FIELDS = ('chip_type', 'device_model', 'app_version')
+FLUSH_BATCH_SIZE = 500
+
+
+async def record(device, **reported):
+    """
+    记录设备上报的信息
+    Args:
+        device: 数据库中的设备记录
+        reported: chip_type/device_model/app_version
+    Returns:
+        是否需要写库
+    """
+    now = timezone.now()
+    changed = any(getattr(device, field) != reported.get(field) for field in TELEMETRY_FIELDS)
+    seen_at = device.last_seen_at
+    if not changed and seen_at and (now - seen_at).total_seconds() < int(settings.TELEMETRY_SEEN_RESOLUTION):
+        return False
+    state = {field: reported.get(field) for field in TELEMETRY_FIELDS}
+    state['last_seen_at'] = now.isoformat()
+    try:
+        await redis.hset(PENDING_KEY, device.mac_address, json.dumps(state))
+    except Exception as e:
+        # Redis 不可用时退回直接写库
+        logger.error(f'设备上报信息写入缓冲失败，直接写库: {device.mac_address} {e}')
+        await Device.filter(id=device.id).update(**{**state, 'last_seen_at': now, 'update_at': now})
+    return True
+
+
+async def flush():
+    """把缓冲中的设备上报信息批量写库，写库失败的放回缓冲等待下次写入"""
+    # 取出和删除放在同一个事务中，多个 worker 同时执行时每条记录只会被取走一次
+    async with redis.pipeline(transaction=True) as pipe:
+        pipe.hgetall(PENDING_KEY)
+        pipe.delete(PENDING_KEY)
+        pending, _ = await pipe.execute()
+    if not pending:
+        return 0
+    total = 0
+    macs = list(pending)
+    for i in range(0, len(macs), FLUSH_BATCH_SIZE):
+        batch = {mac: json.loads(pending[mac]) for mac in macs[i : i + FLUSH_BATCH_SIZE]}
+        try:
+            total += await _flush_batch(batch)
+        except Exception as e:
+            logger.error(f'设备上报信息写库失败: {e}')
+            # 已有更新的上报时保留更新的
+            async with redis.pipeline(transaction=False) as pipe:
+                for mac, state in batch.items():
+                    pipe.hsetnx(PENDING_KEY, mac, json.dumps(state))
+                await pipe.execute()
+    if total:
+        logger.info(f'设备上报信息写库完成，共更新 {total} 台设备')
+    return total
+
+
+async def _flush_batch(batch):
+    now = timezone.now()
+    changed, seen = [], []
+    for device in await Device.filter(mac_address__in=list(batch)):
+        state = batch.get(device.mac_address)
+        if not state:
+            continue
+        device.last_seen_at = datetime.fromisoformat(state['last_seen_at'])
+        if any(getattr(device, field) != state.get(field) for field in TELEMETRY_FIELDS):
+            # bulk_update 不会自动更新 auto_now 字段
+            device.update_from_dict({**{field: state.get(field) for field in TELEMETRY_FIELDS}, 'update_at': now})
+            changed.append(device)
+        else:
+            seen.append(device)
+    if changed:
+        await Device.bulk_update(changed, fields=[*TELEMETRY_FIELDS, 'last_seen_at', 'update_at'])
+    if seen:
+        await Device.bulk_update(seen, fields=['last_seen_at'])
+    return len(changed) + len(seen)
@@ -0,0 +1,58 @@
+"""
+客户端直传对象存储：申请上传凭证 -> 客户端用预签名地址 PUT 到桶 -> 确认上传
+上传凭证存在 Redis，确认时校验归属、文件是否已上传以及大小，文件内容不经过 API 进程
+"""
+
+import json
+import uuid
+from .background import CTX_USER_ID
+from .config import settings
+from .minio import oss
+from .oss_gc import enqueue_delete
+from .redis_client import redis
+
+SLOT_KEY = 'upload:slot:{}'
+
+
+async def create_slot(key, kind, max_size, content_type=None, **meta):
+    """
+    申请上传凭证
+    Args:
+        key: 上传到的对象 key
+        kind: 上传类型，确认时用于区分后续处理
+        max_size: 文件大小上限（字节）
+        content_type: 文件类型，参与签名
+        meta: 后续处理需要的其他信息
+    """
+    expires = int(settings.UPLOAD_SLOT_EXPIRES)
+    presigned = await oss.presign_upload_async(key, expires, content_type)
+    slot_id = uuid.uuid4().hex
+    slot = {'key': key, 'kind': kind, 'max_size': max_size, 'user_id': CTX_USER_ID.get(), **meta}
+    # 凭证比预签名地址多保留一段时间，上传快结束时地址过期也能确认
+    await redis.set(SLOT_KEY.format(slot_id), json.dumps(slot), ex=expires + 600)
+    return {'slot_id': slot_id, 'key': key, 'expires': expires, 'max_size': max_size, **presigned}
+
+
+async def finalize_slot(slot_id, kind):
+    """
+    确认上传，凭证只能使用一次
+    Returns:
+        (slot, msg)，校验失败时 slot 为 None
+    """
+    raw = await redis.get(SLOT_KEY.format(slot_id))
+    if not raw:
+        return None, '上传凭证不存在或已过期'
+    slot = json.loads(raw)
+    if slot['kind'] != kind or slot['user_id'] != CTX_USER_ID.get():
+        return None, '上传凭证无效'
+    size = await oss.get_size_async(slot['key'])
+    if size is None:
+        return None, '文件未上传'
+    # 删除成功的请求才能继续处理，避免重复确认
+    if not await redis.delete(SLOT_KEY.format(slot_id)):
+        return None, '上传凭证已使用'
+    if size > slot['max_size']:
+        await enqueue_delete([slot['key']])
+        return None, '文件超过大小限制'
+    slot['size'] = size
+    return slot, ''
@@ -1,7 +1,10 @@
 import uuid
 import asyncio
+import hashlib
+import shutil
 import subprocess
 import os
+from contextlib import asynccontextmanager
 from .log import logger
 
 
@@ -58,3 +61,48 @@ async def resize_video_in_memory(video_data, width=720, height=1440):
             os.unlink(tmp_input_path)
         if os.path.exists(tmp_output_path):
             os.unlink(tmp_output_path)
+
+
+def stream_digest(fileobj, algorithm='sha256', chunk_size=1024 * 1024):
+    """分块计算文件对象的摘要，计算完成后指针回到开头"""
+    digest = hashlib.new(algorithm)
+    fileobj.seek(0)
+    while chunk := fileobj.read(chunk_size):
+        digest.update(chunk)
+    fileobj.seek(0)
+    return digest.hexdigest()
+
+
+def file_digest(file_path, algorithm='sha256', chunk_size=1024 * 1024):
+    """分块计算磁盘文件的摘要"""
+    with open(file_path, 'rb') as f:
+        return stream_digest(f, algorithm, chunk_size)
+
+
+async def save_upload_file(upload_file, save_path, chunk_size=1024 * 1024):
+    """把 UploadFile 分块写入磁盘，避免整个文件读进内存"""
+    await upload_file.seek(0)
+
+    def _copy():
+        with open(save_path, 'wb') as f:
+            shutil.copyfileobj(upload_file.file, f, chunk_size)
+
+    await asyncio.to_thread(_copy)
+
+
+@asynccontextmanager
+async def resized_video_file(upload_file, width=720, height=1440):
+    """
+    把上传的视频落盘后转换尺寸，产出转换后的临时文件路径（转换失败为 None），退出时清理临时文件
+    用法：async with resized_video_file(file) as path: ...
+    """
+    unique_id = str(uuid.uuid4())
+    tmp_input_path = f'/tmp/video_input_{unique_id}.mp4'
+    tmp_output_path = f'/tmp/video_output_{unique_id}.mp4'
+    try:
+        await save_upload_file(upload_file, tmp_input_path)
+        yield await resize_video(tmp_input_path, tmp_output_path, width, height)
+    finally:
+        for path in (tmp_input_path, tmp_output_path):
+            if os.path.exists(path):
+                os.unlink(path)
@@ -18,25 +18,27 @@ class XZService:
             logger.error(f'获取XZ API TOKEN失败，正在重试 {i+1}...')
         raise Exception('获取XZ API TOKEN失败，多次重试后无法完成初始化')
 
-    async def _make_request(self, method, url, **kwargs):
-        """通用HTTP请求方法"""
+    async def _make_request(self, method, url, session=None, **kwargs):
+        """通用HTTP请求方法，批量请求时传入共享的 session 复用连接"""
+        if session is None:
+            async with aiohttp.ClientSession() as session:
+                return await self._make_request(method, url, session=session, **kwargs)
         max_retries = 2  # token失效时最多重试1次
         for attempt in range(max_retries):
             try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.request(method, url, headers=self.headers, **kwargs) as response:
-                        if response.status == 401:
-                            data = await response.json()
-                            logger.warning('Token失效，正在重新获取...')
-                            await self.init_headers()
-                            if attempt < max_retries - 1:
-                                continue  # 重新发起请求
-                        # if response.status != 200:
-                        #     logger.error(f'请求失败 [{method} {url}]: {response.status}')
-                        #     return None
+                async with session.request(method, url, headers=self.headers, **kwargs) as response:
+                    if response.status == 401:
                         data = await response.json()
-                        logger.info(f'请求成功 [{method} {url}]: {data}')
-                        return data
+                        logger.warning('Token失效，正在重新获取...')
+                        await self.init_headers()
+                        if attempt < max_retries - 1:
+                            continue  # 重新发起请求
+                    # if response.status != 200:
+                    #     logger.error(f'请求失败 [{method} {url}]: {response.status}')
+                    #     return None
+                    data = await response.json()
+                    logger.info(f'请求成功 [{method} {url}]: {data}')
+                    return data
             except Exception as e:
                 logger.error(f'请求失败 [{method} {url}]: {e}')
                 return None
@@ -298,11 +300,26 @@ class XZService:
         url = f'{self.base_url}/api/developers/mcp-endpoints/{endpoint_id}'
         return await self._make_request('DELETE', url)
 
-    async def push_message(self, serial_number, message={}):
+    async def push_message(self, serial_number, message={}, session=None):
         """推送消息"""
         url = f'{self.base_url}/api/messaging/push'
         data = {'serial_number': serial_number, 'message': message}
-        return await self._make_request('POST', url, json=data)
+        return await self._make_request('POST', url, session=session, json=data)
+
+    async def push_messages(self, messages, concurrency=None):
+        """
+        批量推送消息：共享一个连接池并发推送，同时进行的请求数不超过 concurrency
+        Args:
+            messages: [(serial_number, message)]
+        Returns:
+            与 messages 顺序一致的推送结果，失败为 None
+        """
+        concurrency = max(int(concurrency or settings.ALARM_PUSH_CONCURRENCY), 1)
+        connector = aiohttp.TCPConnector(limit=concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            return await asyncio.gather(
+                *(self.push_message(serial_number, message, session=session) for serial_number, message in messages)
+            )
 
 
 xz_service = XZService()
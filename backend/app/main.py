@@ -14,16 +14,8 @@ from fastapi import FastAPI
 from fastapi.openapi.docs import get_swagger_ui_html
 from fastapi.staticfiles import StaticFiles
 from tortoise import Tortoise
-from core.init_app import (
-    init_data,
-    make_middlewares,
-    register_exceptions,
-    register_routers,
-    check_mcp_status_periodically,
-)
 from core.config import settings
 from core.log import logger
-from core.background import setup_scheduler
 
 
 class InterceptHandler(logging.Handler):
@@ -40,11 +32,19 @@ for name in ('uvicorn', 'uvicorn.access'):
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    from core.init_app import init_data, init_mcps
+    from core.background import setup_scheduler
+    from core.mcp_transport import close_session as close_mcp_session
+    from core.mcp_supervisor import mcp_supervisor
+    from core.mcp_events import run_writer as run_mcp_status_writer
+
     # 1. 应用启动前的操作
     await init_data(app)
     scheduler = setup_scheduler()  # 设置定时任务调度器
-    # 启动 MCP 状态检查后台任务
-    check_task = asyncio.create_task(check_mcp_status_periodically())
+    await mcp_supervisor.start()  # 多 worker 时按哈希分配 MCP 接入点
+    mcp_supervisor.restore(init_mcps)  # 后台同步并恢复 MCP 连接，不阻塞服务就绪
+    # MCP 状态变化事件合并写库
+    status_task = asyncio.create_task(run_mcp_status_writer())
 
     # 2. yield 表示应用正常运行阶段
     yield
@@ -53,16 +53,21 @@ async def lifespan(app: FastAPI):
     # 取消后台任务
     if scheduler:
         scheduler.shutdown()
-    check_task.cancel()
+    status_task.cancel()
     try:
-        await check_task
+        await status_task
     except asyncio.CancelledError:
         pass
+    await mcp_supervisor.stop()
+    await close_mcp_session()
 
     await Tortoise.close_connections()
 
 
 def create_app() -> FastAPI:
+    # 应用依赖的模块在导入时会连接对象存储等，放在这里导入，spawn 子进程重新导入本文件时不会加载
+    from core.init_app import make_middlewares, register_exceptions, register_routers
+
     app = FastAPI(
         title=settings.APP_TITLE,  # 设置 API 文档的标题
         description=settings.APP_DESCRIPTION,
@@ -89,7 +94,9 @@ def create_app() -> FastAPI:
     return app
 
 
-app = create_app()
+# 音频进程池等以 spawn 启动的子进程会把启动脚本作为 __mp_main__ 重新导入，子进程中不创建应用
+if __name__ != '__mp_main__':
+    app = create_app()
 
 if __name__ == '__main__':
     uvicorn.run(app, host='0.0.0.0', port=settings.BACK_END_PORT, reload=False, log_level='info', log_config=None)
@@ -92,6 +92,7 @@ class Profile(BaseModel, TimestampMixin):
     avatar = fields.TextField(null=True, description='头像')
     deleted_at = fields.DatetimeField(null=True, index=True, description='软删除时间')
     task_id = fields.CharField(max_length=64, null=True, index=True, description='celery任务ID')
+    gen_ckpt = fields.JSONField(null=True, description='视频生成断点：各情绪的百炼任务ID、视频地址和上传key')
 
 
 # 系统提示词表
@@ -128,6 +129,7 @@ class Alarm(BaseModel, TimestampMixin):
     status = fields.CharField(max_length=20, default='active', description='状态: active / disabled / triggered / expired')
     trigger_count = fields.IntField(default=0, description='已触发次数')
     last_triggered = fields.DatetimeField(null=True, description='上次触发时间')
+    schedule_gen = fields.IntField(default=0, description='调度代数：重新调度或触发后加一')
 
     class Meta:
         table = 'alarm'
@@ -11,3 +11,27 @@ class Ota(BaseModel, TimestampMixin):
     whole_url = fields.CharField(max_length=255, null=True, description='完整固件 URL')
     is_default = fields.BooleanField(default=False, description='是否默认版本')
     force_update = fields.BooleanField(default=False, description='是否强制更新')
+    size = fields.BigIntField(null=True, description='固件大小')
+    sha256 = fields.CharField(max_length=64, null=True, description='固件sha256')
+    chunk_size = fields.IntField(null=True, description='分块大小')
+    chunk_manifest = fields.JSONField(null=True, description='各分块sha256，用于断点续传校验')
+    delta_from = fields.CharField(max_length=20, null=True, description='差分包基准版本')
+    delta_url = fields.CharField(max_length=255, null=True, description='差分包 URL')
+    delta_size = fields.BigIntField(null=True, description='差分包大小')
+    delta_sha256 = fields.CharField(max_length=64, null=True, description='差分包sha256')
+
+
+# OTA灰度发布表
+class OtaRollout(BaseModel, TimestampMixin):
+    ota_id = fields.IntField(index=True, description='目标OTA版本ID')
+    device_model = fields.CharField(max_length=255, index=True, description='设备型号')
+    app_version = fields.CharField(max_length=20, description='目标版本')
+    percentage = fields.IntField(default=0, description='灰度比例（0-100）')
+    salt = fields.CharField(max_length=32, description='分组盐值，按 MAC 稳定哈希分组')
+    status = fields.CharField(max_length=20, default='active', index=True, description='灰度状态')
+    fail_threshold = fields.FloatField(default=0.2, description='失败率阈值，超过后自动暂停')
+    min_samples = fields.IntField(default=20, description='失败率判定的最小样本数')
+    offered = fields.IntField(default=0, description='已下发次数')
+    succeeded = fields.IntField(default=0, description='升级成功次数')
+    failed = fields.IntField(default=0, description='升级失败次数')
+    halt_reason = fields.TextField(null=True, description='自动暂停原因')
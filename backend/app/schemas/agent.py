@@ -137,6 +137,17 @@ class ProfileVidGen(BaseModel):
     emotion: Optional[str] = Field(default=None, description='表情')
 
 
+class ProfileUploadSlot(BaseModel):
+    id: int = Field(description='形象ID')
+    source_type: str = Field(description='上传类型：emotion_vid/profile_vid')
+    emotion: Optional[str] = Field(default=None, description='情绪，emotion_vid 时必填')
+    content_type: str = Field(default='video/mp4', description='文件类型，上传时需带上相同的 Content-Type')
+
+
+class ProfileUploadFinalize(BaseModel):
+    slot_id: str = Field(description='上传凭证ID')
+
+
 # ========== SystemPrompt ==========
 class SystemPromptCreate(BaseModel):
     user_id: str = Field(description='用户ID')
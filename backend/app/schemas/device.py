@@ -1,5 +1,5 @@
 from datetime import datetime
-from typing import Optional
+from typing import List, Literal, Optional
 from pydantic import BaseModel, Field
 
 
@@ -13,6 +13,7 @@ class DeviceCreate(BaseModel):
     app_version: Optional[str] = None
     auto_update: Optional[bool] = False
     last_conversation: Optional[datetime] = None
+    last_seen_at: Optional[datetime] = None
     alias: Optional[str] = None
     is_unbound: Optional[bool] = False
     agent_id: Optional[str] = None
@@ -33,3 +34,33 @@ class DeviceBind(BaseModel):
 class DevicePush(BaseModel):
     serial_number: str = Field(description='设备序列号')
     message: dict = Field(description='推送消息')
+
+
+# 批量操作
+class DeviceImportItem(BaseModel):
+    mac_address: str = Field(description='设备MAC')
+    chip_type: Optional[str] = Field(default=None, description='芯片类型')
+    device_model: Optional[str] = Field(default=None, description='设备型号')
+    app_version: Optional[str] = Field(default=None, description='APP版本')
+    auto_update: Optional[bool] = Field(default=None, description='是否开启OTA')
+    alias: Optional[str] = Field(default=None, description='备注')
+    serial_number: Optional[str] = Field(default=None, description='序列号')
+
+
+class DeviceBulkImport(BaseModel):
+    devices: List[DeviceImportItem] = Field(description='设备列表')
+    on_conflict: Literal['skip', 'update'] = Field(default='skip', description='MAC已存在时：skip 跳过 / update 更新')
+
+
+class DeviceBulkIds(BaseModel):
+    ids: List[int] = Field(description='设备ID列表')
+
+
+class DeviceBulkOta(DeviceBulkIds):
+    auto_update: bool = Field(description='是否开启OTA')
+
+
+class DeviceBulkBind(BaseModel):
+    user_id: str = Field(description='用户ID')
+    agent_id: Optional[str] = Field(default=None, description='智能体ID')
+    codes: List[str] = Field(description='验证码列表')
@@ -19,3 +19,30 @@ class OtaUpdate(OtaCreate):
     chip_type: Optional[str] = None
     device_model: Optional[str] = None
     ota_url: Optional[str] = None
+
+
+# 固件直传
+class OtaUploadSlot(BaseModel):
+    app_version: str  # APP版本
+    device_model: str  # 设备型号
+    file_type: str  # 文件后缀，如 bin
+
+
+class OtaUploadFinalize(BaseModel):
+    slot_id: str  # 上传凭证ID
+
+
+# OTA灰度发布
+class OtaRolloutCreate(BaseModel):
+    ota_id: int  # 目标OTA版本ID
+    percentage: Optional[int] = 0  # 灰度比例（0-100）
+    fail_threshold: Optional[float] = 0.2  # 失败率阈值
+    min_samples: Optional[int] = 20  # 失败率判定的最小样本数
+
+
+class OtaRolloutUpdate(BaseModel):
+    id: int  # 灰度发布ID，不能为空
+    percentage: Optional[int] = None
+    status: Optional[str] = None  # active / paused / completed
+    fail_threshold: Optional[float] = None
+    min_samples: Optional[int] = None